@@ -0,0 +1,246 @@
+import hashlib
+import logging
+import pickle
+import sys
+import time
+import uuid
+
+from collections import OrderedDict
+from django.core.cache import caches
+from threading import Lock, Thread
+
+from rorapi.common import metrics
+from rorapi.settings import ES7, ES_VARS, MATCHING
+
+logger = logging.getLogger(__name__)
+
+#####################################################################
+# Index generation                                                  #
+#####################################################################
+
+# The index generation is a random value stored in the _meta of the index
+# mapping. It is changed every time the index is rebuilt, so that caches
+# in all processes can detect that their content is outdated.
+INDEX_GENERATION = {"value": None, "checked": None}
+INDEX_GENERATION_LOCK = Lock()
+
+
+def read_index_generation():
+    mapping = ES7.indices.get_mapping(index=ES_VARS["INDEX_V2"])
+    for index_mapping in mapping.values():
+        return index_mapping["mappings"].get("_meta", {}).get("generation")
+    return None
+
+
+def get_index_generation():
+    """Current index generation, re-read from ES at most once per
+    INDEX_GENERATION_CHECK_INTERVAL seconds. The thread re-reading it claims
+    the check, and other threads get the last known generation meanwhile
+    instead of waiting for ES."""
+
+    with INDEX_GENERATION_LOCK:
+        now = time.monotonic()
+        checked = INDEX_GENERATION["checked"]
+        if (
+            checked is not None
+            and now - checked < MATCHING["INDEX_GENERATION_CHECK_INTERVAL"]
+        ):
+            return INDEX_GENERATION["value"]
+        INDEX_GENERATION["checked"] = now
+        generation = INDEX_GENERATION["value"]
+    try:
+        generation = read_index_generation()
+    except Exception:
+        # keep the last known generation if ES cannot be reached
+        return generation
+    with INDEX_GENERATION_LOCK:
+        # unless the index was bumped by this process meanwhile
+        if INDEX_GENERATION["checked"] == now:
+            INDEX_GENERATION["value"] = generation
+        return INDEX_GENERATION["value"]
+
+
+def new_index_generation():
+    return uuid.uuid4().hex
+
+
+def bump_index_generation(generation=None):
+    """Mark the index as rebuilt, invalidating all caches."""
+
+    if generation is None:
+        generation = new_index_generation()
+    ES7.indices.put_mapping(
+        index=ES_VARS["INDEX_V2"], body={"_meta": {"generation": generation}}
+    )
+    with INDEX_GENERATION_LOCK:
+        INDEX_GENERATION["value"] = generation
+        INDEX_GENERATION["checked"] = time.monotonic()
+    return generation
+
+
+#####################################################################
+# LRU cache                                                         #
+#####################################################################
+
+
+def get_size(value):
+    """Approximate memory footprint of a cached value in bytes."""
+
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(get_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Thread-safe least recently used cache bounded by the number of
+    entries and their approximate size in bytes. Entries expire after ttl
+    seconds and the whole cache is cleared when the index generation
+    changes. A cache with max_entries=0 is disabled."""
+
+    def __init__(self, name, max_entries, max_bytes, ttl):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generation = None
+        self.lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        generation = get_index_generation()
+        with self.lock:
+            if generation != self.generation:
+                self.clear_entries(generation)
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] <= time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                metrics.CACHE_MISSES.labels(self.name).inc()
+                return None
+            self.entries.move_to_end(key)
+            metrics.CACHE_HITS.labels(self.name).inc()
+            return entry[0]
+
+    def __contains__(self, key):
+        # unlike get, does not refresh the entry nor count a hit or miss
+        if not self.enabled:
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[2] > time.monotonic()
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        size = get_size(key) + get_size(value)
+        if size > self.max_bytes:
+            return
+        generation = get_index_generation()
+        with self.lock:
+            if generation != self.generation:
+                self.clear_entries(generation)
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                metrics.CACHE_EVICTIONS.labels(self.name).inc()
+
+    def clear(self):
+        with self.lock:
+            self.clear_entries(self.generation)
+
+    def clear_entries(self, generation):
+        self.entries.clear()
+        self.bytes = 0
+        self.generation = generation
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+
+#####################################################################
+# Shared cache                                                      #
+#####################################################################
+
+
+class SharedCache:
+    """Cache shared by the worker processes, stored in a Django cache. Entries
+    are fresh for ttl seconds, then served stale for up to stale_ttl more
+    seconds while a single process refreshes them in the background. Keys
+    include the index generation, so that entries cached before the index
+    was rebuilt are never served. Values larger than max_bytes once pickled
+    are not cached. A cache with ttl=0 is disabled."""
+
+    def __init__(self, name, alias, ttl, stale_ttl, refresh_timeout, max_bytes):
+        self.name = name
+        self.alias = alias
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.refresh_timeout = refresh_timeout
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, key):
+        # Django cache keys must be short strings
+        key = repr((self.name, get_index_generation(), key))
+        return self.name + ":" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key, refresh):
+        """Cached value of the key, None if there is none. A stale value is
+        returned too, after starting its refresh with the refresh function
+        unless another process already did."""
+
+        if not self.enabled:
+            return None
+        cache_key = self.get_key(key)
+        entry = self.cache.get(cache_key)
+        if entry is None:
+            metrics.CACHE_MISSES.labels(self.name).inc()
+            return None
+        fresh_until, value = entry
+        if fresh_until > time.time():
+            metrics.CACHE_HITS.labels(self.name).inc()
+            return value
+        metrics.CACHE_STALE_HITS.labels(self.name).inc()
+        if self.cache.add(cache_key + ":refresh", True, self.refresh_timeout):
+            Thread(
+                target=self.refresh, args=(cache_key, refresh), daemon=True
+            ).start()
+        return value
+
+    def set(self, key, value):
+        if self.enabled:
+            self.store(self.get_key(key), value)
+
+    def store(self, cache_key, value):
+        entry = (time.time() + self.ttl, value)
+        if len(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)) > self.max_bytes:
+            return
+        self.cache.set(cache_key, entry, self.ttl + self.stale_ttl)
+
+    def refresh(self, cache_key, refresh):
+        try:
+            self.store(cache_key, refresh())
+        except Exception:
+            # the stale value is served until it expires or a refresh succeeds
+            logger.exception("Refresh of a %s cache entry failed", self.name)
+        finally:
+            self.cache.delete(cache_key + ":refresh")
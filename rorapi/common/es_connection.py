@@ -0,0 +1,14 @@
+from elasticsearch import RequestsHttpConnection
+from requests.adapters import HTTPAdapter
+
+
+class PooledRequestsHttpConnection(RequestsHttpConnection):
+    """Requests based ES connection that keeps up to pool_maxsize open HTTP
+    connections, so that the client can be shared by the matching worker
+    threads without discarding connections."""
+
+    def __init__(self, *args, pool_maxsize=10, **kwargs):
+        super(PooledRequestsHttpConnection, self).__init__(*args, **kwargs)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
@@ -2,6 +2,37 @@ from rorapi.settings import ES7, ES_VARS
 
 from elasticsearch_dsl import Search, Q
 
+# Fields of the organizations returned by lean affiliation queries: the
+# matching names come as inner hits and the full records are fetched only
+# for the organizations returned by the matching.
+AFFILIATION_SOURCE_FIELDS = [
+    "status",
+    "locations.geonames_details.country_code",
+    "affiliation_match.names_version",
+]
+AFFILIATION_INNER_HITS = 100
+
+COUNTRY_CODE_FIELD = "locations.geonames_details.country_code"
+
+# Pushdown of the matching constraints (country and status) into the
+# matching queries: none, as filters, or as boosts of the hits meeting them
+PUSHDOWN_OFF = "off"
+PUSHDOWN_FILTER = "filter"
+PUSHDOWN_BOOST = "boost"
+PUSHDOWN_MODES = [PUSHDOWN_OFF, PUSHDOWN_FILTER, PUSHDOWN_BOOST]
+PUSHDOWN_BOOST_WEIGHT = 5.0
+
+
+def open_point_in_time():
+    return ES7.open_point_in_time(
+        index=ES_VARS["INDEX_V2"], keep_alive=ES_VARS["CURSOR_PIT_KEEP_ALIVE"]
+    )["id"]
+
+
+def close_point_in_time(pit):
+    # the point in time may already have expired
+    ES7.close_point_in_time(body={"id": pit}, ignore=404)
+
 
 class ESQueryBuilder:
     """Elasticsearch query builder class"""
@@ -25,14 +56,21 @@ class ESQueryBuilder:
             query=Q("query_string", query=terms, fuzzy_max_expansions=1),
         )
 
-    def add_affiliation_query(self, terms, max_candidates):
-        # print(terms)
+    def add_affiliation_query(self, terms, max_candidates, lean=False):
+        """Nested match query over the single search names. A lean query
+        only returns the fields used for scoring, with the matching names as
+        inner hits."""
+
+        inner_hits = {"inner_hits": {"size": AFFILIATION_INNER_HITS}} if lean else {}
         self.search = self.search.query(
             "nested",
             path="affiliation_match.names",
             score_mode="max",
-            query=Q("match", **{"affiliation_match.names.name": terms})
+            query=Q("match", **{"affiliation_match.names.name": terms}),
+            **inner_hits
         ).extra(size=max_candidates)
+        if lean:
+            self.search = self.search.source(AFFILIATION_SOURCE_FIELDS)
 
         '''
         Nested(
@@ -85,6 +123,18 @@ class ESQueryBuilder:
         for f, v in filters.items():
             self.search = self.search.filter("terms", **{f: v})
 
+    def add_boosts(self, boosts, weight=PUSHDOWN_BOOST_WEIGHT):
+        """Boost the hits with one of the values of a field, without
+        filtering out the others."""
+
+        if not boosts:
+            return
+        self.search.query = Q(
+            "bool",
+            must=[self.search.query._proxied],
+            should=[Q("terms", boost=weight, **{f: list(v)}) for f, v in boosts.items()],
+        )
+
     def add_aggregations(self, names):
         for name in names:
             self.search.aggs.bucket(
@@ -96,6 +146,24 @@ class ESQueryBuilder:
             ((page - 1) * ES_VARS["BATCH_SIZE"]) : (page * ES_VARS["BATCH_SIZE"])
         ]
 
+    def add_cursor(self, search_after, pit=None):
+        """Stable sort of the results, resumed after the sort values of the
+        last result of the previous page, if any. With a point in time, the
+        search runs in it instead of the index."""
+
+        self.search = self.search.sort(
+            {"_score": {"order": "desc"}}, {"id": {"order": "asc"}}
+        )
+        if search_after:
+            self.search = self.search.extra(search_after=list(search_after))
+        if pit is not None:
+            self.search = self.search.index().extra(
+                pit={"id": pit, "keep_alive": ES_VARS["CURSOR_PIT_KEEP_ALIVE"]}
+            )
+
+    def add_source(self, fields):
+        self.search = self.search.source(fields)
+
     def get_query(self):
         return self.search
  
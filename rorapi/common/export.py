@@ -0,0 +1,154 @@
+import json
+import zlib
+
+from django.core.cache import caches
+from rest_framework.throttling import SimpleRateThrottle
+from rest_framework.utils.encoders import JSONEncoder
+
+from rorapi.common import metrics
+from rorapi.common.es_utils import close_point_in_time, open_point_in_time
+from rorapi.common.models import Errors
+from rorapi.common.queries import build_plan_query, get_search_plan, validate
+from rorapi.settings import EXPORT
+from rorapi.v2.models import Organization as OrganizationV2, get_field_tree
+from rorapi.v2.serializers import OrganizationSerializer as OrganizationSerializerV2
+
+# Search parameters that make no sense for an export of all the results
+ILLEGAL_EXPORT_PARAM_KEYS = ("page", "cursor", "facets")
+# gzip container of the deflate stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def validate_export(params):
+    """Validates export parameters, the search parameters without the
+    pagination and the facets. Returns an error object that can be
+    serialized into JSON or None."""
+
+    illegal_names = [k for k in params.keys() if k in ILLEGAL_EXPORT_PARAM_KEYS]
+    if illegal_names:
+        return Errors(["query parameter '{}' is illegal".format(n) for n in illegal_names])
+    return validate(params)
+
+
+def get_export_plan(params):
+    """Search plan of all the results of valid export parameters, sorted to
+    be read batch by batch"""
+
+    return get_search_plan(params)._replace(facets=False, search_after=())
+
+
+def export_organizations(plan):
+    """Organizations of all the results of the plan, fetched in batches of
+    BATCH_SIZE with search_after in a point in time, so that the results do
+    not change while they are read and only one batch is in memory. The
+    point in time is closed when the export ends or is interrupted."""
+
+    fields = get_field_tree(plan.fields)
+    plan = plan._replace(pit=open_point_in_time())
+    try:
+        while True:
+            search = build_plan_query(plan, aggregations=False)
+            search = search.extra(track_total_hits=False)[: EXPORT["BATCH_SIZE"]]
+            response = search.execute()
+            hits = response.hits
+            for hit in hits:
+                yield OrganizationV2(hit, fields)
+            if len(hits) < EXPORT["BATCH_SIZE"]:
+                break
+            plan = plan._replace(
+                search_after=tuple(hits[-1].meta.sort),
+                pit=response.to_dict().get("pit_id", plan.pit),
+            )
+    finally:
+        close_point_in_time(plan.pit)
+
+
+def stream_export(plan):
+    """Gzip-compressed NDJSON of the organizations of the plan, one
+    organization per line, in chunks of compressed data."""
+
+    serializer = OrganizationSerializerV2(fields=get_field_tree(plan.fields))
+    compressor = zlib.compressobj(EXPORT["COMPRESSION_LEVEL"], zlib.DEFLATED, GZIP_WBITS)
+    organizations = export_organizations(plan)
+    try:
+        for organization in organizations:
+            line = json.dumps(
+                serializer.to_representation(organization), cls=JSONEncoder
+            ) + "\n"
+            metrics.EXPORTED_ORGANIZATIONS.inc()
+            chunk = compressor.compress(line.encode("utf-8"))
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+    finally:
+        organizations.close()
+
+
+class ExportStream(object):
+    """Chunks of the export of the plan, holding an export stream of the
+    client, if any. The stream is released when the response is closed,
+    even if the export never started, as when the client disconnects before
+    the first chunk."""
+
+    def __init__(self, plan, ident=None):
+        self.chunks = stream_export(plan)
+        self.ident = ident
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        self.chunks.close()
+        if self.ident is not None:
+            release_export_stream(self.ident)
+            self.ident = None
+
+
+class ExportRateThrottle(SimpleRateThrottle):
+    """Limits the number of exports a client starts, by client address"""
+
+    scope = "export"
+    cache = caches["export"]
+
+    def get_rate(self):
+        return EXPORT["RATE"]
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {"scope": self.scope, "ident": self.get_ident(request)}
+
+
+def get_streams_key(ident):
+    return "export_streams_{}".format(ident)
+
+
+def acquire_export_stream(ident):
+    """Counts a new export stream of the client, unless the client already
+    streams MAX_STREAMS exports. The count is shared by the workers through
+    the export cache, with its add and incr operations (atomic with cache
+    backends like memcached)."""
+
+    cache = ExportRateThrottle.cache
+    key = get_streams_key(ident)
+    cache.add(key, 0, EXPORT["STREAM_TIMEOUT"])
+    try:
+        streams = cache.incr(key)
+    except ValueError:
+        # expired between add and incr
+        cache.add(key, 1, EXPORT["STREAM_TIMEOUT"])
+        return True
+    if streams > EXPORT["MAX_STREAMS"]:
+        release_export_stream(ident)
+        return False
+    return True
+
+
+def release_export_stream(ident):
+    cache = ExportRateThrottle.cache
+    try:
+        cache.decr(get_streams_key(ident))
+    except ValueError:
+        # expired, the stream is already forgotten
+        pass
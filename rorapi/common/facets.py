@@ -0,0 +1,192 @@
+import logging
+import numpy as np
+import time
+
+from collections import Counter
+from elasticsearch.helpers import scan
+from elasticsearch_dsl.utils import AttrDict
+from threading import Lock
+
+from rorapi.common.cache import get_index_generation
+from rorapi.settings import ES7, ES_VARS, MATCHING
+
+logger = logging.getLogger(__name__)
+
+# Facets of the search results: name and field of their terms aggregation
+FACETS = [
+    ("types", "types"),
+    ("countries", "locations.geonames_details.country_code"),
+    ("continents", "locations.geonames_details.continent_code"),
+    ("statuses", "status"),
+]
+# buckets per facet, as in the ES terms aggregations
+FACET_SIZE = 10
+FACET_FIELDS = [field for _, field in FACETS]
+
+# The facet table is the number of organizations for each combination of
+# their facet values (the signature). It is computed when the index is
+# written, stored in a separate index for its index generation and loaded
+# by each process. The facets of queries only filtering on facet fields are
+# computed from it instead of aggregating in ES.
+FACET_TABLE_ID = "facets"
+FACET_TABLE = {"generation": None, "table": None, "checked": None}
+FACET_TABLE_LOCK = Lock()
+# maximum number of filter combinations whose facets are kept in memory
+FACET_MEMO_SIZE = 1000
+
+
+class FacetTable:
+    """Facet table loaded in memory. For each facet, the values found in the
+    table and the (row, value) pairs of the rows with them, so that the
+    facets of any filters are computed with a few array operations. The
+    facets already computed are kept by filters."""
+
+    def __init__(self, rows):
+        self.counts = np.array([row[-1] for row in rows], dtype=np.int64)
+        self.values = []
+        self.positions = []
+        self.occurrences = []
+        for i in range(len(FACETS)):
+            values = sorted({v for row in rows for v in row[i]})
+            positions = {v: j for j, v in enumerate(values)}
+            pairs = [(r, positions[v]) for r, row in enumerate(rows) for v in row[i]]
+            self.values.append(values)
+            self.positions.append(positions)
+            self.occurrences.append(np.array(pairs, dtype=np.int64).reshape(-1, 2))
+        self.facets = {}
+
+
+def get_signature(organization):
+    locations = [l["geonames_details"] for l in organization.get("locations", [])]
+    return [
+        sorted(set(organization.get("types", []))),
+        sorted({l["country_code"] for l in locations if l.get("country_code")}),
+        sorted({l["continent_code"] for l in locations if l.get("continent_code")}),
+        [organization["status"]],
+    ]
+
+
+def build_facet_table(organizations):
+    """Rows of the facet table: the values of each facet field followed by
+    the number of organizations with them."""
+
+    counts = Counter(
+        tuple(tuple(values) for values in get_signature(org)) for org in organizations
+    )
+    return [[list(values) for values in signature] + [count]
+            for signature, count in counts.items()]
+
+
+def precompute_facets(generation):
+    """Compute the facet table of the whole index and store it for the given
+    index generation. Returns whether it succeeded; without a facet table,
+    all facets are aggregated in ES."""
+
+    try:
+        hits = scan(
+            ES7,
+            index=ES_VARS["INDEX_V2"],
+            query={"query": {"match_all": {}}},
+            _source=["types", "status", "locations.geonames_details"],
+        )
+        table = build_facet_table(hit["_source"] for hit in hits)
+        if not ES7.indices.exists(ES_VARS["INDEX_V2_FACETS"]):
+            # the table is only stored, never searched
+            ES7.indices.create(
+                index=ES_VARS["INDEX_V2_FACETS"], body={"mappings": {"enabled": False}}
+            )
+        ES7.index(
+            index=ES_VARS["INDEX_V2_FACETS"],
+            id=FACET_TABLE_ID,
+            body={"generation": generation, "table": table},
+        )
+    except Exception:
+        logger.exception("Facets of index generation %s not precomputed", generation)
+        return False
+    return True
+
+
+def read_facet_table(generation):
+    try:
+        doc = ES7.get(index=ES_VARS["INDEX_V2_FACETS"], id=FACET_TABLE_ID)["_source"]
+    except Exception:
+        return None
+    if doc.get("generation") != generation:
+        return None
+    return doc["table"]
+
+
+def get_facet_table():
+    """Facet table of the current index generation, None if there is none.
+    A missing table is looked up again at most once per
+    INDEX_GENERATION_CHECK_INTERVAL seconds."""
+
+    generation = get_index_generation()
+    if generation is None:
+        return None
+    with FACET_TABLE_LOCK:
+        if FACET_TABLE["generation"] != generation:
+            now = time.monotonic()
+            checked = FACET_TABLE["checked"]
+            if (
+                checked is None
+                or now - checked >= MATCHING["INDEX_GENERATION_CHECK_INTERVAL"]
+            ):
+                FACET_TABLE["checked"] = now
+                table = read_facet_table(generation)
+                if table is not None:
+                    FACET_TABLE["generation"] = generation
+                    FACET_TABLE["table"] = FacetTable(table)
+        if FACET_TABLE["generation"] != generation:
+            return None
+        return FACET_TABLE["table"]
+
+
+def is_precomputable(filters):
+    return all(field in FACET_FIELDS for field, _ in filters)
+
+
+def get_facets(table, filters):
+    """Aggregations of the organizations of the facet table matching the
+    filters, as (field, values) pairs, in the form of the ES terms
+    aggregations: the buckets with the most organizations first, ties broken
+    by key."""
+
+    rows = np.ones(len(table.counts), dtype=bool)
+    for field, values in filters:
+        i = FACET_FIELDS.index(field)
+        positions = [table.positions[i][v] for v in values if v in table.positions[i]]
+        occurrences = table.occurrences[i]
+        field_rows = np.zeros(len(table.counts), dtype=bool)
+        field_rows[occurrences[np.isin(occurrences[:, 1], positions), 0]] = True
+        rows &= field_rows
+    counts = table.counts * rows
+    aggregations = {}
+    for (name, _), values, occurrences in zip(FACETS, table.values, table.occurrences):
+        value_counts = np.bincount(
+            occurrences[:, 1], weights=counts[occurrences[:, 0]], minlength=len(values)
+        )
+        buckets = sorted(
+            ((-int(c), v) for v, c in zip(values, value_counts) if c > 0)
+        )[:FACET_SIZE]
+        aggregations[name] = {
+            "buckets": [{"key": v, "doc_count": -c} for c, v in buckets]
+        }
+    return AttrDict(aggregations)
+
+
+def get_precomputed_facets(filters):
+    """Facets of a query only filtering on facet fields, None if they were
+    not precomputed."""
+
+    if not is_precomputable(filters):
+        return None
+    table = get_facet_table()
+    if table is None:
+        return None
+    facets = table.facets.get(filters)
+    if facets is None:
+        facets = get_facets(table, filters)
+        if len(table.facets) < FACET_MEMO_SIZE:
+            table.facets[filters] = facets
+    return facets
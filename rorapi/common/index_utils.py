@@ -0,0 +1,70 @@
+import json
+import re
+import zipfile
+
+from rorapi.common.matching_names import NAMES_VERSION, get_matching_names
+
+
+def get_nested_names_v2(org):
+    for name in org['names']:
+        yield name['value']
+
+
+def get_nested_ids_v2(org):
+    yield org['id']
+    yield re.sub('https://', '', org['id'])
+    yield re.sub('https://ror.org/', '', org['id'])
+    for ext_id in org['external_ids']:
+        for eid in ext_id['all']:
+            yield eid
+
+
+def get_single_search_names_v2(org):
+    for name in org["names"]:
+        if "acronym" not in name["types"]:
+            yield name["value"]
+
+
+def get_affiliation_match_doc(org):
+    doc = {
+        'id': org['id'],
+        'country': org["locations"][0]["geonames_details"]["country_code"],
+        'status': org['status'],
+        'primary': [n["value"] for n in org["names"] if "ror_display" in n["types"]][0],
+        'names': get_matching_names(get_single_search_names_v2(org)),
+        'names_version': NAMES_VERSION,
+        'relationships': [{"type": r['type'], "id": r['id']} for r in org['relationships']]
+    }
+    return doc
+
+
+def add_index_fields(org):
+    """Add the fields only used for searching to a ROR record, as it is
+    indexed in the organizations index"""
+
+    org['names_ids'] = [{
+        'name': n
+    } for n in get_nested_names_v2(org)]
+    org['names_ids'] += [{
+        'id': n
+    } for n in get_nested_ids_v2(org)]
+    # experimental affiliations_match nested doc
+    org['affiliation_match'] = get_affiliation_match_doc(org)
+    return org
+
+
+def read_dump(path):
+    """Organizations from a ROR dump, either the JSON file or the zip
+    archive containing it."""
+
+    if not zipfile.is_zipfile(path):
+        with open(path) as f:
+            return json.load(f)
+    with zipfile.ZipFile(path) as archive:
+        files = sorted(n for n in archive.namelist() if n.endswith(".json"))
+        # v2 dumps contain a schema v1 and a schema v2 JSON file
+        files = [n for n in files if "schema_v2" in n] or files
+        if not files:
+            raise ValueError("ROR dump {} does not contain any JSON files".format(path))
+        with archive.open(files[0]) as f:
+            return json.load(f)
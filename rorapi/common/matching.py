@@ -1,17 +1,36 @@
 import geonamescache
+import math
+import numpy as np
 import os
 import re
-import unicodedata
-import unidecode
+import time
 
+from rorapi.common import metrics
 from rorapi.common.models import Errors
-from rorapi.common.es_utils import ESQueryBuilder
+from rorapi.common.es_utils import COUNTRY_CODE_FIELD, ESQueryBuilder, \
+    PUSHDOWN_BOOST, PUSHDOWN_FILTER
+from rorapi.common.matching_cache import cache_matching_results, \
+    cache_candidates, canonicalize_affiliation, get_cached_candidates, \
+    hydrate_organizations, is_cached
+from rorapi.common.matching_countries import CountryDetector
+from rorapi.common.matching_fragments import get_searched_parts
+from rorapi.common.matching_gazetteer import get_gazetteer
+from rorapi.common.matching_local import ENGINE_LOCAL, get_engine, \
+    get_local_index
+from rorapi.common.matching_names import get_name_forms, has_name_forms, \
+    normalize
+from rorapi.settings import ES7, ES_VARS, MATCHING
 from rorapi.v2.models import MatchingResult as MatchingResultV2
 
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from elasticsearch_dsl import MultiSearch
 from functools import lru_cache
 from fuzzywuzzy import fuzz
 from itertools import groupby
+from rapidfuzz.distance import Indel
+from rapidfuzz.process import cdist
+from threading import Lock
 
 MIN_CHOSEN_SCORE = 0.9
 MIN_MATCHING_SCORE = 0.5
@@ -46,9 +65,6 @@ def load_geonames_countries():
     return gc_countries
 
 
-GEONAMES_COUNTRIES = load_geonames_countries()
-
-
 @lru_cache(maxsize=None)
 def load_geonames_cities():
     """Load countries with population > 15000 from geonames"""
@@ -57,9 +73,6 @@ def load_geonames_cities():
     return gc_cities
 
 
-GEONAMES_CITIES = load_geonames_cities()
-
-
 @lru_cache(maxsize=None)
 def load_countries():
     """Load custom country code map from countries.txt"""
@@ -91,25 +104,14 @@ def to_region(c):
     }.get(c, c)
 
 
+COUNTRY_DETECTOR = CountryDetector(COUNTRIES, fuzz.ratio, fuzz.partial_ratio)
+
+
 def get_country_codes(string):
     """Extract the country codes from the string,
     if the country names are mentioned."""
 
-    string = unidecode.unidecode(string).strip()
-    lower = re.sub(r"\s+", " ", string.lower())
-    lower_alpha = re.sub(r"\s+", " ", re.sub("[^a-z]", " ", string.lower()))
-    alpha = re.sub(r"\s+", " ", re.sub("[^a-zA-Z]", " ", string))
-    codes = []
-    for code, name in COUNTRIES:
-        if re.search("[^a-z]", name):
-            score = fuzz.partial_ratio(name, lower)
-        elif len(name) == 2:
-            score = max([fuzz.ratio(name.upper(), t) for t in alpha.split()])
-        else:
-            score = max([fuzz.ratio(name, t) for t in lower_alpha.split()])
-        if score >= 90:
-            codes.append(code.upper())
-    return list(set(codes))
+    return COUNTRY_DETECTOR.get_country_codes(string)
 
 
 def get_countries(string):
@@ -124,56 +126,11 @@ def get_countries(string):
 #####################################################################
 
 
-def check_latin_chars(s):
-    for ch in s:
-        if ch.isalpha():
-            if "LATIN" not in unicodedata.name(ch):
-                return False
-    return True
-
-
-def normalize(s):
-    """Normalize string for matching."""
-
-    if check_latin_chars(s):
-        s = re.sub(r"\s+", " ", unidecode.unidecode(s).strip().lower())
-    else:
-        s = re.sub(r"\s+", " ", s.strip().lower())
-    s = re.sub(
-        "(?<![a-z])univ$",
-        "university",
-        re.sub(
-            r"(?<![a-z])univ[\. ]",
-            "university ",
-            re.sub(r"(?<![a-z])u\.(?! ?[a-z]\.)", "university ", s),
-        ),
-    )
-    s = re.sub(
-        "(?<![a-z])lab$", "laboratory", re.sub("(?<![a-z])lab[^a-z]", "laboratory ", s)
-    )
-    s = re.sub(
-        "(?<![a-z])inst$", "institute", re.sub("(?<![a-z])inst[^a-z]", "institute ", s)
-    )
-    s = re.sub(
-        "(?<![a-z])tech$",
-        "technology",
-        re.sub("(?<![a-z])tech[^a-z]", "technology ", s),
-    )
-    s = re.sub(r"(?<![a-z])u\. ?s\.", "united states", s)
-    s = re.sub("&", " and ", re.sub("&amp;", " and ", s))
-    s = re.sub("^the ", "", s)
-    s = re.sub(r"\s+", " ", s.strip().lower())
-    return s
-
-
-def get_similarity(aff_sub, cand_name):
-    """Calculate the similarity between the affiliation substring
-    and the candidate name version."""
+def is_partial_comparison(aff_sub):
+    """Whether the normalized affiliation substring is compared to the
+    candidate names with partial_ratio rather than token_sort_ratio."""
 
-    aff_sub = normalize(aff_sub)
-    cand_name = normalize(cand_name)
-    comparfun = fuzz.token_sort_ratio
-    if (
+    return (
         "(" in aff_sub
         or ")" in aff_sub
         or "-" in aff_sub
@@ -193,29 +150,354 @@ def get_similarity(aff_sub, cand_name):
             ]
         )
         > 1
+    )
+
+
+def get_similarities(aff_sub, cand_names):
+    """Calculate the similarities between the affiliation substring and all
+    the candidate name versions at once."""
+
+    return score_name_forms(aff_sub, [get_name_forms(name) for name in cand_names])
+
+
+def score_name_forms(aff_sub, forms):
+    """Similarities between the affiliation substring and the precomputed
+    forms of the candidate names. token_sort_ratio is computed as a single
+    rapidfuzz cdist over the token sorted names, with the same scores as
+    fuzzywuzzy."""
+
+    aff_sub = normalize(aff_sub)
+    if is_partial_comparison(aff_sub):
+        return [fuzz.partial_ratio(aff_sub, f["stripped"]) / 100 for f in forms]
+    if not forms:
+        return []
+    similarities = cdist(
+        [fuzz._process_and_sort(aff_sub, force_ascii=True)],
+        [f["sorted"] for f in forms],
+        scorer=Indel.normalized_similarity,
+        dtype=np.float64,
+    )[0]
+    # fuzzywuzzy rounds the ratio half to even, like rint
+    return (np.rint(100 * similarities) / 100).tolist()
+
+
+def get_candidate_name_forms(candidate):
+    """Forms of the candidate names, other than acronyms. They are read from
+    the affiliation_match document when it was indexed with them, and
+    computed otherwise."""
+
+    affiliation_match = getattr(candidate, "affiliation_match", None)
+    if has_name_forms(affiliation_match):
+        return list(affiliation_match["names"])
+    return [
+        get_name_forms(name["value"])
+        for name in candidate.names
+        if "acronym" not in name["types"]
+    ]
+
+
+def get_similarity(aff_sub, cand_name):
+    """Calculate the similarity between the affiliation substring
+    and the candidate name version."""
+
+    return get_similarities(aff_sub, [cand_name])[0]
+
+
+def get_scores(candidates, aff_sub, countries):
+    """Calculate the similarities between the affiliation substring and the
+    candidates, using all name versions. The names of all candidates are
+    scored together."""
+
+    allowed = []
+    names = []
+    for i, candidate in enumerate(candidates):
+        country_code = candidate.locations[0].geonames_details.country_code
+        allowed.append(not countries or to_region(country_code) in countries)
+        if allowed[-1]:
+            names.extend((i, forms) for forms in get_candidate_name_forms(candidate))
+    similarities = score_name_forms(aff_sub, [forms for _, forms in names])
+    candidate_scores = [[] for _ in candidates]
+    for (i, _), similarity in zip(names, similarities):
+        candidate_scores[i].append(similarity)
+
+    scores = []
+    for candidate, is_allowed, candidate_score in zip(
+        candidates, allowed, candidate_scores
     ):
-        comparfun = fuzz.partial_ratio
-    cand_name = re.sub(r"\(.*\)", "", cand_name).strip()
-    return comparfun(aff_sub, cand_name) / 100
+        if not is_allowed:
+            scores.append(0)
+            continue
+        acronyms = [
+            name["value"] for name in candidate.names if "acronym" in name["types"]
+        ]
+        if aff_sub != "USA" and aff_sub in acronyms:
+            candidate_score.append(1) if countries else candidate_score.append(0.9)
+        scores.append(max(candidate_score))
+    return scores
 
 
 def get_score(candidate, aff_sub, countries):
     """Calculate the similarity between the affiliation substring
     and the candidate, using all name versions."""
-    country_code = candidate.locations[0].geonames_details.country_code
-    all_names = [
-        name["value"] for name in candidate.names if "acronym" not in name["types"]
-    ]
-    acronyms = [
-        name["value"] for name in candidate.names if "acronym" in name["types"]
-    ]
 
-    if countries and to_region(country_code) not in countries:
-        return 0
-    scores = [get_similarity(aff_sub, name) for name in all_names]
-    if aff_sub != "USA" and aff_sub in acronyms:
-        scores.append(1) if countries else scores.append(0.9)
-    return max(scores)
+    return get_scores([candidate], aff_sub, countries)[0]
+
+
+#####################################################################
+# Query execution                                                   #
+#####################################################################
+
+QUERY_EXECUTION_SEQUENTIAL = "sequential"
+QUERY_EXECUTION_BATCH = "batch"
+QUERY_EXECUTION_CONCURRENT = "concurrent"
+
+QUERY_KIND_PHRASE = "phrase"
+QUERY_KIND_COMMON = "common"
+QUERY_KIND_FUZZY = "fuzzy"
+QUERY_KIND_ACRONYM = "acronym"
+QUERY_KIND_EXACT = "exact"
+
+QUERY_KINDS = {
+    MATCHING_TYPE_PHRASE: QUERY_KIND_PHRASE,
+    MATCHING_TYPE_COMMON: QUERY_KIND_COMMON,
+    MATCHING_TYPE_FUZZY: QUERY_KIND_FUZZY,
+    MATCHING_TYPE_HEURISTICS: QUERY_KIND_COMMON,
+    MATCHING_TYPE_ACRONYM: QUERY_KIND_ACRONYM,
+    MATCHING_TYPE_EXACT: QUERY_KIND_EXACT,
+}
+
+# Constraints on the candidates pushed down into the matching queries, as
+# tuples of (field, values) pairs
+QueryConstraints = namedtuple("QueryConstraints", ["filters", "boosts"])
+NO_CONSTRAINTS = QueryConstraints((), ())
+
+# Description of a matching ES query. Two matching queries with the same
+# kind, fields, (normalized) terms and constraints are the same ES query.
+MatchingQuery = namedtuple("MatchingQuery", ["kind", "fields", "terms", "constraints"])
+MatchingQuery.__new__.__defaults__ = (NO_CONSTRAINTS,)
+
+
+def get_query_constraints(countries, active_only):
+    """Constraints applied to the candidates after scoring, pushed down into
+    the matching queries according to the pushdown mode: candidates outside
+    the regions of the affiliation countries score 0, and inactive ones are
+    dropped when active_only."""
+
+    constraints = []
+    if countries:
+        codes = {code for region in countries for code in region.split("-")}
+        constraints.append((COUNTRY_CODE_FIELD, tuple(sorted(codes))))
+    if active_only:
+        constraints.append(("status", ("active",)))
+    if MATCHING["PUSHDOWN"] == PUSHDOWN_FILTER:
+        return QueryConstraints(tuple(constraints), ())
+    if MATCHING["PUSHDOWN"] == PUSHDOWN_BOOST:
+        return QueryConstraints((), tuple(constraints))
+    return NO_CONSTRAINTS
+
+
+def build_query(query):
+    """Build the ES query from the matching query description."""
+
+    qb = ESQueryBuilder()
+    if query.kind == QUERY_KIND_PHRASE:
+        qb.add_phrase_query(query.fields, query.terms)
+    elif query.kind == QUERY_KIND_COMMON:
+        qb.add_common_query(query.fields, query.terms)
+    elif query.kind == QUERY_KIND_FUZZY:
+        qb.add_fuzzy_query(query.fields, query.terms)
+    elif query.kind == QUERY_KIND_ACRONYM:
+        qb.add_match_query(query.terms)
+    elif query.kind == QUERY_KIND_EXACT:
+        qb.add_string_query(query.terms)
+    qb.add_filters({f: list(v) for f, v in query.constraints.filters})
+    qb.add_boosts(dict(query.constraints.boosts))
+    return qb.get_query()
+
+
+def run_local_query(query):
+    """Run the matching query against the local index, instead of ES."""
+
+    index = get_local_index()
+    # the local scoring is not affected by boosts
+    filters = query.constraints.filters
+    if query.kind == QUERY_KIND_EXACT:
+        return index.search_names_ids(query.terms.strip('"'), filters=filters)
+    if query.kind == QUERY_KIND_ACRONYM:
+        # the v2 index has no acronyms field, ES never returns candidates
+        return []
+    return index.search_names(query.kind, query.terms, filters=filters)
+
+
+class QueryExecutor:
+    """Executes matching queries one at a time, as they are needed.
+
+    The executor lives for a single request and memoizes the responses, so
+    that every distinct query is run only once. Queries whose candidates are
+    in the cross-request candidate cache are not sent to ES at all. executed
+    counts the queries sent to ES, saved counts the queries served from the
+    memo."""
+
+    batched = False
+
+    def __init__(self):
+        self.responses = {}
+        self.executed = 0
+        self.saved = 0
+        self.lock = Lock()
+
+    def prefetch(self, queries):
+        pass
+
+    def execute(self, query):
+        with self.lock:
+            response = self.responses.get(query)
+            if response is None:
+                response = self.responses[query] = Future()
+                fetch = True
+            else:
+                self.saved += 1
+                metrics.MATCHING_QUERIES_SAVED.inc()
+                fetch = False
+        if fetch:
+            try:
+                response.set_result(self.fetch(query))
+            except Exception as e:
+                response.set_exception(e)
+        return response.result()
+
+    def fetch(self, query):
+        candidates = get_cached_candidates(query)
+        if candidates is None:
+            with self.lock:
+                self.executed += 1
+            metrics.MATCHING_QUERIES_EXECUTED.inc()
+            candidates = build_query(query).execute()
+            cache_candidates(query, candidates)
+        return candidates
+
+    def map(self, fn, items):
+        """Apply fn to all items, returning the results in the same order."""
+        return [fn(item) for item in items]
+
+
+class BatchQueryExecutor(QueryExecutor):
+    """Sends all the queries of a request to ES in a single multi search
+    round trip and serves the responses from memory while scoring."""
+
+    batched = True
+
+    def __init__(self):
+        super(BatchQueryExecutor, self).__init__()
+        self.prefetched = set()
+
+    def prefetch(self, queries):
+        pending = []
+        with self.lock:
+            for query in queries:
+                if query not in self.responses:
+                    self.responses[query] = Future()
+                    self.prefetched.add(query)
+                    candidates = get_cached_candidates(query)
+                    if candidates is None:
+                        pending.append(query)
+                    else:
+                        self.responses[query].set_result(candidates)
+            self.executed += len(pending)
+        if not pending:
+            return
+        metrics.MATCHING_QUERIES_EXECUTED.inc(len(pending))
+        ms = MultiSearch(using=ES7, index=ES_VARS["INDEX_V2"])
+        for query in pending:
+            ms = ms.add(build_query(query))
+        try:
+            responses = ms.execute()
+        except Exception as e:
+            for query in pending:
+                self.responses[query].set_exception(e)
+            raise
+        for query, response in zip(pending, responses):
+            cache_candidates(query, response)
+            self.responses[query].set_result(response)
+
+    def execute(self, query):
+        # the first use of a prefetched response is not a saved query
+        with self.lock:
+            prefetched = query in self.prefetched
+            self.prefetched.discard(query)
+        if prefetched:
+            return self.responses[query].result()
+        return super(BatchQueryExecutor, self).execute(query)
+
+
+class LocalQueryExecutor(QueryExecutor):
+    """Executes the matching queries against the local index. The queries
+    are cheap, so the candidate cache is not used."""
+
+    def fetch(self, query):
+        with self.lock:
+            self.executed += 1
+        return run_local_query(query)
+
+
+@lru_cache(maxsize=None)
+def get_worker_pool():
+    """Thread pool shared by all matching requests of the process."""
+    return ThreadPoolExecutor(
+        max_workers=MATCHING["WORKERS"], thread_name_prefix="matching"
+    )
+
+
+class ConcurrentQueryExecutor(QueryExecutor):
+    """Runs independent matching tasks on the shared worker pool. Results are
+    collected in submission order, so the outcome is the same as in the
+    sequential execution."""
+
+    def map(self, fn, items):
+        return list(get_worker_pool().map(fn, items))
+
+
+class Deadline:
+    """Time budget of the matching of an affiliation, in seconds from its
+    creation (no budget if seconds is 0 or None). hit is set once matching
+    work has been skipped because the budget was spent."""
+
+    def __init__(self, seconds=None):
+        self.end = time.monotonic() + seconds if seconds else None
+        self.hit = False
+
+    def expired(self):
+        return self.end is not None and time.monotonic() >= self.end
+
+
+def get_deadline(params):
+    """Deadline of a matching request, from the deadline parameter (in
+    seconds) or the configured default. Raises ValueError if the parameter
+    is invalid."""
+
+    seconds = params.get("deadline", MATCHING["DEADLINE"])
+    try:
+        seconds = float(seconds)
+    except (TypeError, ValueError):
+        seconds = -1
+    # a NaN deadline would never expire and an infinite one disables it
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(
+            "'deadline' must be a non-negative number of seconds, got '{}'".format(
+                params.get("deadline")
+            )
+        )
+    return Deadline(seconds)
+
+
+def get_query_executor(engine=None):
+    if get_engine(engine) == ENGINE_LOCAL:
+        return LocalQueryExecutor()
+    if MATCHING["QUERY_EXECUTION"] == QUERY_EXECUTION_BATCH:
+        return BatchQueryExecutor()
+    if MATCHING["QUERY_EXECUTION"] == QUERY_EXECUTION_CONCURRENT:
+        return ConcurrentQueryExecutor()
+    return QueryExecutor()
 
 
 #####################################################################
@@ -229,13 +511,12 @@ MatchedOrganization = namedtuple(
 MatchedOrganization.__new__.__defaults__ = (False, None, None, 0, None)
 
 
-def match_by_query(text, matching_type, query, countries):
+def match_by_query(text, matching_type, query, countries, executor=None):
     """Match affiliation text using specific ES query."""
-    candidates = query.execute()
-    scores = [
-        (candidate, get_score(candidate, text, countries))
-        for candidate in candidates
-    ]
+    if executor is None:
+        executor = QueryExecutor()
+    candidates = executor.execute(query)
+    scores = list(zip(candidates, get_scores(candidates, text, countries)))
     if not candidates:
         return MatchedOrganization(substring=text, matching_type=matching_type), []
     max_score = max([s[1] for s in scores])
@@ -252,10 +533,11 @@ def match_by_query(text, matching_type, query, countries):
     return chosen, all_matched
 
 
-def match_by_type(text, matching_type, countries):
-    """Match affiliation text using specific matching mode/type."""
+def get_queries_by_type(text, matching_type, constraints=NO_CONSTRAINTS):
+    """Describe the ES queries for the substrings of the affiliation text
+    matched using specific matching mode/type."""
 
-    fields = ["names.value.norm"]
+    fields = ("names.value.norm",)
     substrings = []
     if matching_type == MATCHING_TYPE_HEURISTICS:
         h1 = re.search(r"University of ([^\s]+)", text)
@@ -267,34 +549,33 @@ def match_by_type(text, matching_type, countries):
             substrings.append(h2.group())
             substrings.append("University of " + h2.group(1))
     elif matching_type == MATCHING_TYPE_ACRONYM:
-        iso3_substrings = []
+        gazetteer = get_gazetteer()
         all_substrings = re.findall("[A-Z]{3,}", text)
-        for substring in all_substrings:
-            for country in GEONAMES_COUNTRIES.values():
-                if substring.lower() == country["iso3"].lower():
-                    iso3_substrings.append(substring)
-        substrings = [x for x in all_substrings if x not in iso3_substrings]
+        substrings = [x for x in all_substrings if not gazetteer.is_iso3(x)]
 
     else:
         substrings.append(text)
 
-    queries = [ESQueryBuilder() for _ in substrings]
-
-    for s, q in zip(substrings, queries):
-        if matching_type == MATCHING_TYPE_PHRASE:
-            q.add_phrase_query(fields, normalize(text))
-        elif matching_type == MATCHING_TYPE_COMMON:
-            q.add_common_query(fields, normalize(text))
-        elif matching_type == MATCHING_TYPE_FUZZY:
-            q.add_fuzzy_query(fields, normalize(text))
-        elif matching_type == MATCHING_TYPE_ACRONYM:
-            q.add_match_query(normalize(text))
-        elif matching_type == MATCHING_TYPE_HEURISTICS:
-            q.add_common_query(fields, normalize(text))
-    queries = [q.get_query() for q in queries]
+    if not substrings:
+        return []
+    # all the queries are built from the whole text, not the substring, so
+    # heuristics and acronym queries repeat and are served by the query memo
+    if matching_type == MATCHING_TYPE_ACRONYM:
+        fields = ("acronyms",)
+    query = MatchingQuery(
+        QUERY_KINDS[matching_type], fields, normalize(text), constraints
+    )
+    return [(s, query) for s in substrings]
+
+
+def match_by_type(
+    text, matching_type, countries, executor=None, constraints=NO_CONSTRAINTS
+):
+    """Match affiliation text using specific matching mode/type."""
+
     matched = [
-        match_by_query(t, matching_type, q, countries)
-        for t, q in zip(substrings, queries)
+        match_by_query(t, matching_type, q, countries, executor)
+        for t, q in get_queries_by_type(text, matching_type, constraints)
     ]
     if not matched:
         matched.append(
@@ -316,20 +597,30 @@ class MatchingNode:
         self.matched = None
         self.all_matched = []
 
-    def match(self, countries, min_score):
+    def get_queries(self, constraints=NO_CONSTRAINTS):
+        return [
+            q
+            for matching_type in NODE_MATCHING_TYPES
+            for _, q in get_queries_by_type(self.text, matching_type, constraints)
+        ]
+
+    def add_match(self, chosen, all_matched, min_score):
+        self.all_matched.extend(all_matched)
+        if self.matched is None:
+            self.matched = chosen
+        if (
+            self.matched is not None
+            and chosen.score > self.matched.score
+            and self.matched.score < min_score
+        ):
+            self.matched = chosen
+
+    def match(self, countries, min_score, executor=None, constraints=NO_CONSTRAINTS):
         for matching_type in NODE_MATCHING_TYPES:
             chosen, all_matched = match_by_type(
-                self.text, matching_type, countries
+                self.text, matching_type, countries, executor, constraints
             )
-            self.all_matched.extend(all_matched)
-            if self.matched is None:
-                self.matched = chosen
-            if (
-                self.matched is not None
-                and chosen.score > self.matched.score
-                and self.matched.score < min_score
-            ):
-                self.matched = chosen
+            self.add_match(chosen, all_matched, min_score)
 
 
 def clean_search_string(search_string):
@@ -349,18 +640,10 @@ def check_do_not_match(search_string):
         do_not_match = True
         return do_not_match
     else:
-        for country in GEONAMES_COUNTRIES.values():
-            if (
-                search_string.lower() == country["name"].lower()
-                or search_string.lower() == country["iso"].lower()
-                or search_string.lower() == country["iso3"].lower()
-            ):
-                do_not_match = True
-                break
-        for city in GEONAMES_CITIES.values():
-            if search_string.lower() == city["name"].lower():
-                do_not_match = True
-                break
+        gazetteer = get_gazetteer()
+        do_not_match = gazetteer.is_country(search_string) or gazetteer.is_city(
+            search_string
+        )
     return do_not_match
 
 
@@ -369,16 +652,24 @@ class MatchingGraph:
     are substrings that could be potentially matched to an organization name.
     Some substrings contain other substrings, which defines the graph edges.
     This prevents matching an organization to a substring and another
-    organization to the substring's substring."""
+    organization to the substring's substring. The constraints are pushed
+    down into all its queries. The countries found in the affiliation, if
+    known, are kept with the graph so that they are detected only once."""
 
-    def __init__(self, affiliation):
+    def __init__(self, affiliation, constraints=NO_CONSTRAINTS, countries=None):
         self.nodes = []
         self.affiliation = affiliation
+        self.constraints = constraints
+        self.countries = countries
         affiliation = re.sub("&amp;", "&", affiliation)
         affiliation_cleaned = clean_search_string(affiliation)
         n = MatchingNode(affiliation_cleaned)
         self.nodes.append(n)
-        for part in [s.strip() for s in re.split("[,;:]", affiliation)]:
+        parts = [s.strip() for s in re.split("[,;:]", affiliation)]
+        if MATCHING["FRAGMENT_CLASSIFIER"]:
+            # parts that cannot be the matched organization are not searched
+            parts = get_searched_parts(parts)
+        for part in parts:
             part_cleaned = clean_search_string(part)
             do_not_match = check_do_not_match(part_cleaned)
             # do not perform search if substring exactly matches a country name or ISO code
@@ -391,9 +682,50 @@ class MatchingGraph:
             if node.matched is not None and node.matched.score < min_score:
                 node.matched = None
 
-    def match(self, countries, min_score):
+    def get_queries(self):
+        """All the ES queries needed to match the graph."""
+        queries = [
+            q for node in self.nodes for q in node.get_queries(self.constraints)
+        ]
+        queries.extend(
+            q
+            for _, q in get_queries_by_type(
+                self.affiliation, MATCHING_TYPE_ACRONYM, self.constraints
+            )
+        )
+        return queries
+
+    def match(self, countries, min_score, executor=None, deadline=None):
+        if executor is None:
+            executor = QueryExecutor()
+        # every (node, matching type) pair and the acronym matching are
+        # independent, the results are applied to the nodes in order
+        tasks = [
+            (node.text, matching_type)
+            for node in self.nodes
+            for matching_type in NODE_MATCHING_TYPES
+        ]
+        tasks.append((self.affiliation, MATCHING_TYPE_ACRONYM))
+
+        def match_task(task):
+            # once the deadline has passed, the remaining tasks are skipped
+            # and the graph is matched with the results found so far
+            if deadline is not None and deadline.expired():
+                deadline.hit = True
+                metrics.MATCHING_TASKS_SKIPPED.inc()
+                return None
+            return match_by_type(
+                task[0], task[1], countries, executor, self.constraints
+            )
+
+        results = iter(executor.map(match_task, tasks))
         for node in self.nodes:
-            node.match(countries, min_score)
+            for _ in NODE_MATCHING_TYPES:
+                result = next(results)
+                if result is not None:
+                    node.add_match(*result, min_score)
+        acronym_result = next(results)
+        acr_all_matched = [] if acronym_result is None else acronym_result[1]
         self.remove_low_scores(min_score)
         chosen = []
         all_matched = []
@@ -403,9 +735,6 @@ class MatchingGraph:
                 m.organization["id"] for m in chosen
             ]:
                 chosen.append(node.matched)
-        acr_chosen, acr_all_matched = match_by_type(
-            self.affiliation, MATCHING_TYPE_ACRONYM, countries
-        )
         all_matched.extend(acr_all_matched)
         return chosen, all_matched
 
@@ -474,23 +803,112 @@ def get_output(chosen, all_matched, active_only):
     return sorted(output, key=lambda x: x.score, reverse=True)[:100]
 
 
-def check_exact_match(affiliation, countries):
-    qb = ESQueryBuilder()
-    qb.add_string_query('"' + affiliation + '"')
+def get_exact_match_query(affiliation, constraints=NO_CONSTRAINTS):
+    return MatchingQuery(
+        QUERY_KIND_EXACT, ("names_ids",), '"' + affiliation + '"', constraints
+    )
+
+
+def check_exact_match(affiliation, countries, executor=None, constraints=NO_CONSTRAINTS):
     return match_by_query(
-        affiliation, MATCHING_TYPE_EXACT, qb.get_query(), countries
+        affiliation,
+        MATCHING_TYPE_EXACT,
+        get_exact_match_query(affiliation, constraints),
+        countries,
+        executor,
     )
 
 
-def match_affiliation(affiliation, active_only):
+def get_matching_graph(affiliation, active_only):
+    """Matching graph of the canonical affiliation, with its countries and
+    the constraints they imply. It is built once, then used both to collect
+    the queries of the affiliation and to match it."""
+
+    affiliation = canonicalize_affiliation(affiliation)
     countries = get_countries(affiliation)
-    exact_chosen, exact_all_matched = check_exact_match(affiliation, countries)
+    return MatchingGraph(
+        affiliation, get_query_constraints(countries, active_only), countries
+    )
+
+
+def get_graph_queries(graph):
+    """All the queries the multi search matching of the affiliation of the
+    graph may send: the exact match query and the graph queries."""
+
+    return [get_exact_match_query(graph.affiliation, graph.constraints)] + (
+        graph.get_queries()
+    )
+
+
+@cache_matching_results(single_search=False, factory=MatchedOrganization)
+def match_affiliation(
+    affiliation, active_only, engine=None, executor=None, deadline=None, graph=None
+):
+    """Match the affiliation with the multi search. graph is the matching
+    graph of the affiliation, when it was already built to collect its
+    queries."""
+
+    if executor is None:
+        executor = get_query_executor(engine)
+    if graph is None and executor.batched:
+        graph = get_matching_graph(affiliation, active_only)
+    if graph is not None:
+        countries, constraints = graph.countries, graph.constraints
+    else:
+        countries = get_countries(affiliation)
+        constraints = get_query_constraints(countries, active_only)
+    if executor.batched:
+        # the graph queries are sent together with the exact match query,
+        # even though they are not needed if the exact match succeeds
+        executor.prefetch(get_graph_queries(graph))
+    exact_chosen, exact_all_matched = check_exact_match(
+        affiliation, countries, executor, constraints
+    )
     if exact_chosen.score == 1.0:
-        return get_output(exact_chosen, exact_all_matched, active_only)
+        output = get_output(exact_chosen, exact_all_matched, active_only)
     else:
-        graph = MatchingGraph(affiliation)
-        chosen, all_matched = graph.match(countries, MIN_CHOSEN_SCORE)
-        return get_output(chosen, all_matched, active_only)
+        if graph is None:
+            graph = MatchingGraph(affiliation, constraints, countries)
+        chosen, all_matched = graph.match(
+            countries, MIN_CHOSEN_SCORE, executor, deadline
+        )
+        output = get_output(chosen, all_matched, active_only)
+        if deadline is not None and deadline.hit:
+            metrics.MATCHING_DEADLINE_HITS.inc()
+    return hydrate_organizations(output)
+
+
+def match_affiliations(affiliations, active_only, engine=None):
+    """Match a batch of distinct affiliations with a shared query executor,
+    so that queries repeated across the batch are run once and, in batch
+    mode, all queries go to ES in a single msearch. Returns a dict mapping
+    each affiliation to its matched organizations or the exception raised
+    while matching it."""
+
+    engine = get_engine(engine)
+    executor = get_query_executor(engine)
+    # the graphs built to collect the queries are reused for the matching
+    graphs = {}
+    if executor.batched:
+        queries = []
+        for affiliation in affiliations:
+            if not is_cached(affiliation, False, active_only, engine=engine):
+                graphs[affiliation] = get_matching_graph(affiliation, active_only)
+                queries.extend(get_graph_queries(graphs[affiliation]))
+        executor.prefetch(queries)
+    results = {}
+    for affiliation in affiliations:
+        try:
+            results[affiliation] = match_affiliation(
+                affiliation,
+                active_only,
+                engine=engine,
+                executor=executor,
+                graph=graphs.get(affiliation),
+            )
+        except Exception as e:
+            results[affiliation] = e
+    return results
 
 
 def match_organizations(params):
@@ -499,6 +917,13 @@ def match_organizations(params):
         if "all_status" in params:
             if params["all_status"] == "" or params["all_status"].lower() == "true":
                 active_only = False
-        matched = match_affiliation(params.get("affiliation"), active_only)
-        return None, MatchingResultV2(matched)
+        try:
+            engine = get_engine(params.get("engine"))
+            deadline = get_deadline(params)
+        except ValueError as e:
+            return Errors([str(e)]), None
+        matched = match_affiliation(
+            params.get("affiliation"), active_only, engine=engine, deadline=deadline
+        )
+        return None, MatchingResultV2(matched, partial=deadline.hit)
     return Errors('"affiliation" parameter missing'), None
@@ -0,0 +1,131 @@
+import json
+import logging
+
+from itertools import islice
+
+from rorapi.common import matching, matching_single_search
+from rorapi.common.matching_cache import canonicalize_affiliation
+from rorapi.common.matching_local import get_engine
+from rorapi.common.models import Errors
+from rorapi.settings import MATCHING
+from rorapi.v2.models import MatchingResult as MatchingResultV2
+
+logger = logging.getLogger(__name__)
+
+
+def is_true(value):
+    if isinstance(value, bool):
+        return value
+    return isinstance(value, str) and value.lower() in ["", "true"]
+
+
+def validate_batch(data):
+    if not isinstance(data, dict):
+        return Errors(["Request body must be a JSON object"])
+    affiliations = data.get("affiliations")
+    if not isinstance(affiliations, list) or not affiliations:
+        return Errors(['"affiliations" must be a non-empty list'])
+    if len(affiliations) > MATCHING["BATCH_MAX_SIZE"]:
+        return Errors(
+            [
+                "Batch contains {} affiliations, the maximum is {}".format(
+                    len(affiliations), MATCHING["BATCH_MAX_SIZE"]
+                )
+            ]
+        )
+    try:
+        get_engine(data.get("engine"))
+    except ValueError as e:
+        return Errors([str(e)])
+    return None
+
+
+def match_batch(affiliations, single_search=False, active_only=True, engine=None):
+    """Match a list of affiliations. Identical (after canonicalization)
+    affiliations are matched once. Returns a MatchingResult or Errors object
+    for each affiliation, in input order."""
+
+    unique = list(
+        dict.fromkeys(
+            canonicalize_affiliation(a)
+            for a in affiliations
+            if isinstance(a, str) and a.strip()
+        )
+    )
+    if single_search:
+        matched = matching_single_search.match_affiliations(unique, engine)
+    else:
+        matched = matching.match_affiliations(unique, active_only, engine)
+    results = []
+    for affiliation in affiliations:
+        if not isinstance(affiliation, str) or not affiliation.strip():
+            results.append(Errors(["Affiliation must be a non-empty string"]))
+            continue
+        result = matched[canonicalize_affiliation(affiliation)]
+        if isinstance(result, Exception):
+            logger.exception(
+                "Matching affiliation %r failed", affiliation, exc_info=result
+            )
+            results.append(Errors(["Affiliation matching failed"]))
+        else:
+            results.append(MatchingResultV2(result))
+    return results
+
+
+def match_organizations_batch(data):
+    errors = validate_batch(data)
+    if errors is not None:
+        return errors, None
+    active_only = not is_true(data.get("all_status", False))
+    single_search = is_true(data.get("single_search", False))
+    return None, match_batch(
+        data["affiliations"], single_search, active_only, data.get("engine")
+    )
+
+
+def parse_lines(lines):
+    """Affiliations from NDJSON lines, either JSON strings or objects with an
+    "affiliation" field. Blank lines are skipped, invalid lines are returned
+    as Errors."""
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            yield Errors(["Line is not valid JSON"])
+            continue
+        if isinstance(value, dict):
+            value = value.get("affiliation")
+        yield value
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def match_stream(lines, single_search=False, active_only=True, engine=None):
+    """Match NDJSON affiliations lazily. Lines are read and matched in chunks
+    of STREAM_CHUNK_SIZE, which bounds both the memory used and the number of
+    ES queries in flight, and a result is yielded for every line in input
+    order."""
+
+    parsed = parse_lines(lines)
+    for chunk in chunked(parsed, MATCHING["STREAM_CHUNK_SIZE"]):
+        results = iter(
+            match_batch(
+                [a for a in chunk if not isinstance(a, Errors)],
+                single_search,
+                active_only,
+                engine,
+            )
+        )
+        for item in chunk:
+            yield item if isinstance(item, Errors) else next(results)
@@ -0,0 +1,188 @@
+import re
+
+from elasticsearch_dsl.response import Hit
+from elasticsearch_dsl.utils import AttrDict
+from functools import wraps
+
+from rorapi.common.cache import LRUCache
+from rorapi.common.matching_local import ENGINE_ES, ENGINE_LOCAL, get_engine, get_local_index
+from rorapi.settings import ES7, ES_VARS, MATCHING
+
+# Results of match_affiliation, shared by both matching strategies. Only the
+# organization IDs, scores and matching details are cached, the organizations
+# are fetched again with a single mget when a cached result is used.
+AFFILIATION_CACHE = LRUCache(
+    "affiliation",
+    MATCHING["RESULT_CACHE_SIZE"],
+    MATCHING["RESULT_CACHE_MAX_BYTES"],
+    MATCHING["RESULT_CACHE_TTL"],
+)
+
+
+# Candidates returned by the multi search matching queries, keyed by the
+# matching query (kind, fields and normalized terms). Common affiliation
+# fragments ("Department of Physics", city names) can be scored without
+# querying ES. Queries without results are cached too.
+CANDIDATE_CACHE = LRUCache(
+    "candidates",
+    MATCHING["CANDIDATE_CACHE_SIZE"],
+    MATCHING["CANDIDATE_CACHE_MAX_BYTES"],
+    MATCHING["CANDIDATE_CACHE_TTL"],
+)
+
+
+def canonicalize_affiliation(affiliation):
+    """Collapse whitespace, so that trivially different versions of the
+    affiliation string are matched (and cached) in the same way."""
+
+    return re.sub(r"\s+", " ", affiliation).strip()
+
+
+def get_key(affiliation, single_search, engine, args):
+    return (canonicalize_affiliation(affiliation), single_search, engine) + args
+
+
+def is_cached(affiliation, single_search, *args, engine=None):
+    key = get_key(affiliation, single_search, get_engine(engine), args)
+    return key in AFFILIATION_CACHE
+
+
+def get_organization_id(organization):
+    if "_source" in organization:
+        return organization["_source"]["id"]
+    return organization["id"]
+
+
+def to_compact(matched):
+    return tuple(
+        (
+            get_organization_id(m.organization),
+            m.substring,
+            m.matching_type,
+            m.score,
+            m.chosen,
+        )
+        for m in matched
+    )
+
+
+def get_organizations(ids, single_search, engine=ENGINE_ES):
+    """Fetch organizations by ROR ID in a single round trip. Organizations are
+    returned in the form used by the matching strategy: raw hits for single
+    search, search hits otherwise."""
+
+    if not ids:
+        return {}
+    if engine == ENGINE_LOCAL:
+        return get_local_index().get_organizations(ids, single_search)
+    response = ES7.mget(index=ES_VARS["INDEX_V2"], body={"ids": list(ids)})
+    wrap = AttrDict if single_search else Hit
+    return {doc["_id"]: wrap(doc) for doc in response["docs"] if doc.get("found")}
+
+
+def from_compact(compact, single_search, factory, engine=ENGINE_ES):
+    organizations = get_organizations({c[0] for c in compact}, single_search, engine)
+    return [
+        factory(
+            organization=organizations[org_id],
+            substring=substring,
+            matching_type=matching_type,
+            score=score,
+            chosen=chosen,
+        )
+        for org_id, substring, matching_type, score, chosen in compact
+        if org_id in organizations
+    ]
+
+
+def cache_matching_results(single_search, factory):
+    """Decorator caching the results of a match_affiliation function. The
+    cache key is the canonical affiliation, the strategy, the engine and the
+    remaining positional arguments (e.g. active_only). Other keyword
+    arguments only affect how the matching is executed and are not part of
+    the key. Results of a matching cut short by its deadline are not
+    cached."""
+
+    def decorator(match_affiliation):
+        @wraps(match_affiliation)
+        def wrapper(affiliation, *args, engine=None, **kwargs):
+            affiliation = canonicalize_affiliation(affiliation)
+            engine = get_engine(engine)
+            key = get_key(affiliation, single_search, engine, args)
+            compact = AFFILIATION_CACHE.get(key)
+            if compact is not None:
+                return from_compact(compact, single_search, factory, engine)
+            matched = match_affiliation(affiliation, *args, engine=engine, **kwargs)
+            deadline = kwargs.get("deadline")
+            if deadline is None or not deadline.hit:
+                AFFILIATION_CACHE.set(key, to_compact(matched))
+            return matched
+
+        return wrapper
+
+    return decorator
+
+
+class CachedCandidate(Hit):
+    """Candidate restored from the candidate cache. It contains only the
+    fields used for scoring and has to be hydrated before it is returned."""
+
+
+def cache_candidates(query, response):
+    if not CANDIDATE_CACHE.enabled:
+        return
+    CANDIDATE_CACHE.set(
+        query,
+        tuple(
+            (
+                hit.meta.id,
+                hit.meta.score,
+                hit.id,
+                hit.status,
+                hit.locations[0].geonames_details.country_code,
+                tuple((n.value, tuple(n.types)) for n in hit.names),
+            )
+            for hit in response
+        ),
+    )
+
+
+def get_cached_candidates(query):
+    compact = CANDIDATE_CACHE.get(query)
+    if compact is None:
+        return None
+    return [
+        CachedCandidate(
+            {
+                "_id": _id,
+                "_score": score,
+                "_source": {
+                    "id": org_id,
+                    "status": status,
+                    "locations": [{"geonames_details": {"country_code": country_code}}],
+                    "names": [{"value": v, "types": list(t)} for v, t in names],
+                },
+            }
+        )
+        for _id, score, org_id, status, country_code, names in compact
+    ]
+
+
+def hydrate_organizations(matched):
+    """Replace cached candidates in the matching results by the full
+    organizations, fetched in a single round trip."""
+
+    ids = {
+        m.organization.id for m in matched if isinstance(m.organization, CachedCandidate)
+    }
+    if not ids:
+        return matched
+    organizations = get_organizations(ids, single_search=False)
+    return [
+        m._replace(organization=organizations[m.organization.id])
+        if isinstance(m.organization, CachedCandidate)
+        else m
+        for m in matched
+        if not isinstance(m.organization, CachedCandidate)
+        or m.organization.id in organizations
+    ]
@@ -0,0 +1,93 @@
+from rorapi.common import matching, matching_single_search, metrics
+from rorapi.common.matching_cache import CANDIDATE_CACHE, is_cached
+from rorapi.common.matching_local import get_engine
+from rorapi.common.models import Errors
+from rorapi.settings import MATCHING
+from rorapi.v2.models import MatchingResult as MatchingResultV2
+
+STAGE_SINGLE_SEARCH = "single_search"
+STAGE_MULTI_SEARCH = "multi_search"
+
+# single search answers
+REASON_CONFIDENT = "confident"
+REASON_BUDGET = "budget"
+# multi search answers
+REASON_NO_CANDIDATE = "no_candidate"
+REASON_LOW_MARGIN = "low_margin"
+
+
+def get_margin(matched):
+    """Score difference between the chosen organization and the next best
+    one, None if no organization was chosen."""
+
+    chosen = [m.score for m in matched if m.chosen]
+    if not chosen:
+        return None
+    return chosen[0] - max([m.score for m in matched if not m.chosen] + [0])
+
+
+def count_single_search_queries(affiliation, engine):
+    return 0 if is_cached(affiliation, True, engine=engine) else 1
+
+
+def count_multi_search_queries(graph):
+    """Upper bound of the number of queries the multi search would send for
+    the matching graph: the exact match query and all the graph queries,
+    except the queries whose candidates are cached. Without a graph, the
+    multi search result is cached and no query is sent."""
+
+    if graph is None:
+        return 0
+    queries = set(matching.get_graph_queries(graph))
+    return len([q for q in queries if q not in CANDIDATE_CACHE])
+
+
+def match_affiliation(affiliation, active_only, engine=None, deadline=None):
+    """Match the affiliation with the single search, and with the multi
+    search only when the single search chose no organization or chose one
+    without a clear margin over the next one, and the multi search queries
+    fit in the query budget. The deadline applies to the multi search.
+    Both stages use their own result cache. Returns the stage that answered
+    and its matched organizations. The matching graph of the multi search
+    is built once, to count its queries and to match the affiliation."""
+
+    engine = get_engine(engine)
+    budget = MATCHING["CASCADE_QUERY_BUDGET"] - count_single_search_queries(
+        affiliation, engine
+    )
+    matched = matching_single_search.match_affiliation(affiliation, engine=engine)
+    margin = get_margin(matched)
+    if margin is not None and margin >= MATCHING["CASCADE_MIN_MARGIN"]:
+        reason = REASON_CONFIDENT
+    else:
+        graph = None
+        if not is_cached(affiliation, False, active_only, engine=engine):
+            graph = matching.get_matching_graph(affiliation, active_only)
+        if count_multi_search_queries(graph) > budget:
+            reason = REASON_BUDGET
+        else:
+            reason = REASON_NO_CANDIDATE if margin is None else REASON_LOW_MARGIN
+            metrics.MATCHING_CASCADE.labels(STAGE_MULTI_SEARCH, reason).inc()
+            return STAGE_MULTI_SEARCH, matching.match_affiliation(
+                affiliation, active_only, engine=engine, deadline=deadline, graph=graph
+            )
+    metrics.MATCHING_CASCADE.labels(STAGE_SINGLE_SEARCH, reason).inc()
+    return STAGE_SINGLE_SEARCH, matched
+
+
+def match_organizations(params):
+    if "affiliation" in params:
+        active_only = True
+        if "all_status" in params:
+            if params["all_status"] == "" or params["all_status"].lower() == "true":
+                active_only = False
+        try:
+            engine = get_engine(params.get("engine"))
+            deadline = matching.get_deadline(params)
+        except ValueError as e:
+            return Errors([str(e)]), None
+        stage, matched = match_affiliation(
+            params.get("affiliation"), active_only, engine=engine, deadline=deadline
+        )
+        return None, MatchingResultV2(matched, stage=stage, partial=deadline.hit)
+    return Errors(["'affiliation' parameter missing"]), None
@@ -0,0 +1,163 @@
+import numpy as np
+import re
+import unidecode
+
+from collections import defaultdict
+from rapidfuzz import fuzz
+
+MIN_COUNTRY_SCORE = 90
+# Upper bound of the Indel distance, relative to the summed lengths, of two
+# strings whose ratio is at least MIN_COUNTRY_SCORE (rounded ratios included),
+# with a margin for floating point errors.
+MAX_RELATIVE_DISTANCE = 0.11
+
+
+def get_bigrams(s):
+    return [s[i : i + 2] for i in range(len(s) - 1)]
+
+
+def get_max_distance(lengths1, lengths2):
+    return np.floor(MAX_RELATIVE_DISTANCE * (lengths1 + lengths2)).astype(np.int32)
+
+
+def get_min_shared_bigrams(length, max_distance):
+    # q-gram lemma: every edit destroys at most 2 of the bigrams of a string,
+    # the others are found in the string it is aligned to
+    return length - 1 - 2 * max_distance
+
+
+class BigramIndex:
+    """Bigram multiplicities of a list of names, as a dense matrix, used to
+    count the bigrams of the names found in a string for all names at
+    once."""
+
+    def __init__(self, names):
+        self.names = names
+        self.lengths = np.array([len(n) for n in names], dtype=np.int32)
+        self.vocabulary = {}
+        counts = defaultdict(int)
+        for i, name in enumerate(names):
+            for bigram in get_bigrams(name):
+                j = self.vocabulary.setdefault(bigram, len(self.vocabulary))
+                counts[i, j] += 1
+        self.matrix = np.zeros((len(names), len(self.vocabulary)), dtype=np.float32)
+        for (i, j), count in counts.items():
+            self.matrix[i, j] = count
+
+    def get_shared(self, strings):
+        """For every string and name, the number of bigram positions of the
+        name whose bigram occurs in the string."""
+
+        found = np.zeros((len(strings), len(self.vocabulary)), dtype=np.float32)
+        for i, s in enumerate(strings):
+            found[i, [self.vocabulary[b] for b in set(get_bigrams(s)) if b in self.vocabulary]] = 1
+        return found @ self.matrix.T
+
+
+class CountryDetector:
+    """Detects the countries mentioned in a string, with the results of
+    comparing every country name to the string with the fuzzy scorers, but
+    without running them on names that cannot reach the threshold.
+
+    Like the exhaustive comparison, names containing other characters than
+    lowercase letters are compared to the whole string with partial_ratio,
+    two letter names to the tokens of the string with ratio, case sensitive,
+    and other names to its lowercase tokens with ratio. Two letter names
+    only reach the threshold when equal to a token, so they are looked up.
+    The other names are only scored when they share enough bigrams with the
+    string or token to be within the maximum edit distance of a window of
+    the string or of the token."""
+
+    def __init__(self, countries, ratio, partial_ratio):
+        self.ratio = ratio
+        self.partial_ratio = partial_ratio
+        self.phrases = []
+        self.phrase_codes = []
+        self.codes = defaultdict(set)
+        words = defaultdict(set)
+        for code, name in countries:
+            if re.search("[^a-z]", name):
+                self.phrases.append(name)
+                self.phrase_codes.append(code.upper())
+            elif len(name) == 2:
+                self.codes[name.upper()].add(code.upper())
+            else:
+                words[name].add(code.upper())
+        self.phrase_index = BigramIndex(self.phrases)
+        lengths = self.phrase_index.lengths
+        # the windows of the string compared to a name are at most as long
+        self.phrase_min_shared = get_min_shared_bigrams(
+            lengths, get_max_distance(lengths, lengths)
+        )
+        self.words = list(words)
+        self.word_codes = [words[w] for w in self.words]
+        self.word_index = BigramIndex(self.words)
+
+    def get_phrase_candidates(self, lower):
+        # names longer than the string are compared with its whole length
+        longer = self.phrase_index.lengths > len(lower)
+        shared = self.phrase_index.get_shared([lower])[0]
+        candidates = np.flatnonzero(longer | (shared >= self.phrase_min_shared))
+        # rapidfuzz finds the best alignment of the name, which scores at
+        # least as high as the one found by any partial_ratio
+        return [
+            i
+            for i in candidates
+            if fuzz.partial_ratio(
+                self.phrases[i], lower, score_cutoff=MIN_COUNTRY_SCORE - 1
+            )
+        ]
+
+    def get_word_candidates(self, tokens):
+        """Pairs of token and name indices within the maximum distance."""
+
+        lengths = self.word_index.lengths[np.newaxis, :]
+        token_lengths = np.array([len(t) for t in tokens], dtype=np.int32)[:, np.newaxis]
+        max_distance = get_max_distance(lengths, token_lengths)
+        shared = self.word_index.get_shared(tokens)
+        # the Indel distance is at least the difference of the lengths
+        return zip(
+            *np.nonzero(
+                (np.abs(lengths - token_lengths) <= max_distance)
+                & (shared >= get_min_shared_bigrams(lengths, max_distance))
+            )
+        )
+
+    def get_country_codes(self, string):
+        string = unidecode.unidecode(string).strip()
+        lower = re.sub(r"\s+", " ", string.lower())
+        lower_alpha = re.sub(r"\s+", " ", re.sub("[^a-z]", " ", string.lower()))
+        alpha = re.sub(r"\s+", " ", re.sub("[^a-zA-Z]", " ", string))
+        codes = set()
+        for i in self.get_phrase_candidates(lower):
+            if self.partial_ratio(self.phrases[i], lower) >= MIN_COUNTRY_SCORE:
+                codes.add(self.phrase_codes[i])
+        for token in set(alpha.split()):
+            codes.update(self.codes.get(token, ()))
+        tokens = list(set(lower_alpha.split()))
+        for t, i in self.get_word_candidates(tokens):
+            if self.ratio(self.words[i], tokens[t]) >= MIN_COUNTRY_SCORE:
+                codes.update(self.word_codes[i])
+        return list(codes)
+
+
+def get_country_codes_exhaustive(countries, string, ratio, partial_ratio):
+    """Country codes found by comparing every country name to the string, as
+    done before CountryDetector. Used as its reference in tests and
+    benchmarks."""
+
+    string = unidecode.unidecode(string).strip()
+    lower = re.sub(r"\s+", " ", string.lower())
+    lower_alpha = re.sub(r"\s+", " ", re.sub("[^a-z]", " ", string.lower()))
+    alpha = re.sub(r"\s+", " ", re.sub("[^a-zA-Z]", " ", string))
+    codes = []
+    for code, name in countries:
+        if re.search("[^a-z]", name):
+            score = partial_ratio(name, lower)
+        elif len(name) == 2:
+            score = max([ratio(name.upper(), t) for t in alpha.split()] + [0])
+        else:
+            score = max([ratio(name, t) for t in lower_alpha.split()] + [0])
+        if score >= MIN_COUNTRY_SCORE:
+            codes.append(code.upper())
+    return list(set(codes))
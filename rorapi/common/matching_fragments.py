@@ -0,0 +1,124 @@
+import re
+import unidecode
+
+from rorapi.common.matching_gazetteer import get_gazetteer
+
+# Classes of the parts of an affiliation
+FRAGMENT_ORGANIZATION = "organization"
+FRAGMENT_DEPARTMENT = "department"
+FRAGMENT_ADDRESS = "address"
+FRAGMENT_OTHER = "other"
+
+# Words found in organization names (matched on the lowercased ASCII part)
+ORGANIZATION_RE = re.compile(
+    r"\b(?:"
+    r"univ\w*|institu\w*|hospi\w*|colleg\w*|colegio|school|ecole|escuela|scuola"
+    r"|academ\w*|akadem\w*|laborator\w*|labs?|cent(?:er|re|ro)s?|zentrum"
+    r"|klinik\w*|clinic\w*|foundation|fondation|fundacion|council|ministry"
+    r"|ministerio|agency|society|museum|library|observator\w*|corporation"
+    r"|company|inc|ltd|gmbh|llc|plc|co|association|organi[sz]ation|bureau"
+    r"|office|services?|survey|trust|authority|hochschule|politecnico"
+    r"|polytechnic|cnrs|inserm|umr|national|research|facult\w*"
+    r")\b"
+)
+DEPARTMENT_RE = re.compile(
+    r"^(?:department|dept|departamento|departement|dipartimento|abteilung)\b"
+)
+# Government departments are organizations, not departments of another
+# organization of the affiliation
+GOVERNMENT_DEPARTMENT_RE = re.compile(
+    r"^(?:department|dept) of (?:the )?(?:"
+    r"energy|defen[cs]e|veterans affairs|homeland security|state|justice"
+    r"|interior|treasury|commerce|labou?r|transportation|agriculture"
+    r"|health and human services|housing and urban development|education"
+    r"|foreign affairs|environment|conservation|primary industries"
+    r")\b"
+)
+# Words found in the names of the organizations departments belong to;
+# a department is only left out when another part names one of them
+PARENT_ORGANIZATION_RE = re.compile(
+    r"\b(?:"
+    r"univ\w*|institu\w*|hospi\w*|colleg\w*|colegio|school|ecole|escuela|scuola"
+    r"|academ\w*|akadem\w*|laborator\w*|cent(?:er|re|ro)s?|zentrum|klinik\w*"
+    r"|clinic\w*|hochschule|politecnico|polytechnic|facult\w*"
+    r")\b"
+)
+STREET_RE = re.compile(
+    r"\b(?:street|road|rd|avenue|ave|boulevard|blvd|lane|parkway|highway"
+    r"|strasse|str|rue|calle|avenida|box|postfach|floor|suite|room)\b"
+)
+# Longest address-like part, in tokens
+MAX_STREET_TOKENS = 6
+CONTACT_RE = re.compile(r"\S+@\S+|\bhttps?://\S+|\bwww\.\S+", re.IGNORECASE)
+# Postal codes: numbers of at least 3 digits (possibly with dashes or a
+# space) and UK postcodes
+POSTAL_CODE_RE = re.compile(
+    r"\b(?:\d[\d\-]*\d[\d\-]*\d|\d{3} \d{3}|[A-Z]{1,2}\d[A-Z\d]? ?\d[A-Z]{2})\b"
+)
+TOKEN_RE = re.compile(r"[^\s,.;:()]+")
+
+
+def is_street_address(lower):
+    tokens = TOKEN_RE.findall(lower)
+    if not tokens or len(tokens) > MAX_STREET_TOKENS or not STREET_RE.search(lower):
+        return False
+    # the street type or the number comes first or last
+    return any(
+        STREET_RE.match(t) or re.search(r"\d", t) for t in [tokens[0], tokens[-1]]
+    )
+
+
+def is_place(s):
+    """Whether what remains of a part without its postal codes and contact
+    details is only a place: nothing, a state code, a country or a city."""
+
+    s = " ".join(TOKEN_RE.findall(s))
+    if not s or (len(s) <= 2 and s.isupper()):
+        return True
+    gazetteer = get_gazetteer()
+    return gazetteer.is_country(s) or gazetteer.is_city(s)
+
+
+def normalize_part(part):
+    return unidecode.unidecode(CONTACT_RE.sub(" ", part)).lower().strip()
+
+
+def classify_part(part):
+    """Class of an affiliation part, from its token patterns: contact
+    details, street addresses and postal codes with a place are
+    address-like, parts starting like a department name are departments
+    (except government departments) and parts containing a word found in
+    organization names are organization-like."""
+
+    without_contact = CONTACT_RE.sub(" ", part)
+    lower = normalize_part(part)
+    organization = (
+        ORGANIZATION_RE.search(lower) is not None
+        or GOVERNMENT_DEPARTMENT_RE.search(lower) is not None
+    )
+    if DEPARTMENT_RE.search(lower) and not organization:
+        return FRAGMENT_DEPARTMENT
+    if organization:
+        return FRAGMENT_ORGANIZATION
+    if is_street_address(lower):
+        return FRAGMENT_ADDRESS
+    without_postal_code = POSTAL_CODE_RE.sub(" ", without_contact)
+    if without_postal_code != part and is_place(without_postal_code):
+        return FRAGMENT_ADDRESS
+    return FRAGMENT_OTHER
+
+
+def get_searched_parts(parts):
+    """The parts of an affiliation worth searching: address-like parts are
+    never searched, departments only when no other part names an
+    organization departments belong to (a university, an institute...), as
+    they would not be the chosen match."""
+
+    classes = [classify_part(p) for p in parts]
+    skipped = {FRAGMENT_ADDRESS}
+    if any(
+        c == FRAGMENT_ORGANIZATION and PARENT_ORGANIZATION_RE.search(normalize_part(p))
+        for p, c in zip(parts, classes)
+    ):
+        skipped.add(FRAGMENT_DEPARTMENT)
+    return [p for p, c in zip(parts, classes) if c not in skipped]
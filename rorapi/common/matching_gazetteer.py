@@ -0,0 +1,56 @@
+import geonamescache
+import sys
+
+from threading import Lock
+
+
+def get_lower_names(entries, field):
+    return frozenset(sys.intern(e[field].lower()) for e in entries)
+
+
+class Gazetteer:
+    """Lowercased geonames country names, ISO and ISO3 codes and city names,
+    kept as frozen sets of interned strings for constant time lookups. The
+    geonames records they come from are not retained."""
+
+    def __init__(self, countries, cities):
+        countries = list(countries)
+        self.country_names = get_lower_names(countries, "name")
+        self.iso = get_lower_names(countries, "iso")
+        self.iso3 = get_lower_names(countries, "iso3")
+        self.cities = get_lower_names(cities, "name")
+
+    def is_country(self, s):
+        s = s.lower()
+        return s in self.country_names or s in self.iso or s in self.iso3
+
+    def is_city(self, s):
+        return s.lower() in self.cities
+
+    def is_iso3(self, s):
+        return s.lower() in self.iso3
+
+    def get_memory_size(self):
+        """Approximate size in bytes of the sets and their strings."""
+
+        sets = [self.country_names, self.iso, self.iso3, self.cities]
+        strings = set().union(*sets)
+        return sum(sys.getsizeof(s) for s in sets) + sum(
+            sys.getsizeof(s) for s in strings
+        )
+
+
+GAZETTEER = {"gazetteer": None}
+GAZETTEER_LOCK = Lock()
+
+
+def get_gazetteer():
+    """The gazetteer, built from geonamescache on first use."""
+
+    with GAZETTEER_LOCK:
+        if GAZETTEER["gazetteer"] is None:
+            gc = geonamescache.GeonamesCache()
+            GAZETTEER["gazetteer"] = Gazetteer(
+                gc.get_countries().values(), gc.get_cities().values()
+            )
+        return GAZETTEER["gazetteer"]
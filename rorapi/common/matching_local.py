@@ -0,0 +1,369 @@
+import json
+import logging
+import math
+import numpy as np
+import re
+import unicodedata
+
+from collections import defaultdict
+from elasticsearch_dsl.response import Hit
+from elasticsearch_dsl.utils import AttrDict
+from rapidfuzz import process
+from rapidfuzz.distance import OSA
+from threading import Lock
+
+from rorapi.common.es_utils import COUNTRY_CODE_FIELD
+from rorapi.common.index_utils import add_index_fields, get_nested_ids_v2, \
+    get_nested_names_v2, get_single_search_names_v2, read_dump
+from rorapi.settings import MATCHING
+
+logger = logging.getLogger(__name__)
+
+# Affiliation matching engines. "es" sends the matching queries to
+# Elasticsearch, "local" runs them against an in-process index built from the
+# ROR dump (MATCHING_LOCAL_DUMP).
+ENGINE_ES = "es"
+ENGINE_LOCAL = "local"
+ENGINES = [ENGINE_ES, ENGINE_LOCAL]
+
+# ES defaults reproduced by the local engine
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_SIZE = 10
+COMMON_CUTOFF_FREQUENCY = 0.001
+FUZZY_MAX_EXPANSIONS = 50
+
+# Standard tokenizer approximation: CJK ideographs and kana are single
+# tokens, everything else is split on non-alphanumeric characters.
+TOKEN_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]|[^\W_]+(?:['\u2019][^\W_]+)*"
+)
+
+
+def get_engine(engine=None):
+    """The matching engine requested, or the one configured for the
+    deployment. Raises ValueError for unknown engines, and for the local
+    engine when its index was not loaded."""
+
+    engine = engine or MATCHING["ENGINE"]
+    if engine not in ENGINES:
+        raise ValueError(
+            "Unknown matching engine {}, expected one of: {}".format(
+                engine, ", ".join(ENGINES)
+            )
+        )
+    if engine == ENGINE_LOCAL and LOCAL_INDEX["index"] is None:
+        raise ValueError("Matching engine {} is not available".format(engine))
+    return engine
+
+
+def fold(token):
+    return "".join(
+        c
+        for c in unicodedata.normalize("NFKD", token)
+        if not unicodedata.combining(c)
+    )
+
+
+def analyze(text):
+    """Tokens of the text, as produced by the string_lowercase analyzer
+    (standard tokenizer, lowercase, asciifolding). Only the folded form of
+    a token is kept, which matches the same documents as the original."""
+
+    return tuple(t for t in map(fold, TOKEN_RE.findall(text.lower())) if t)
+
+
+def get_fuzziness(token):
+    # fuzziness AUTO
+    if len(token) <= 2:
+        return 0
+    if len(token) <= 5:
+        return 1
+    return 2
+
+
+class InvertedIndex:
+    """Inverted index of a text field, scored with BM25 like ES.
+
+    Every entry belongs to an organization and has one or more values (the
+    values of a multi-valued field, or a single value for nested documents).
+    A posting holds the entries containing a token and their BM25 term
+    weight, so that a query only multiplies the weights by the idf and sums
+    them into a dense score array."""
+
+    def __init__(self, entries):
+        postings = defaultdict(dict)
+        entry_orgs = []
+        entry_lengths = []
+        self.entry_values = []
+        for org, values in entries:
+            entry = len(entry_orgs)
+            entry_orgs.append(org)
+            self.entry_values.append(values)
+            for tokens in values:
+                for token in tokens:
+                    tfs = postings[token]
+                    tfs[entry] = tfs.get(entry, 0) + 1
+            entry_lengths.append(sum(len(tokens) for tokens in values))
+        self.entry_orgs = np.array(entry_orgs, dtype=np.uint32)
+        self.count = len(entry_orgs)
+        lengths = np.array(entry_lengths, dtype=np.float32)
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1))
+        self.postings = {}
+        self.vocabulary = defaultdict(list)
+        for token, tfs in postings.items():
+            posting_entries = np.array(sorted(tfs), dtype=np.uint32)
+            tf = np.array([tfs[e] for e in posting_entries], dtype=np.float32)
+            weights = tf * (BM25_K1 + 1) / (tf + norms[posting_entries])
+            self.postings[token] = (posting_entries, weights.astype(np.float32))
+            self.vocabulary[len(token)].append(token)
+
+    def df(self, token):
+        posting = self.postings.get(token)
+        return len(posting[0]) if posting else 0
+
+    def idf(self, df):
+        return math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+
+    def new_scores(self):
+        return np.zeros(self.count, dtype=np.float32)
+
+    def add_scores(self, scores, token, boost=1.0, df=None, mask=None):
+        posting = self.postings.get(token)
+        if not posting:
+            return
+        entries, weights = posting
+        idf = self.idf(df if df is not None else len(entries)) * boost
+        if mask is None:
+            scores[entries] += idf * weights
+        else:
+            scores[entries] += idf * weights * mask[entries]
+
+    def expand(self, token):
+        """Terms within the AUTO edit distance of the token, with their
+        similarity boost."""
+
+        distance = get_fuzziness(token)
+        if distance == 0:
+            return [(token, 1.0)] if token in self.postings else []
+        candidates = [
+            t
+            for length in range(len(token) - distance, len(token) + distance + 1)
+            for t in self.vocabulary.get(length, [])
+        ]
+        expanded = process.extract(
+            token,
+            candidates,
+            scorer=OSA.distance,
+            score_cutoff=distance,
+            limit=FUZZY_MAX_EXPANSIONS,
+        )
+        return [(t, 1 - d / min(len(t), len(token))) for t, d, _ in expanded]
+
+    def match(self, tokens):
+        scores = self.new_scores()
+        for token in tokens:
+            self.add_scores(scores, token)
+        return scores
+
+    def match_fuzzy(self, tokens):
+        scores = self.new_scores()
+        for token in tokens:
+            expanded = self.expand(token)
+            # blended frequencies, all expansions score with the highest df
+            df = max([self.df(t) for t, _ in expanded], default=0)
+            for term, boost in expanded:
+                self.add_scores(scores, term, boost, df)
+        return scores
+
+    def match_common(self, tokens):
+        """Common terms query: entries have to contain one of the low
+        frequency tokens, high frequency tokens only add to the score."""
+
+        cutoff = COMMON_CUTOFF_FREQUENCY * self.count
+        low = [t for t in tokens if self.df(t) <= cutoff]
+        if not low:
+            return self.match(tokens)
+        scores = self.match(low)
+        mask = scores > 0
+        for token in tokens:
+            if token not in low:
+                self.add_scores(scores, token, mask=mask)
+        return scores
+
+    def match_phrase(self, tokens):
+        scores = self.new_scores()
+        postings = [self.postings.get(token) for token in tokens]
+        if not tokens or not all(postings):
+            return scores
+        entries = postings[0][0]
+        for posting in postings[1:]:
+            entries = np.intersect1d(entries, posting[0], assume_unique=True)
+        n = len(tokens)
+        mask = np.zeros(self.count, dtype=bool)
+        for e in entries:
+            mask[e] = any(
+                values[i : i + n] == tokens
+                for values in self.entry_values[e]
+                for i in range(len(values) - n + 1)
+            )
+        for token in tokens:
+            self.add_scores(scores, token, mask=mask)
+        return scores
+
+    def top(self, scores, size, orgs_mask=None):
+        """Best organizations, scored by their best entry. Ties are broken
+        by index order, like ES. orgs_mask selects the organizations
+        returned, like ES filters."""
+
+        entries = np.flatnonzero(scores)
+        if orgs_mask is not None:
+            entries = entries[orgs_mask[self.entry_orgs[entries]]]
+        orgs = self.entry_orgs[entries]
+        order = np.lexsort((orgs, -scores[entries]))
+        orgs = orgs[order]
+        _, first = np.unique(orgs, return_index=True)
+        first = np.sort(first)[:size]
+        return [(int(orgs[i]), float(scores[entries[order[i]]])) for i in first]
+
+
+class LocalIndex:
+    """In-process equivalent of the organizations index, for the fields used
+    by affiliation matching. Documents are kept as compact JSON and decoded
+    only when they are returned."""
+
+    def __init__(self, organizations):
+        self.ids = []
+        self.documents = []
+        names = []
+        names_ids = []
+        self.ids_keywords = {}
+        affiliation_names = []
+        # organizations by value of the fields used in query filters
+        self.filter_fields = defaultdict(lambda: defaultdict(list))
+        for i, org in enumerate(organizations):
+            org = add_index_fields(dict(org))
+            self.ids.append(org["id"])
+            self.documents.append(json.dumps(org).encode("utf-8"))
+            names.append((i, tuple(analyze(n) for n in get_nested_names_v2(org))))
+            names_ids.extend((i, (analyze(n),)) for n in get_nested_names_v2(org))
+            for n in get_nested_ids_v2(org):
+                self.ids_keywords.setdefault(n, []).append(i)
+            affiliation_names.extend(
+                (i, (analyze(n),)) for n in get_single_search_names_v2(org)
+            )
+            self.filter_fields["status"][org["status"]].append(i)
+            for location in org["locations"]:
+                self.filter_fields[COUNTRY_CODE_FIELD][
+                    location["geonames_details"]["country_code"]
+                ].append(i)
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self.names = InvertedIndex(names)
+        self.names_ids = InvertedIndex(names_ids)
+        self.affiliation_names = InvertedIndex(affiliation_names)
+
+    def get_organizations(self, ids, single_search):
+        """Organizations by ROR ID, in the form used by the matching
+        strategy: raw hits for single search, search hits otherwise."""
+
+        hits = {
+            id: self.get_hit(self.positions[id], None)
+            for id in ids
+            if id in self.positions
+        }
+        wrap = AttrDict if single_search else Hit
+        return {id: wrap(hit) for id, hit in hits.items()}
+
+    def get_filter_mask(self, filters):
+        """Organizations with one of the values of each filtered field, None
+        without filters."""
+
+        if not filters:
+            return None
+        mask = np.ones(len(self.ids), dtype=bool)
+        for field, values in filters:
+            field_mask = np.zeros(len(self.ids), dtype=bool)
+            for value in values:
+                field_mask[self.filter_fields[field].get(value, [])] = True
+            mask &= field_mask
+        return mask
+
+    def get_hit(self, org, score):
+        return {
+            "_index": "local",
+            "_id": self.ids[org],
+            "_score": score,
+            "_source": json.loads(self.documents[org]),
+        }
+
+    def get_hits(self, top):
+        return [Hit(self.get_hit(org, score)) for org, score in top]
+
+    def search_names(self, kind, terms, size=DEFAULT_SIZE, filters=()):
+        tokens = analyze(terms)
+        if kind == "phrase":
+            scores = self.names.match_phrase(tokens)
+        elif kind == "common":
+            scores = self.names.match_common(tokens)
+        elif kind == "fuzzy":
+            scores = self.names.match_fuzzy(tokens)
+        else:
+            scores = self.names.match(tokens)
+        return self.get_hits(
+            self.names.top(scores, size, self.get_filter_mask(filters))
+        )
+
+    def search_names_ids(self, phrase, size=DEFAULT_SIZE, filters=()):
+        """Phrase query over the nested names and IDs, as the query_string
+        query used by exact matching."""
+
+        scores = self.names_ids.match_phrase(analyze(phrase))
+        mask = self.get_filter_mask(filters)
+        top = self.names_ids.top(scores, size, mask)
+        # IDs are keywords and only match the whole phrase
+        found = {org for org, _ in top}
+        top += [
+            (org, 1.0)
+            for org in self.ids_keywords.get(phrase, [])
+            if org not in found and (mask is None or mask[org])
+        ]
+        return self.get_hits(sorted(top, key=lambda x: -x[1])[:size])
+
+    def search_affiliation(self, terms, size, filters=()):
+        """Nested match query over the single search names, with the raw
+        hits returned in the shape of an ES response."""
+
+        index = self.affiliation_names
+        top = index.top(index.match(analyze(terms)), size, self.get_filter_mask(filters))
+        return AttrDict({"hits": {"hits": [self.get_hit(org, score) for org, score in top]}})
+
+
+LOCAL_INDEX = {"index": None}
+LOCAL_INDEX_LOCK = Lock()
+
+
+def load_local_index():
+    """Build the local index from MATCHING_LOCAL_DUMP, if it is set. It is
+    built when the application starts, never by a request; the local engine
+    is not available if the dump cannot be read."""
+
+    if not MATCHING["LOCAL_DUMP"]:
+        return None
+    with LOCAL_INDEX_LOCK:
+        if LOCAL_INDEX["index"] is None:
+            try:
+                LOCAL_INDEX["index"] = LocalIndex(read_dump(MATCHING["LOCAL_DUMP"]))
+            except Exception:
+                logger.exception(
+                    "Local index not built from %s", MATCHING["LOCAL_DUMP"]
+                )
+        return LOCAL_INDEX["index"]
+
+
+def get_local_index():
+    """The local index. Raises ValueError if it was not loaded."""
+
+    index = LOCAL_INDEX["index"]
+    if index is None:
+        raise ValueError("The local index is not loaded")
+    return index
@@ -0,0 +1,145 @@
+import re
+import unicodedata
+import unidecode
+
+from functools import lru_cache
+from fuzzywuzzy import fuzz
+
+# Version of the name forms precomputed for affiliation matching and stored
+# in the affiliation_match index documents. Bump it whenever normalize() or
+# the stored forms change: documents indexed with another version are scored
+# with forms computed at query time until the index is rebuilt.
+NAMES_VERSION = 1
+
+NORMALIZE_CACHE_SIZE = 65536
+
+WHITESPACE_RE = re.compile(r"\s+")
+# All the abbreviation and ampersand substitutions of normalize() in a single
+# pass. At any position the alternatives are tried in the order the
+# substitutions used to be applied, and none of the replacements can be
+# matched by a later substitution, so the output is identical to applying
+# them one after the other.
+ABBREVIATIONS_RE = re.compile(
+    r"(?<![a-z])(?:"
+    r"u(?:\.(?! ?[a-z]\.)|niv(?:[\. ]|$)|\. ?s\.)"
+    r"|lab(?:[^a-z]|$)"
+    r"|inst(?:[^a-z]|$)"
+    r"|tech(?:[^a-z]|$)"
+    r")|&(?:amp;)?"
+)
+ABBREVIATIONS = {
+    "u.": "university",
+    "un": "university",
+    "la": "laboratory",
+    "in": "institute",
+    "te": "technology",
+}
+
+
+def expand_abbreviation(match):
+    abbreviation = match.group()
+    if abbreviation[0] == "&":
+        return " and "
+    if abbreviation[:2] == "u." and len(abbreviation) > 2:
+        return "united states"
+    # abbreviations at the end of the string end with a letter, the others
+    # with the separator replaced by a space
+    if "a" <= abbreviation[-1] <= "z":
+        return ABBREVIATIONS[abbreviation[:2]]
+    return ABBREVIATIONS[abbreviation[:2]] + " "
+
+
+@lru_cache(maxsize=None)
+def is_latin_char(ch):
+    return not ch.isalpha() or "LATIN" in unicodedata.name(ch)
+
+
+def check_latin_chars(s):
+    # ASCII letters are all latin
+    return s.isascii() or all(map(is_latin_char, s))
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize(s):
+    """Normalize string for matching."""
+
+    if check_latin_chars(s):
+        s = WHITESPACE_RE.sub(" ", unidecode.unidecode(s).strip().lower())
+    else:
+        s = WHITESPACE_RE.sub(" ", s.strip().lower())
+    s = ABBREVIATIONS_RE.sub(expand_abbreviation, s)
+    if s.startswith("the "):
+        s = s[4:]
+    return WHITESPACE_RE.sub(" ", s.strip().lower())
+
+
+def normalize_reference(s):
+    """Sequential implementation of normalize(), kept as the reference the
+    compiled one is tested and benchmarked against."""
+
+    if all(
+        "LATIN" in unicodedata.name(ch) for ch in s if ch.isalpha()
+    ):
+        s = re.sub(r"\s+", " ", unidecode.unidecode(s).strip().lower())
+    else:
+        s = re.sub(r"\s+", " ", s.strip().lower())
+    s = re.sub(
+        "(?<![a-z])univ$",
+        "university",
+        re.sub(
+            r"(?<![a-z])univ[\. ]",
+            "university ",
+            re.sub(r"(?<![a-z])u\.(?! ?[a-z]\.)", "university ", s),
+        ),
+    )
+    s = re.sub(
+        "(?<![a-z])lab$", "laboratory", re.sub("(?<![a-z])lab[^a-z]", "laboratory ", s)
+    )
+    s = re.sub(
+        "(?<![a-z])inst$", "institute", re.sub("(?<![a-z])inst[^a-z]", "institute ", s)
+    )
+    s = re.sub(
+        "(?<![a-z])tech$",
+        "technology",
+        re.sub("(?<![a-z])tech[^a-z]", "technology ", s),
+    )
+    s = re.sub(r"(?<![a-z])u\. ?s\.", "united states", s)
+    s = re.sub("&", " and ", re.sub("&amp;", " and ", s))
+    s = re.sub("^the ", "", s)
+    s = re.sub(r"\s+", " ", s.strip().lower())
+    return s
+
+
+@lru_cache(maxsize=100000)
+def get_name_forms(name):
+    """Forms of an organization name used by the matching scorers:
+    normalized (single search), normalized without the parenthesized part and
+    its token sorted form (multi search), and the flags checked before
+    scoring."""
+
+    normalized = normalize(name)
+    stripped = re.sub(r"\(.*\)", "", normalized).strip()
+    return {
+        "normalized": normalized,
+        "stripped": stripped,
+        "sorted": fuzz._process_and_sort(stripped, force_ascii=True),
+        "has_space": " " in name,
+        "length": len(name),
+    }
+
+
+def get_matching_names(names):
+    """Names of the affiliation_match document, with their precomputed
+    forms."""
+
+    return [dict({"name": name}, **get_name_forms(name)) for name in names]
+
+
+def has_name_forms(affiliation_match):
+    """Whether the names of an indexed affiliation_match document carry the
+    precomputed forms of the current version."""
+
+    try:
+        return affiliation_match["names_version"] == NAMES_VERSION
+    except (KeyError, TypeError):
+        return False
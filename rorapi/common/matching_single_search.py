@@ -1,24 +1,36 @@
 import os
-import re
-import unicodedata
-import unidecode
 import json
+import numpy as np
 
 from rorapi.common.models import Errors
-from rorapi.settings import ES7
-from rorapi.common.es_utils import ESQueryBuilder
+from rorapi.settings import ES7, ES_VARS, MATCHING
+from rorapi.common.es_utils import ESQueryBuilder, PUSHDOWN_BOOST, \
+    PUSHDOWN_FILTER
+from rorapi.common.matching_cache import cache_matching_results, \
+    canonicalize_affiliation, get_organizations, is_cached
+from rorapi.common.matching_countries import CountryDetector
+from rorapi.common.matching_local import ENGINE_ES, ENGINE_LOCAL, get_engine, \
+    get_local_index
+from rorapi.common.matching_names import get_name_forms, has_name_forms, \
+    normalize
 from rorapi.v2.models import MatchingResult as MatchingResultV2
 
 from collections import namedtuple
+from elasticsearch_dsl import MultiSearch
 from functools import lru_cache
 from rapidfuzz import fuzz
+from rapidfuzz.process import cdist
 from itertools import groupby
 
 MIN_SCORE = 96
 MIN_SCORE_FOR_RETURN = 50
+MAX_CANDIDATES = 200
 
 MATCHING_TYPE_SINGLE = "SINGLE SEARCH"
 
+# only active candidates are scored
+ACTIVE_FILTER = (("status", ("active",)),)
+
 # Matching strategy from Marple:
 # https://gitlab.com/crossref/labs/marple/-/blob/main/strategies_available/affiliation_single_search/strategy.py?ref_type=heads
 
@@ -52,22 +64,11 @@ def to_region(c):
     }.get(c, c)
 
 
+COUNTRY_DETECTOR = CountryDetector(GEONAMES_COUNTRIES, fuzz.ratio, fuzz.partial_ratio)
+
+
 def get_country_codes(string):
-    string = unidecode.unidecode(string).strip()
-    lower = re.sub(r"\s+", " ", string.lower())
-    lower_alpha = re.sub(r"\s+", " ", re.sub("[^a-z]", " ", string.lower()))
-    alpha = re.sub(r"\s+", " ", re.sub("[^a-zA-Z]", " ", string))
-    codes = []
-    for code, name in GEONAMES_COUNTRIES:
-        if re.search("[^a-z]", name):
-            score = fuzz.partial_ratio(name, lower)
-        elif len(name) == 2:
-            score = max([fuzz.ratio(name.upper(), t) for t in alpha.split()] + [0])
-        else:
-            score = max([fuzz.ratio(name, t) for t in lower_alpha.split()] + [0])
-        if score >= 90:
-            codes.append(code.upper())
-    return list(set(codes))
+    return COUNTRY_DETECTOR.get_country_codes(string)
 
 
 def get_countries(string):
@@ -77,142 +78,162 @@ def get_countries(string):
     return [to_region(c) for c in codes]
 
 
-def check_latin_chars(s):
-    for ch in s:
-        if ch.isalpha():
-            if "LATIN" not in unicodedata.name(ch):
-                return False
-    return True
-
-
-def normalize(s):
-    """Normalize string for matching."""
-
-    if check_latin_chars(s):
-        s = re.sub(r"\s+", " ", unidecode.unidecode(s).strip().lower())
-    else:
-        s = re.sub(r"\s+", " ", s.strip().lower())
-    s = re.sub(
-        "(?<![a-z])univ$",
-        "university",
-        re.sub(
-            r"(?<![a-z])univ[\. ]",
-            "university ",
-            re.sub(r"(?<![a-z])u\.(?! ?[a-z]\.)", "university ", s),
-        ),
-    )
-    s = re.sub(
-        "(?<![a-z])lab$",
-        "laboratory",
-        re.sub("(?<![a-z])lab[^a-z]", "laboratory ", s),
-    )
-    s = re.sub(
-        "(?<![a-z])inst$",
-        "institute",
-        re.sub("(?<![a-z])inst[^a-z]", "institute ", s),
+def get_overlaps(candidates):
+    """Matrix telling which candidates have a matched span overlapping the
+    span of a candidate of another organization."""
+
+    starts = np.array([c.start for c in candidates])
+    ends = np.array([c.end for c in candidates])
+    orgs = {}
+    ids = np.array(
+        [orgs.setdefault(c.organization["_id"], len(orgs)) for c in candidates]
     )
-    s = re.sub(
-        "(?<![a-z])tech$",
-        "technology",
-        re.sub("(?<![a-z])tech[^a-z]", "technology ", s),
+    c_start, o_start = starts[:, np.newaxis], starts[np.newaxis, :]
+    c_end, o_end = ends[:, np.newaxis], ends[np.newaxis, :]
+    overlaps = (
+        ((c_start <= o_start) & (o_start <= c_end))
+        | ((c_start <= o_end) & (o_end <= c_end))
+        | ((o_start <= c_start) & (c_start <= o_end))
+        | ((o_start <= c_end) & (c_end <= o_end))
     )
-    s = re.sub(r"(?<![a-z])u\. ?s\.", "united states", s)
-    s = re.sub("&", " and ", re.sub("&amp;", " and ", s))
-    s = re.sub("^the ", "", s)
-    s = re.sub(r"\s+", " ", s.strip().lower())
-    return s
+    return overlaps & (ids[:, np.newaxis] != ids[np.newaxis, :])
 
 
 def last_non_overlapping(candidates):
-    matched = None
-    for candidate in candidates:
-        overlap = False
-        for other in candidates:
-            if candidate.organization["_id"] == other.organization["_id"]:
-                continue
-            if (
-                candidate.start <= other.start <= candidate.end
-                or candidate.start <= other.end <= candidate.end
-                or other.start <= candidate.start <= other.end
-                or other.start <= candidate.end <= other.end
-            ):
-                overlap = True
-        if not overlap:
-            matched = candidate
-    return matched
-
-
-def is_better(aff, candidate, other):
-    score = 0
-    if "univ" in candidate.name.lower() and "univ" not in other.name.lower():
-        score += 1
-    if "univ" not in candidate.name.lower() and "univ" in other.name.lower():
-        score -= 1
-    c_diff = abs(len(candidate.name) - len(aff))
-    o_diff = abs(len(other.name) - len(aff))
-    if o_diff - c_diff > 4:
-        score += 1
-    if c_diff - o_diff > 4:
-        score -= 1
-    if candidate.start > other.end:
-        score += 1
-    if other.start > candidate.end:
-        score -= 1
-    if candidate.score > 99 and other.score < 99:
-        score += 1
-    if candidate.score < 99 and other.score > 99:
-        score -= 1
-    return score > 0
+    non_overlapping = np.flatnonzero(~get_overlaps(candidates).any(axis=1))
+    if not len(non_overlapping):
+        return None
+    return candidates[non_overlapping[-1]]
+
+
+def pairs(values):
+    values = np.array(values)
+    return values[:, np.newaxis], values[np.newaxis, :]
 
 
 def rescore(aff, candidates):
-    new_scores = []
-    for candidate in candidates:
-        ns = 0
-        for other in candidates:
-            if is_better(aff, candidate, other):
-                ns += 1
-        new_scores.append(ns)
-    return [c._replace(rescore=ns) for c, ns in zip(candidates, new_scores)]
-
-
-def score(aff, candidate):
-    best = MatchedOrganization(
-        organization=candidate,
-        name="",
-        score=0,
-        rescore=0,
-        start=-1,
-        end=-1,
-        matching_type=MATCHING_TYPE_SINGLE,
-        substring=aff,
-        chosen=False,
+    """Rescore every candidate with the number of other candidates it is
+    better than. A candidate is better than another if it wins more of these
+    comparisons than it loses: "univ" in the name, the name length being
+    closer to the affiliation length, matching later in the affiliation and
+    scoring above 99."""
+
+    c_univ, o_univ = pairs(["univ" in c.name.lower() for c in candidates])
+    c_diff, o_diff = pairs([abs(len(c.name) - len(aff)) for c in candidates])
+    c_start, o_start = pairs([c.start for c in candidates])
+    c_end, o_end = pairs([c.end for c in candidates])
+    c_score, o_score = pairs([c.score for c in candidates])
+    comparison = (
+        (c_univ & ~o_univ).astype(np.int32)
+        - (~c_univ & o_univ)
+        + (o_diff - c_diff > 4)
+        - (c_diff - o_diff > 4)
+        + (c_start > o_end)
+        - (o_start > c_end)
+        + ((c_score > 99) & (o_score < 99))
+        - ((c_score < 99) & (o_score > 99))
     )
-    for candidate_name in candidate["_source"]["affiliation_match"]["names"]:
-        if hasattr(candidate_name, "name"):
-            name = candidate_name["name"]
-            if (
-                name.lower() in ["university school", "university hospital"]
-                or len(name) >= len(aff) + 4
-                or len(name) < 5
-                or (" " not in name and aff.lower() != name.lower())
-                or (" " not in aff and aff.lower() != name.lower())
-            ):
-                continue
-            alignment = fuzz.partial_ratio_alignment(normalize(aff), normalize(name))
-            if alignment.score > best.score:
-                best = MatchedOrganization(
-                    organization=candidate,
-                    name=name,
-                    score=alignment.score,
-                    rescore=alignment.score,
-                    start=alignment.src_start,
-                    end=alignment.src_end,
-                    matching_type=MATCHING_TYPE_SINGLE,
-                    substring=aff,
-                    chosen=False,
+    new_scores = (comparison > 0).sum(axis=1)
+    return [c._replace(rescore=int(ns)) for c, ns in zip(candidates, new_scores)]
+
+
+def get_raw(candidate):
+    # the raw document, without the AttrDict wrapping of every access
+    return getattr(candidate, "_d_", candidate)
+
+
+def get_source(candidate):
+    return get_raw(candidate)["_source"]
+
+
+def get_candidate_names(candidate):
+    """Names of the candidate to score: the names matched by a lean query,
+    returned as inner hits, or all the names of the full record."""
+
+    inner_hits = get_raw(candidate).get("inner_hits")
+    if inner_hits:
+        # inner hits are sorted by score, names are scored in the order of
+        # the record, so that ties are broken the same way
+        hits = sorted(
+            inner_hits["affiliation_match.names"]["hits"]["hits"],
+            key=lambda h: h["_nested"]["offset"],
+        )
+        return [h["_source"] for h in hits]
+    return get_source(candidate)["affiliation_match"]["names"]
+
+
+def score_candidates(aff, candidates, normalized_aff=None, min_alignment_score=0):
+    """Best matching name of every candidate. The names of all candidates are
+    scored with a single partial_ratio cdist, and the alignment is only
+    computed for the best name of each candidate, if it scores at least
+    min_alignment_score (the span of the others is left at -1)."""
+
+    if normalized_aff is None:
+        normalized_aff = normalize(aff)
+    owners = []
+    names = []
+    normalized_names = []
+    for i, candidate in enumerate(candidates):
+        # indexes built before the name forms were stored fall back to
+        # computing them
+        indexed_forms = has_name_forms(get_source(candidate).get("affiliation_match"))
+        for candidate_name in get_candidate_names(candidate):
+            if "name" in candidate_name:
+                name = candidate_name["name"]
+                forms = candidate_name if indexed_forms else get_name_forms(name)
+                if (
+                    name.lower() in ["university school", "university hospital"]
+                    or forms["length"] >= len(aff) + 4
+                    or forms["length"] < 5
+                    or (not forms["has_space"] and aff.lower() != name.lower())
+                    or (" " not in aff and aff.lower() != name.lower())
+                ):
+                    continue
+                owners.append(i)
+                names.append(name)
+                normalized_names.append(forms["normalized"])
+
+    best = [None] * len(candidates)
+    best_scores = [0] * len(candidates)
+    if normalized_names:
+        scores = cdist(
+            [normalized_aff], normalized_names, scorer=fuzz.partial_ratio, dtype=np.float64
+        )[0]
+        for j, (i, name_score) in enumerate(zip(owners, scores)):
+            if name_score > best_scores[i]:
+                best_scores[i] = name_score
+                best[i] = j
+
+    scored = []
+    for candidate, j, best_score in zip(candidates, best, best_scores):
+        name, start, end = "", -1, -1
+        if j is not None:
+            name = names[j]
+            if best_score >= min_alignment_score:
+                alignment = fuzz.partial_ratio_alignment(
+                    normalized_aff, normalized_names[j]
                 )
-    return best
+                best_score = alignment.score
+                start, end = alignment.src_start, alignment.src_end
+        scored.append(
+            MatchedOrganization(
+                organization=candidate,
+                name=name,
+                score=best_score,
+                rescore=best_score,
+                start=start,
+                end=end,
+                matching_type=MATCHING_TYPE_SINGLE,
+                substring=aff,
+                chosen=False,
+            )
+        )
+    return scored
+
+
+def score(aff, candidate, normalized_aff=None):
+    return score_candidates(aff, [candidate], normalized_aff)[0]
+
 
 def choose_candidate(rescored):
 
@@ -240,16 +261,24 @@ MatchedOrganization = namedtuple(
 )
 MatchedOrganization.__new__.__defaults__ = (None, None, 0, 0, 0, 0, None, None, False)
 
-def match_by_query(text, query, countries):
-    """Match affiliation text using specific ES query."""
+def match_by_query(text, query, countries, results=None):
+    """Match affiliation text using specific ES query. The query is executed
+    unless its results are given."""
     scored_candidates = []
     scored_candidates_to_return = []
     chosen_candidate = None
     chosen_true = None
-    results = query.execute()
+    if results is None:
+        results = query.execute()
     candidates = results.hits.hits
     if candidates:
-        active_candidates = [score(text, c) for c in candidates if c["_source"]["status"] == "active"]
+        # the spans are only used to choose among the candidates scoring
+        # at least MIN_SCORE
+        active_candidates = score_candidates(
+            text,
+            [c for c in candidates if get_source(c)["status"] == "active"],
+            min_alignment_score=MIN_SCORE,
+        )
         scored_candidates_to_return = [s for s in active_candidates if s.score >= MIN_SCORE_FOR_RETURN]
         scored_candidates = [s for s in scored_candidates_to_return if s.score >= MIN_SCORE]
         #### choose candidate ####
@@ -295,20 +324,94 @@ def get_output(chosen, all_matched):
     return all_matched
 
 
-def get_candidates(aff, countries):
+def get_candidates_query(aff):
     qb = ESQueryBuilder()
-    qb.add_affiliation_query(aff, 200)
-    return match_by_query(aff, qb.get_query(), countries)
+    qb.add_affiliation_query(aff, MAX_CANDIDATES, lean=True)
+    if MATCHING["PUSHDOWN"] == PUSHDOWN_FILTER:
+        qb.add_filters(dict(ACTIVE_FILTER))
+    elif MATCHING["PUSHDOWN"] == PUSHDOWN_BOOST:
+        qb.add_boosts(dict(ACTIVE_FILTER))
+    return qb.get_query()
 
 
-def match_affiliation(affiliation):
+def hydrate(matched, engine):
+    """Replace the lean candidate hits of the matching output by the full
+    organizations, fetched in a single round trip."""
+
+    organizations = get_organizations(
+        {m.organization["_id"] for m in matched}, True, engine
+    )
+    return [
+        m._replace(organization=organizations[m.organization["_id"]])
+        for m in matched
+        if m.organization["_id"] in organizations
+    ]
+
+
+def get_candidates(aff, countries, results=None):
+    return match_by_query(aff, get_candidates_query(aff), countries, results)
+
+
+@cache_matching_results(single_search=True, factory=MatchedOrganization)
+def match_affiliation(affiliation, engine=None, results=None):
     countries = get_countries(affiliation)
-    chosen, all_matched = get_candidates(affiliation, countries)
-    return get_output(chosen, all_matched)
+    if results is None and engine == ENGINE_LOCAL:
+        filters = ACTIVE_FILTER if MATCHING["PUSHDOWN"] == PUSHDOWN_FILTER else ()
+        results = get_local_index().search_affiliation(
+            affiliation, MAX_CANDIDATES, filters
+        )
+    chosen, all_matched = get_candidates(affiliation, countries, results)
+    output = get_output(chosen, all_matched)
+    # the local engine returns full records
+    if engine == ENGINE_LOCAL:
+        return output
+    return hydrate(output, engine)
+
+
+def match_affiliations(affiliations, engine=None):
+    """Match a batch of distinct affiliations. The candidates of all
+    affiliations that are not cached are fetched in a single msearch.
+    Returns a dict mapping each affiliation to its matched organizations or
+    the exception raised while matching it."""
+
+    engine = get_engine(engine)
+    pending = list(
+        dict.fromkeys(
+            canonicalize_affiliation(a)
+            for a in affiliations
+            if not is_cached(a, True, engine=engine)
+        )
+    )
+    responses = {}
+    # the local engine has no round trips to save
+    if pending and engine == ENGINE_ES:
+        ms = MultiSearch(using=ES7, index=ES_VARS["INDEX_V2"])
+        for affiliation in pending:
+            ms = ms.add(get_candidates_query(affiliation))
+        try:
+            responses = dict(zip(pending, ms.execute()))
+        except Exception as e:
+            responses = {affiliation: e for affiliation in pending}
+    results = {}
+    for affiliation in affiliations:
+        response = responses.get(canonicalize_affiliation(affiliation))
+        try:
+            if isinstance(response, Exception):
+                raise response
+            results[affiliation] = match_affiliation(
+                affiliation, engine=engine, results=response
+            )
+        except Exception as e:
+            results[affiliation] = e
+    return results
 
 
 def match_organizations(params):
     if "affiliation" in params:
-        matched = match_affiliation(params.get("affiliation"))
+        try:
+            engine = get_engine(params.get("engine"))
+        except ValueError as e:
+            return Errors([str(e)]), None
+        matched = match_affiliation(params.get("affiliation"), engine=engine)
         return None, MatchingResultV2(matched)
     return Errors(["'affiliation' parameter missing"]), None
\ No newline at end of file
@@ -0,0 +1,38 @@
+from prometheus_client import Counter
+
+MATCHING_QUERIES_EXECUTED = Counter(
+    "rorapi_matching_queries_executed_total",
+    "ES queries sent by the affiliation matching",
+)
+MATCHING_QUERIES_SAVED = Counter(
+    "rorapi_matching_queries_saved_total",
+    "Affiliation matching queries served from the per-request query memo",
+)
+MATCHING_DEADLINE_HITS = Counter(
+    "rorapi_matching_deadline_hits_total",
+    "Affiliations whose matching was cut short by the deadline",
+)
+MATCHING_TASKS_SKIPPED = Counter(
+    "rorapi_matching_tasks_skipped_total",
+    "Matching graph (node, matching type) tasks skipped after the deadline",
+)
+
+CACHE_HITS = Counter("rorapi_cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = Counter("rorapi_cache_misses_total", "Cache misses", ["cache"])
+CACHE_STALE_HITS = Counter(
+    "rorapi_cache_stale_hits_total",
+    "Cache hits served stale while the entry is refreshed",
+    ["cache"],
+)
+CACHE_EVICTIONS = Counter(
+    "rorapi_cache_evictions_total", "Entries evicted from a full cache", ["cache"]
+)
+MATCHING_CASCADE = Counter(
+    "rorapi_matching_cascade_total",
+    "Affiliations answered by each stage of the cascade matching, and why",
+    ["stage", "reason"],
+)
+EXPORTED_ORGANIZATIONS = Counter(
+    "rorapi_exported_organizations_total",
+    "Organizations streamed by the export endpoint",
+)
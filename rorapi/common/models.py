@@ -1,4 +1,9 @@
-from geonamescache.mappers import country
+from geonamescache import GeonamesCache
+
+# Country names by ISO code, the labels of the country facet
+COUNTRY_NAMES = {
+    c["iso"]: c["name"] for c in GeonamesCache().get_countries().values()
+}
 
 
 class Entity:
@@ -22,12 +27,7 @@ class CountryBucket:
 
     def __init__(self, data):
         self.id = data.key.lower()
-        mapper = country(from_key="iso", to_key="name")
-        try:
-            self.title = mapper(data.key)
-        except AttributeError:
-            # if we have a country code with no name mapping, skip it to prevent 500
-            pass
+        self.title = COUNTRY_NAMES.get(data.key)
         self.count = data.doc_count
 
 
@@ -1,22 +1,32 @@
 import re
+import base64
+import hashlib
 import json
 from titlecase import titlecase
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from elasticsearch import NotFoundError, RequestError
+from elasticsearch_dsl.response import Response
 
 from rorapi.common.models import Errors
 from rorapi.common.matching import match_affiliation
 from rorapi.v2.models import (
     Organization as OrganizationV2,
-    ListResult as ListResultV2
+    ListResult as ListResultV2,
+    get_field_tree,
+    get_source_fields,
 )
-from rorapi.settings import GRID_REMOVED_IDS, ROR_API, ES_VARS
-from rorapi.common.es_utils import ESQueryBuilder
+from rorapi.settings import GRID_REMOVED_IDS, ROR_API, ES_VARS, SEARCH_CACHE as SEARCH_CACHE_SETTINGS
+from rorapi.common.cache import SharedCache
+from rorapi.common.es_utils import ESQueryBuilder, close_point_in_time, \
+    open_point_in_time
+from rorapi.common.facets import FACETS, get_precomputed_facets
 
 from urllib.parse import unquote
 
 ALLOWED_FILTERS_V2 = ("country.country_code", "locations.geonames_details.country_code", "types", "country.country_name", "locations.geonames_details.country_name", "status", "locations.geonames_details.continent_code", "locations.geonames_details.continent_name")
-ALLOWED_PARAM_KEYS = ("query", "page", "filter", "query.advanced", "all_status")
+ALLOWED_PARAM_KEYS = ("query", "page", "cursor", "filter", "query.advanced", "all_status", "facets", "fields")
 ALLOWED_ALL_STATUS_VALUES = ("", "true", "false")
+ALLOWED_FACETS_VALUES = ("", "true", "false")
 ALLOWED_FIELDS_V2 = (
     "admin.created.date",
     "admin.created.schema_version",
@@ -55,6 +65,16 @@ ALLOWED_FIELDS_V2 = (
 # _exists_: check if field has non-null value, ex _exists_:wikipedia_url
 ALLOWED_ENDINGS = ("_exists_", "\\", "\\*")
 
+# Search responses, keyed by search plan
+SEARCH_CACHE = SharedCache(
+    "search",
+    "search",
+    SEARCH_CACHE_SETTINGS["TTL"],
+    SEARCH_CACHE_SETTINGS["STALE_TTL"],
+    SEARCH_CACHE_SETTINGS["REFRESH_TIMEOUT"],
+    SEARCH_CACHE_SETTINGS["MAX_BYTES"],
+)
+
 
 def get_ror_id(string):
     """Extracts ROR id from a string and transforms it into canonical form"""
@@ -123,6 +143,34 @@ def filter_string_to_list(filter_string):
     return filter_list
 
 
+def get_requested_fields(fields_string):
+    """Sorted field names of the fields parameter, None if no field is
+    requested"""
+
+    if not fields_string:
+        return None
+    fields = sorted({f.strip() for f in fields_string.split(",") if f.strip()})
+    return tuple(fields) or None
+
+
+def is_allowed_field(field):
+    """Whether the field is an allowed field or one of their parents"""
+
+    return any(f == field or f.startswith(field + ".") for f in ALLOWED_FIELDS_V2)
+
+
+def validate_fields(fields_string):
+    """Validates the fields parameter. Returns an error object that can be
+    serialized into JSON or None."""
+
+    illegal_fields = [
+        f for f in get_requested_fields(fields_string) or [] if not is_allowed_field(f)
+    ]
+    if illegal_fields:
+        return Errors(["field '{}' is illegal".format(f) for f in illegal_fields])
+    return None
+
+
 def validate(params):
     """Validates API GET parameters. Returns an error object
     that can be serialized into JSON or None."""
@@ -138,6 +186,13 @@ def validate(params):
                         "allowed values for all_status parameter are empty (no value), true or false"
                     ]
                 )
+        if "facets" in params.keys():
+            if str(params.get("facets")).lower() not in ALLOWED_FACETS_VALUES:
+                errors.extend(
+                    [
+                        "allowed values for facets parameter are empty (no value), true or false"
+                    ]
+                )
         if len(params.keys()) > 1:
             if "query" in params.keys() and "query.advanced" in params.keys():
                 errors.extend(
@@ -170,6 +225,21 @@ def validate(params):
     illegal_keys = [v for v in filter_keys if v not in ALLOWED_FILTERS_V2]
     errors.extend(["filter key '{}' is illegal".format(k) for k in illegal_keys])
 
+    if "fields" in params:
+        fields_error = validate_fields(params.get("fields"))
+        if fields_error is not None:
+            errors.extend(fields_error.errors)
+
+    cursor = None
+    if "cursor" in params:
+        if "page" in params:
+            errors.append("cursor and page parameters cannot be combined")
+        elif params.get("cursor") != FIRST_CURSOR:
+            try:
+                cursor = decode_cursor(params.get("cursor"))
+            except ValueError as e:
+                errors.append(str(e))
+
     if "page" in params:
         page = params.get("page")
         try:
@@ -182,84 +252,184 @@ def validate(params):
                 )
         except ValueError:
             errors.append("page '{}' is not an integer".format(page))
+
+    if not errors and cursor is not None:
+        if cursor.fingerprint != get_plan_fingerprint(get_search_plan(params)):
+            errors.append(
+                "cursor '{}' was not issued for this query".format(params.get("cursor"))
+            )
     return Errors(errors) if errors else None
 
 
-def build_search_query(params):
-    """Builds search query from API parameters"""
+# Search request compiled from the API parameters: the kind of query
+# ("advanced", "id", "string" or "all"), its terms, the normalized filters
+# (including the default status filter) as (field, values) pairs sorted by
+# field, the page and whether facets are returned. Requests with the same
+# plan run the same ES query. When paginating with a cursor, search_after
+# holds the sort values of the last result of the previous page (empty for
+# the first page) and pit the point in time, if any. fields holds the sorted
+# names of the requested fields, None for all fields.
+SearchPlan = namedtuple(
+    "SearchPlan",
+    ["query_type", "query", "filters", "page", "facets", "search_after", "pit",
+     "fields"],
+)
+SearchPlan.__new__.__defaults__ = (True, None, None, None)
 
-    qb = ESQueryBuilder()
-    ror_id = None
+# Opaque cursor of the next page of search results: the fingerprint of the
+# query it was issued for, the sort values of the last result and the point
+# in time, if any. The first page is requested with the "*" cursor.
+Cursor = namedtuple("Cursor", ["fingerprint", "search_after", "pit"])
+FIRST_CURSOR = "*"
+
+
+def encode_cursor(cursor):
+    data = json.dumps(list(cursor), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_valid_search_after(search_after, pit):
+    # the score and the id of the last result, followed in a point in time by
+    # the implicit _shard_doc tiebreaker ES adds to the sort
+    if not isinstance(search_after, list):
+        return False
+    if pit is not None and len(search_after) == 3:
+        if not isinstance(search_after[2], int) or isinstance(search_after[2], bool):
+            return False
+        search_after = search_after[:2]
+    return (
+        len(search_after) == 2
+        and is_number(search_after[0])
+        and isinstance(search_after[1], str)
+    )
+
+
+def decode_cursor(string):
+    """Decodes a cursor, raises ValueError if it is malformed"""
+
+    try:
+        fingerprint, search_after, pit = json.loads(
+            base64.urlsafe_b64decode(string.encode("ascii")).decode("utf-8")
+        )
+        if not isinstance(fingerprint, str) or not (pit is None or isinstance(pit, str)):
+            raise ValueError
+        if not is_valid_search_after(search_after, pit):
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError("cursor '{}' is invalid".format(string))
+    return Cursor(fingerprint, tuple(search_after), pit)
+
+
+def get_plan_fingerprint(plan):
+    """Identifies the results of the plan, regardless of the page"""
+
+    key = repr((plan.query_type, plan.query, plan.filters))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
 
-    if "all_status" in params:
-        if params["all_status"].lower() == "false":
-            del params["all_status"]
 
+def normalize_filter_value(field, value):
+    """Normalize filter values based on casing conventions used in ROR
+    records."""
+
+    value = " ".join(value.split())
+    if field in ("types", "status"):
+        return value.lower()
+    if field in ("country.country_code", "locations.geonames_details.country_code"):
+        return value.upper()
+    if field in ("country.country_name", "locations.geonames_details.country_name"):
+        return titlecase(value)
+    return value
+
+
+def get_search_plan(params):
+    """Compiles valid API parameters into a search plan"""
+
+    all_status = params.get("all_status", "false").lower() != "false"
     if "query.advanced" in params:
-        qb.add_string_query_advanced(params.get("query.advanced"))
+        query_type, query = "advanced", params.get("query.advanced")
     elif "query" in params:
-        ror_id = get_ror_id(params.get("query"))
-        if ror_id is not None:
-            qb.add_id_query(ror_id)
+        query = get_ror_id(params.get("query"))
+        if query is not None:
+            query_type = "id"
         else:
-            qb.add_string_query(params.get("query"))
+            query_type, query = "string", params.get("query")
+    else:
+        query_type, query = "all", None
+
+    filters = defaultdict(set)
+    for f in filter_string_to_list(params.get("filter", "")):
+        f = f.split(":")
+        filters[f[0]].add(normalize_filter_value(f[0], f[1]))
+    if (
+        "status" not in filters
+        and not all_status
+        and query_type != "id"
+        and not (query_type == "advanced" and check_status_adv_q(query))
+    ):
+        filters["status"].add("active")
+
+    search_after, pit = None, None
+    if "cursor" in params:
+        search_after = ()
+        if params.get("cursor") != FIRST_CURSOR:
+            _, search_after, pit = decode_cursor(params.get("cursor"))
+
+    return SearchPlan(
+        query_type,
+        query,
+        tuple((k, tuple(sorted(v))) for k, v in sorted(filters.items())),
+        int(params.get("page", 1)),
+        params.get("facets", "true").lower() != "false",
+        search_after,
+        pit,
+        get_requested_fields(params.get("fields")),
+    )
+
+
+def build_plan_query(plan, aggregations=True):
+    """Builds search query from a search plan, with the aggregations of its
+    facets unless they are left out"""
+
+    qb = ESQueryBuilder()
+    if plan.query_type == "advanced":
+        qb.add_string_query_advanced(plan.query)
+    elif plan.query_type == "id":
+        qb.add_id_query(plan.query)
+    elif plan.query_type == "string":
+        qb.add_string_query(plan.query)
     else:
         qb.add_match_all_query()
 
-    if "filter" in params or (not "all_status" in params):
-        filters = [
-            f.split(":")
-            for f in filter_string_to_list(params.get("filter", ""))
-            if f
-        ]
-        # normalize filter values based on casing conventions used in ROR records
-        for f in filters:
-            f[1] = " ".join(f[1].split())
-            if f[0] == "types":
-                f[1] = f[1].lower()
-            if f[0] == "country.country_code" or f[0] == "locations.geonames_details.country_code":
-                f[1] = f[1].upper()
-            if f[0] == "country.country_name" or f[0] == "locations.geonames_details.country_name":
-                f[1] = titlecase(f[1])
-            if f[0] == "status":
-                f[1] = f[1].lower()
-        filters = [(f[0], f[1]) for f in filters]
-
-        filter_dict = {}
-        temp = defaultdict(list)
-        for k, v in filters:
-            temp[k].append(v)
-        filter_dict = dict((k, tuple(v)) for k, v in temp.items())
+    qb.add_filters({f: list(v) for f, v in plan.filters})
 
-        if (
-            (not "status" in filter_dict)
-            and (not "all_status" in params)
-            and ror_id is None
-        ):
-            status_in_adv_q = False
-            if "query.advanced" in params:
-                status_in_adv_q = check_status_adv_q(params.get("query.advanced"))
-            if not status_in_adv_q:
-                filter_dict.update({"status": ["active"]})
-        qb.add_filters(filter_dict)
-
-    qb.add_aggregations(
-        [
-            ("types", "types"),
-            ("countries", "locations.geonames_details.country_code"),
-            ("continents", "locations.geonames_details.continent_code"),
-            ("statuses", "status"),
-        ]
-    )
+    if plan.fields is not None:
+        qb.add_source(get_source_fields(get_field_tree(plan.fields)))
+
+    if plan.facets and aggregations:
+        qb.add_aggregations(FACETS)
 
-    qb.paginate(int(params.get("page", 1)))
+    if plan.search_after is not None:
+        qb.add_cursor(plan.search_after, plan.pit)
+    qb.paginate(plan.page)
     return qb.get_query()
 
 
-def build_retrieve_query(ror_id):
-    """Builds retrieval query"""
+def build_search_query(params):
+    """Builds search query from API parameters"""
+
+    return build_plan_query(get_search_plan(params))
+
+
+def build_retrieve_query(ror_id, fields=None):
+    """Builds retrieval query, fetching only what the requested fields need"""
     qb = ESQueryBuilder()
     qb.add_id_query(ror_id)
+    if fields is not None:
+        qb.add_source(get_source_fields(get_field_tree(fields)))
     return qb.get_query()
 
 
@@ -269,12 +439,63 @@ def search_organizations(params):
     error = validate(params)
     if error is not None:
         return error, None
-    search = build_search_query(params)
-    return None, ListResultV2(search.execute())
+    plan = get_search_plan(params)
+    if plan.search_after == () and ES_VARS["CURSOR_PIT"]:
+        plan = plan._replace(pit=open_point_in_time())
+    facets = None
+    if plan.facets and plan.query_type == "all":
+        facets = get_precomputed_facets(plan.filters)
+    search = build_plan_query(plan, aggregations=facets is None)
+    # the response has the aggregations or not, depending on whether the
+    # facets were precomputed
+    key = (plan, facets is None)
+    response = None
+    try:
+        # results in a point in time are not shared
+        if plan.pit is None:
+            cached = SEARCH_CACHE.get(key, lambda: search.execute().to_dict())
+            if cached is not None:
+                response = Response(search, cached)
+        if response is None:
+            response = search.execute()
+            if plan.pit is None and SEARCH_CACHE.enabled:
+                SEARCH_CACHE.set(key, response.to_dict())
+    except (RequestError, NotFoundError):
+        # sort values ES cannot resume after, or an expired point in time
+        if not plan.search_after:
+            raise
+        return (
+            Errors(["cursor '{}' is invalid or expired".format(params.get("cursor"))]),
+            None,
+        )
+    result = {
+        "facets": plan.facets,
+        "aggregations": facets,
+        "fields": get_field_tree(plan.fields),
+    }
+    if plan.search_after is not None:
+        result.update(next_cursor=get_next_cursor(plan, response), cursor=True)
+    return None, ListResultV2(response, **result)
+
+
+def get_next_cursor(plan, response):
+    """Cursor of the page following the response, None after the last page,
+    whose point in time is closed."""
+
+    hits = response.hits
+    pit = response.to_dict().get("pit_id", plan.pit)
+    if len(hits) < ES_VARS["BATCH_SIZE"]:
+        if pit is not None:
+            close_point_in_time(pit)
+        return None
+    return encode_cursor(
+        Cursor(get_plan_fingerprint(plan), list(hits[-1].meta.sort), pit)
+    )
 
 
-def retrieve_organization(ror_id):
-    """Retrieves the organization of the given ROR ID"""
+def retrieve_organization(ror_id, fields=None):
+    """Retrieves the organization of the given ROR ID, with only the
+    requested fields if any"""
     if any(ror_id in ror_id_url for ror_id_url in GRID_REMOVED_IDS):
         return (
             Errors(
@@ -288,9 +509,9 @@ def retrieve_organization(ror_id):
             ),
             None,
         )
-    search = build_retrieve_query(ror_id)
+    search = build_retrieve_query(ror_id, fields)
     results = search.execute()
     total = results.hits.total.value
     if total > 0:
-        return None, OrganizationV2(results[0])
+        return None, OrganizationV2(results[0], get_field_tree(fields))
     return Errors(["ROR ID '{}' does not exist".format(ror_id)]), None
@@ -1,6 +1,20 @@
 from rest_framework import serializers
 
 
+def restrict_fields(serializer, tree):
+    """Drop the fields of a serializer, and of its nested serializers, that
+    are not selected by the field tree."""
+
+    for name in list(serializer.fields):
+        if name not in tree:
+            serializer.fields.pop(name)
+        elif tree[name]:
+            field = serializer.fields[name]
+            field = getattr(field, "child", field)
+            if isinstance(field, serializers.Serializer):
+                restrict_fields(field, tree[name])
+
+
 class OrganizationRelationshipsSerializer(serializers.Serializer):
     label = serializers.CharField()
     type = serializers.CharField()
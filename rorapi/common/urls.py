@@ -3,7 +3,8 @@ from django.urls import path, re_path
 from rest_framework.documentation import include_docs_urls
 from  . import views
 from rorapi.common.views import (
-    HeartbeatView,GenerateAddress,GenerateId,IndexData,IndexDataDump,BulkUpdate,ClientRegistrationView,ValidateClientView)
+    HeartbeatView,GenerateAddress,GenerateId,IndexData,IndexDataDump,BulkUpdate,ClientRegistrationView,ValidateClientView,
+    AffiliationMatchingView,AffiliationMatchingStreamView,OrganizationExportView)
 
 urlpatterns = [
     # Health check
@@ -18,6 +19,12 @@ urlpatterns = [
     path('validate-client-id/<str:client_id>/', ValidateClientView.as_view()),
     url(r"^(?P<version>v2)\/indexdata/(?P<branch>.*)", IndexData.as_view()),
     url(r"^(?P<version>v2)\/indexdatadump\/(?P<filename>v(\d+\.)?(\d+\.)?(\*|\d+)-\d{4}-\d{2}-\d{2}-ror-data)\/(?P<dataenv>(test|prod))$", IndexDataDump.as_view()),
+    re_path(r"^(?P<version>v2)\/organizations\/affiliations$", AffiliationMatchingView.as_view()),
+    re_path(r"^organizations\/affiliations$", AffiliationMatchingView.as_view()),
+    re_path(r"^(?P<version>v2)\/organizations\/affiliations\/stream$", AffiliationMatchingStreamView.as_view()),
+    re_path(r"^organizations\/affiliations\/stream$", AffiliationMatchingStreamView.as_view()),
+    re_path(r"^(?P<version>v2)\/organizations\/export$", OrganizationExportView.as_view()),
+    re_path(r"^organizations\/export$", OrganizationExportView.as_view()),
     url(r"^(?P<version>v2)\/", include(views.organizations_router.urls)),
     url(r"^", include(views.organizations_router.urls)),
     url(r"^docs/", include_docs_urls(title="Research Organization Registry")),
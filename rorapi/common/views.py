@@ -1,7 +1,8 @@
 import csv
+import json
 from rest_framework import viewsets, routers, status
 from rest_framework.response import Response
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views import View
 from django.shortcuts import redirect
 from rest_framework.permissions import BasePermission
@@ -17,6 +18,11 @@ from rorapi.common.csv_utils import validate_csv
 from rorapi.settings import REST_FRAMEWORK, ES7, ES_VARS
 from rorapi.common.matching import match_organizations
 from rorapi.common.matching_single_search import match_organizations as single_search_match_organizations
+from rorapi.common.matching_cascade import match_organizations as cascade_match_organizations
+from rorapi.common.matching_batch import is_true, match_organizations_batch, match_stream
+from rorapi.common.matching_local import get_engine
+from rorapi.common.export import ExportRateThrottle, ExportStream, \
+    acquire_export_stream, get_export_plan, validate_export
 from rorapi.common.models import (
     Errors
 )
@@ -28,7 +34,8 @@ from rorapi.v2.serializers import (
     MatchingResultSerializer as MatchingResultSerializerV2,
 )
 
-from rorapi.common.queries import search_organizations, retrieve_organization, get_ror_id
+from rorapi.common.queries import search_organizations, retrieve_organization, get_ror_id, \
+    get_requested_fields, validate_fields
 from urllib.parse import urlencode
 import os
 import update_address as ua
@@ -38,7 +45,7 @@ from django.core import management
 import rorapi.management.commands.indexrordump
 from django.core.mail import EmailMultiAlternatives
 from django.utils.timezone import now
-from rorapi.v2.models import Client
+from rorapi.v2.models import Client, get_field_tree
 from rorapi.v2.serializers import ClientSerializer
 
 class ClientRegistrationView(APIView):
@@ -115,6 +122,18 @@ class ValidateClientView(APIView):
 
         return Response({'valid': client_exists}, status=status.HTTP_200_OK)
 
+def has_our_token(request):
+    """Whether the request carries our token and user name, which allows it
+    to override some limits, like the matching deadline."""
+
+    token = os.environ.get("TOKEN")
+    return (
+        token is not None
+        and request.headers.get("Token", None) == token
+        and request.headers.get("Route-User", None) == os.environ.get("ROUTE_USER")
+    )
+
+
 class OurTokenPermission(BasePermission):
     """
     Allows access only to using our token and user name.
@@ -150,8 +169,12 @@ class OrganizationViewSet(viewsets.ViewSet):
             return redirect("{}?{}".format(request.path, urlencode(params)))
         if "format" in params:
             del params["format"]
+        if "deadline" in params and not has_our_token(request):
+            del params["deadline"]
         if "affiliation" in params:
-            if "single_search" in params:
+            if "cascade" in params:
+                errors, organizations = cascade_match_organizations(params)
+            elif "single_search" in params:
                 errors, organizations = single_search_match_organizations(params)
             else:
                 errors, organizations = match_organizations(params)
@@ -162,7 +185,8 @@ class OrganizationViewSet(viewsets.ViewSet):
         if "affiliation" in params:
             serializer = MatchingResultSerializerV2(organizations)
         else:
-            serializer = ListResultSerializerV2(organizations)
+            fields = get_field_tree(get_requested_fields(params.get("fields")))
+            serializer = ListResultSerializerV2(organizations, fields=fields)
         return Response(serializer.data)
 
     def retrieve(self, request, pk=None, version=REST_FRAMEWORK["DEFAULT_VERSION"]):
@@ -172,12 +196,18 @@ class OrganizationViewSet(viewsets.ViewSet):
             return Response(
                 ErrorsSerializer(errors).data, status=status.HTTP_404_NOT_FOUND
             )
-        errors, organization = retrieve_organization(ror_id)
+        errors = validate_fields(request.GET.get("fields"))
+        if errors is not None:
+            return Response(
+                ErrorsSerializer(errors).data, status=status.HTTP_400_BAD_REQUEST
+            )
+        fields = get_requested_fields(request.GET.get("fields"))
+        errors, organization = retrieve_organization(ror_id, fields)
         if errors is not None:
             return Response(
                 ErrorsSerializer(errors).data, status=status.HTTP_404_NOT_FOUND
             )
-        serializer = OrganizationSerializerV2(organization)
+        serializer = OrganizationSerializerV2(organization, fields=get_field_tree(fields))
         return Response(serializer.data)
 
     def create(self, request, version=REST_FRAMEWORK["DEFAULT_VERSION"]):
@@ -232,6 +262,100 @@ organizations_router.register(
 )
 
 
+class AffiliationMatchingView(APIView):
+    """Match a batch of affiliations, posted as
+    {"affiliations": [...], "single_search": false, "all_status": false,
+    "engine": "es"}.
+    Returns a matching result (or errors) per affiliation, in input order."""
+
+    def post(self, request, version=REST_FRAMEWORK["DEFAULT_VERSION"]):
+        errors, results = match_organizations_batch(request.data)
+        if errors is not None:
+            return Response(
+                ErrorsSerializer(errors).data, status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(
+            [
+                ErrorsSerializer(r).data
+                if isinstance(r, Errors)
+                else MatchingResultSerializerV2(r).data
+                for r in results
+            ]
+        )
+
+
+class AffiliationMatchingStreamView(APIView):
+    """Match affiliations posted as NDJSON (one JSON string or
+    {"affiliation": ...} object per line). Results are streamed back as
+    NDJSON, one line per input line, in input order. single_search,
+    all_status and engine are passed as query parameters."""
+
+    def post(self, request, version=REST_FRAMEWORK["DEFAULT_VERSION"]):
+        params = request.GET.dict()
+        single_search = is_true(params.get("single_search", "false"))
+        active_only = not is_true(params.get("all_status", "false"))
+        engine = params.get("engine")
+        try:
+            get_engine(engine)
+        except ValueError as e:
+            return Response(
+                ErrorsSerializer(Errors([str(e)])).data,
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # read the raw request lazily, the body is never parsed as a whole
+        results = match_stream(request._request, single_search, active_only, engine)
+        return StreamingHttpResponse(
+            (
+                json.dumps(
+                    ErrorsSerializer(r).data
+                    if isinstance(r, Errors)
+                    else MatchingResultSerializerV2(r).data
+                )
+                + "\n"
+                for r in results
+            ),
+            content_type="application/x-ndjson",
+        )
+
+
+class OrganizationExportView(APIView):
+    """Export all the organizations matching the query, query.advanced,
+    filter and all_status parameters, as gzip-compressed NDJSON, one
+    organization per line. fields restricts the exported fields.
+    Exports are rate limited per client, and a client can only stream a
+    few exports at the same time."""
+
+    def get(self, request, version=REST_FRAMEWORK["DEFAULT_VERSION"]):
+        params = request.GET.dict()
+        if "format" in params:
+            del params["format"]
+        errors = validate_export(params)
+        if errors is not None:
+            return Response(
+                ErrorsSerializer(errors).data, status=status.HTTP_400_BAD_REQUEST
+            )
+        ident = None
+        if not has_our_token(request):
+            # throttled once validated, so that invalid requests do not
+            # count as exports
+            throttle = ExportRateThrottle()
+            if not throttle.allow_request(request, self):
+                self.throttled(request, throttle.wait())
+            ident = throttle.get_ident(request)
+            if not acquire_export_stream(ident):
+                errors = Errors(["too many exports in progress, retry later"])
+                return Response(
+                    ErrorsSerializer(errors).data,
+                    status=status.HTTP_429_TOO_MANY_REQUESTS,
+                )
+        response = StreamingHttpResponse(
+            ExportStream(get_export_plan(params), ident),
+            content_type="application/gzip",
+        )
+        response["Content-Disposition"] = 'attachment; filename="ror-organizations.ndjson.gz"'
+        return response
+
+
 class HeartbeatView(View):
     def get(self, request, version=REST_FRAMEWORK["DEFAULT_VERSION"]):
         try:
@@ -0,0 +1,357 @@
+import geonamescache
+import json
+import os
+import random
+import re
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from elasticsearch_dsl.utils import AttrDict
+from fuzzywuzzy import fuzz as fuzzywuzzy_fuzz
+from rapidfuzz import fuzz as rapidfuzz_fuzz
+
+from rorapi.common import matching, matching_single_search
+from rorapi.common.es_utils import PUSHDOWN_MODES
+from rorapi.common.matching_cache import AFFILIATION_CACHE, CANDIDATE_CACHE
+from rorapi.common.matching_countries import get_country_codes_exhaustive
+from rorapi.common.matching_gazetteer import Gazetteer
+from rorapi.common.matching_local import ENGINE_LOCAL, ENGINES, get_engine, \
+    load_local_index
+from rorapi.common.matching_names import normalize, normalize_reference
+from rorapi.settings import MATCHING
+
+DATASETS_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "tests", "tests_affiliations", "data"
+)
+DATASETS = {
+    "springer": "dataset_affiliations_springer_2023_10_31.json",
+    "crossref": "dataset_affiliations_crossref_2024_02_19.json",
+}
+
+
+def load_dataset(name, limit=None):
+    with open(os.path.join(DATASETS_DIR, DATASETS[name])) as f:
+        return json.load(f)[:limit]
+
+
+def escape(affiliation):
+    # escaped the way the affiliation matching tests query the API
+    return re.sub(
+        r'([\+\-=\&\|><!\(\)\{\}\[\]\^"\~\*\?:\\\/])',
+        lambda m: "\\" + m.group(),
+        affiliation,
+    )
+
+
+def get_chosen_ids(matched, single_search):
+    if single_search:
+        return [m.organization["_id"] for m in matched if m.chosen]
+    return [m.organization.id for m in matched if m.chosen]
+
+
+def get_accuracy(dataset, results):
+    """Accuracy, precision and recall, computed like the affiliation
+    matching tests."""
+
+    correct = len(
+        [d for d, r in zip(dataset, results) if set(d["ror_ids"]) == set(r)]
+    )
+    intersection = sum(
+        len(set(r).intersection(d["ror_ids"])) for d, r in zip(dataset, results)
+    )
+    returned = sum(len(r) for r in results)
+    expected = sum(len(d["ror_ids"]) for d in dataset)
+    return {
+        "accuracy": correct / max(len(dataset), 1),
+        "precision": intersection / max(returned, 1),
+        "recall": intersection / max(expected, 1),
+    }
+
+
+def get_latency(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+        "throughput": len(latencies) / sum(latencies),
+    }
+
+
+def run_dataset(dataset, single_search, engine):
+    latencies = []
+    results = []
+    for d in dataset:
+        affiliation = escape(d["affiliation"])
+        start = time.perf_counter()
+        if single_search:
+            matched = matching_single_search.match_affiliation(
+                affiliation, engine=engine
+            )
+        else:
+            matched = matching.match_affiliation(affiliation, True, engine=engine)
+        latencies.append(time.perf_counter() - start)
+        results.append(get_chosen_ids(matched, single_search))
+    return latencies, results
+
+
+def benchmark_engines(command, options):
+    """Latency, throughput and accuracy of the ES and local engines on the
+    affiliation matching datasets. Caches are disabled."""
+
+    AFFILIATION_CACHE.max_entries = 0
+    CANDIDATE_CACHE.max_entries = 0
+    try:
+        get_engine(ENGINE_LOCAL)
+    except ValueError as e:
+        raise CommandError("{}, check MATCHING_LOCAL_DUMP".format(e))
+    for name in DATASETS:
+        dataset = load_dataset(name, options["limit"])
+        for single_search in [False, True]:
+            for engine in ENGINES:
+                latencies, results = run_dataset(dataset, single_search, engine)
+                stats = dict(get_latency(latencies), **get_accuracy(dataset, results))
+                command.stdout.write(
+                    "{:<9} {:<13} {:<6} p50 {p50:7.1f}ms  p95 {p95:7.1f}ms  "
+                    "{throughput:7.1f}/s  accuracy {accuracy:.4f}  "
+                    "precision {precision:.4f}  recall {recall:.4f}".format(
+                        name,
+                        "single search" if single_search else "multi search",
+                        engine,
+                        **stats
+                    )
+                )
+
+
+def benchmark_normalize(command, options):
+    """Per call cost of the compiled normalizer, without and with its
+    memoization, against the sequential reference implementation, on the
+    affiliations and their substrings."""
+
+    strings = []
+    for name in DATASETS:
+        for d in load_dataset(name, options["limit"]):
+            strings.append(d["affiliation"])
+            strings.extend(d["affiliation"].split(","))
+    strings = list(dict.fromkeys(strings))
+    normalize.cache_clear()
+    for label, function in [
+        ("reference", normalize_reference),
+        ("compiled", normalize),
+        ("memoized", normalize),
+    ]:
+        start = time.perf_counter()
+        for s in strings:
+            function(s)
+        elapsed = time.perf_counter() - start
+        command.stdout.write(
+            "{:<9} {:7.2f}us per call".format(label, elapsed / len(strings) * 1e6)
+        )
+
+
+def benchmark_countries(command, options):
+    """Per affiliation cost of country extraction, for the scorers of both
+    matching strategies, against comparing every country name."""
+
+    affiliations = [
+        d["affiliation"]
+        for name in DATASETS
+        for d in load_dataset(name, options["limit"])
+    ]
+    for label, countries, fuzz, detector in [
+        ("multi search", matching.COUNTRIES, fuzzywuzzy_fuzz, matching.COUNTRY_DETECTOR),
+        (
+            "single search",
+            matching_single_search.GEONAMES_COUNTRIES,
+            rapidfuzz_fuzz,
+            matching_single_search.COUNTRY_DETECTOR,
+        ),
+    ]:
+        start = time.perf_counter()
+        for affiliation in affiliations:
+            get_country_codes_exhaustive(
+                countries, affiliation, fuzz.ratio, fuzz.partial_ratio
+            )
+        exhaustive = time.perf_counter() - start
+        start = time.perf_counter()
+        for affiliation in affiliations:
+            detector.get_country_codes(affiliation)
+        detected = time.perf_counter() - start
+        command.stdout.write(
+            "{:<13} exhaustive {:6.2f}ms  detector {:6.2f}ms per affiliation".format(
+                label,
+                exhaustive / len(affiliations) * 1000,
+                detected / len(affiliations) * 1000,
+            )
+        )
+
+
+def check_do_not_match_linear(search_string, countries, cities):
+    # the scans check_do_not_match did before the gazetteer
+    lower = search_string.lower()
+    return any(
+        lower in (c["name"].lower(), c["iso"].lower(), c["iso3"].lower())
+        for c in countries
+    ) or any(lower == c["name"].lower() for c in cities)
+
+
+def benchmark_gazetteer(command, options):
+    """Memory retained by the geonames records and by the gazetteer, and the
+    cost of a do-not-match lookup with linear scans and with the
+    gazetteer, on the parts of the affiliations."""
+
+    tracemalloc.start()
+    gc = geonamescache.GeonamesCache()
+    countries = list(gc.get_countries().values())
+    cities = list(gc.get_cities().values())
+    records = tracemalloc.get_traced_memory()[0]
+    gazetteer = Gazetteer(countries, cities)
+    retained = tracemalloc.get_traced_memory()[0] - records
+    tracemalloc.stop()
+    command.stdout.write(
+        "geonames records {:6.1f}MB  gazetteer {:6.1f}MB (estimated {:.1f}MB)".format(
+            records / 2 ** 20, retained / 2 ** 20, gazetteer.get_memory_size() / 2 ** 20
+        )
+    )
+
+    parts = [
+        p.strip()
+        for name in DATASETS
+        for d in load_dataset(name, options["limit"])
+        for p in d["affiliation"].split(",")
+    ]
+    for label, check in [
+        ("linear", lambda p: check_do_not_match_linear(p, countries, cities)),
+        ("gazetteer", lambda p: gazetteer.is_country(p) or gazetteer.is_city(p)),
+    ]:
+        start = time.perf_counter()
+        for p in parts:
+            check(p)
+        elapsed = time.perf_counter() - start
+        command.stdout.write(
+            "{:<9} {:10.2f}us per lookup".format(label, elapsed / len(parts) * 1e6)
+        )
+
+
+def benchmark_single_search_scoring(command, options):
+    """Cost of scoring, rescoring and choosing among 50, 200 and 1000 single
+    search candidates per affiliation. Candidate names are drawn from the
+    affiliation parts, so that many candidates score above MIN_SCORE."""
+
+    affiliations = [d["affiliation"] for d in load_dataset("crossref", options["limit"])]
+    parts = [p.strip() for a in affiliations for p in a.split(",") if p.strip()]
+    rng = random.Random(0)
+    for size in [50, 200, 1000]:
+        elapsed = 0
+        for affiliation in affiliations:
+            own = [p.strip() for p in affiliation.split(",") if p.strip()]
+            hits = [
+                {
+                    "_id": "https://ror.org/0{}".format(i),
+                    "_source": {
+                        "status": "active",
+                        "locations": [{"geonames_details": {"country_code": "US"}}],
+                        "affiliation_match": {
+                            "names": [{"name": n} for n in rng.sample(own + parts, 3)]
+                        },
+                    },
+                }
+                for i in range(size)
+            ]
+            results = AttrDict({"hits": {"hits": hits}})
+            start = time.perf_counter()
+            matching_single_search.match_by_query(affiliation, None, [], results)
+            elapsed += time.perf_counter() - start
+        command.stdout.write(
+            "{:>4} candidates {:8.2f}ms per affiliation".format(
+                size, elapsed / len(affiliations) * 1000
+            )
+        )
+
+
+def count_graph_queries(affiliation):
+    graph = matching.get_matching_graph(affiliation, True)
+    return len(graph.nodes), len(set(matching.get_graph_queries(graph)))
+
+
+def benchmark_fragments(command, options):
+    """Matching graph nodes and distinct multi search queries per
+    affiliation without and with the fragment classifier. With --engine,
+    also the accuracy of the multi search matching in both cases (caches
+    disabled), which needs the engine's index."""
+
+    AFFILIATION_CACHE.max_entries = 0
+    CANDIDATE_CACHE.max_entries = 0
+    for name in DATASETS:
+        dataset = load_dataset(name, options["limit"])
+        for classifier in [False, True]:
+            MATCHING["FRAGMENT_CLASSIFIER"] = classifier
+            counts = [count_graph_queries(d["affiliation"]) for d in dataset]
+            line = "{:<9} classifier {:<3}  nodes {:5.2f}  queries {:6.2f} per affiliation".format(
+                name,
+                "on" if classifier else "off",
+                sum(c[0] for c in counts) / len(counts),
+                sum(c[1] for c in counts) / len(counts),
+            )
+            if options["engine"]:
+                _, results = run_dataset(dataset, False, options["engine"])
+                line += "  accuracy {accuracy:.4f}  precision {precision:.4f}  recall {recall:.4f}".format(
+                    **get_accuracy(dataset, results)
+                )
+            command.stdout.write(line)
+
+
+def benchmark_pushdown(command, options):
+    """Latency and accuracy of both matching strategies on the datasets for
+    each pushdown mode of the country and status constraints (caches
+    disabled), with the configured engine or --engine."""
+
+    AFFILIATION_CACHE.max_entries = 0
+    CANDIDATE_CACHE.max_entries = 0
+    engine = options["engine"] or MATCHING["ENGINE"]
+    for name in DATASETS:
+        dataset = load_dataset(name, options["limit"])
+        for single_search in [False, True]:
+            for mode in PUSHDOWN_MODES:
+                MATCHING["PUSHDOWN"] = mode
+                latencies, results = run_dataset(dataset, single_search, engine)
+                stats = dict(get_latency(latencies), **get_accuracy(dataset, results))
+                command.stdout.write(
+                    "{:<9} {:<13} {:<6} p50 {p50:7.1f}ms  p95 {p95:7.1f}ms  "
+                    "accuracy {accuracy:.4f}  precision {precision:.4f}  "
+                    "recall {recall:.4f}".format(
+                        name,
+                        "single search" if single_search else "multi search",
+                        mode,
+                        **stats
+                    )
+                )
+
+
+BENCHMARKS = {
+    "engines": benchmark_engines,
+    "normalize": benchmark_normalize,
+    "countries": benchmark_countries,
+    "gazetteer": benchmark_gazetteer,
+    "single-search-scoring": benchmark_single_search_scoring,
+    "fragments": benchmark_fragments,
+    "pushdown": benchmark_pushdown,
+}
+
+
+class Command(BaseCommand):
+    help = "Benchmark affiliation matching"
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmark", type=str, choices=list(BENCHMARKS), help="Benchmark to run")
+        parser.add_argument("--limit", type=int, help="Number of affiliations used from each dataset")
+        parser.add_argument("--engine", type=str, choices=ENGINES, help="Engine used to check the accuracy")
+
+    def handle(self, *args, **options):
+        # the local index, if configured, is built before any matching
+        start = time.perf_counter()
+        if load_local_index() is not None:
+            self.stdout.write(
+                "Local index built in {:.1f}s".format(time.perf_counter() - start)
+            )
+        BENCHMARKS[options["benchmark"]](self, options)
@@ -1,5 +1,4 @@
 import json
-import re
 from functools import wraps
 from threading import local
 import zipfile
@@ -9,38 +8,13 @@ from os.path import exists
 import pathlib
 import shutil
 from rorapi.settings import ES7, ES_VARS, DATA
+from rorapi.common.cache import bump_index_generation, new_index_generation
+from rorapi.common.facets import precompute_facets
+from rorapi.common.index_utils import add_index_fields
 
 from django.core.management.base import BaseCommand
 from elasticsearch import TransportError
 
-def get_nested_names_v2(org):
-    for name in org['names']:
-        yield name['value']
-
-def get_nested_ids_v2(org):
-    yield org['id']
-    yield re.sub('https://', '', org['id'])
-    yield re.sub('https://ror.org/', '', org['id'])
-    for ext_id in org['external_ids']:
-        for eid in ext_id['all']:
-            yield eid
-
-def get_single_search_names_v2(org):
-    for name in org["names"]:
-        if "acronym" not in name["types"]:
-            yield name["value"]
-
-def get_affiliation_match_doc(org):
-    doc = { 
-        'id': org['id'],
-        'country': org["locations"][0]["geonames_details"]["country_code"],
-        'status': org['status'],
-        'primary': [n["value"] for n in org["names"] if "ror_display" in n["types"]][0],
-        'names': [{"name": n} for n in get_single_search_names_v2(org)],
-        'relationships': [{"type": r['type'], "id": r['id']} for r in org['relationships']]
-    }
-    return doc
-
 def prepare_files(path, local_file):
     data = []
     err = {}
@@ -154,15 +128,7 @@ def index(dataset, version):
                         '_id': org['id']
                     }
                 })
-                org['names_ids'] = [{
-                    'name': n
-                } for n in get_nested_names_v2(org)]
-                org['names_ids'] += [{
-                    'id': n
-                } for n in get_nested_ids_v2(org)]
-                # experimental affiliations_match nested doc
-                org['affiliation_match'] = get_affiliation_match_doc(org)
-                body.append(org)
+                body.append(add_index_fields(org))
             ES7.bulk(body)
     except TransportError:
         err[index.__name__] = f"Indexing error, reverted index back to previous state"
@@ -176,6 +142,13 @@ def index(dataset, version):
         })
     if ES7.indices.exists(backup_index):
         ES7.indices.delete(backup_index)
+    # make the indexed documents visible to the facet precomputation
+    ES7.indices.refresh(index)
+    # invalidate cached results in all processes, once the facets of the
+    # new index generation are precomputed
+    generation = new_index_generation()
+    precompute_facets(generation)
+    bump_index_generation(generation)
     return err
 
 class Command(BaseCommand):
@@ -0,0 +1,247 @@
+import csv
+import io
+import json
+import os
+import time
+
+from collections import deque
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rorapi.common.matching_batch import match_batch
+from rorapi.common.matching_local import ENGINES, get_engine, load_local_index
+from rorapi.common.models import Errors
+
+OUTPUT_FIELDS = ["record", "affiliation", "ror_ids", "scores", "matching_types", "errors"]
+
+
+def is_csv(path):
+    return path.lower().endswith(".csv")
+
+
+def read_affiliations(path, offset, column):
+    """Affiliations from a CSV file (one record per line, with a header) or a
+    JSONL file (JSON strings or objects with an "affiliation" field),
+    starting at the given byte offset. Yields (affiliation, offset of the
+    next line) tuples."""
+
+    with open(path, "rb") as f:
+        index = None
+        if is_csv(path):
+            header = f.readline()
+            fields = next(csv.reader([header.decode("utf-8-sig")]))
+            if column not in fields:
+                raise CommandError("Column {} not found in {}".format(column, path))
+            index = fields.index(column)
+            offset = max(offset, len(header))
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            text = line.decode("utf-8", errors="replace")
+            if not text.strip():
+                continue
+            if index is not None:
+                row = next(csv.reader([text]))
+                yield (row[index] if index < len(row) else None), offset
+                continue
+            try:
+                value = json.loads(text)
+            except ValueError:
+                value = None
+            if isinstance(value, dict):
+                value = value.get(column)
+            yield value, offset
+
+
+def read_chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def match_chunk(affiliations, single_search, active_only, engine):
+    """Match a chunk of affiliations, returning the chosen organizations in
+    a picklable form."""
+
+    rows = []
+    for affiliation, result in zip(
+        affiliations, match_batch(affiliations, single_search, active_only, engine)
+    ):
+        if isinstance(result, Errors):
+            rows.append({"affiliation": affiliation, "errors": result.errors})
+            continue
+        chosen = [item for item in result.items if item.chosen]
+        rows.append(
+            {
+                "affiliation": affiliation,
+                "ror_ids": [item.organization.id for item in chosen],
+                "scores": [item.score for item in chosen],
+                "matching_types": [item.matching_type for item in chosen],
+            }
+        )
+    return rows
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return {"input_offset": 0, "output_offset": 0, "records": 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+class OutputWriter:
+    """Writes matching results to a CSV or JSONL file, appending after the
+    last checkpoint."""
+
+    def __init__(self, path, offset):
+        self.csv = is_csv(path)
+        self.file = open(path, "a+b")
+        # drop results written after the last checkpoint
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        if self.csv and offset == 0:
+            self.write_line(self.csv_line(OUTPUT_FIELDS))
+
+    def csv_line(self, values):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue()
+
+    def write_line(self, line):
+        self.file.write(line.encode("utf-8"))
+
+    def write(self, row):
+        if self.csv:
+            self.write_line(
+                self.csv_line(
+                    [
+                        row["record"],
+                        row["affiliation"],
+                        ";".join(row.get("ror_ids", [])),
+                        ";".join(str(s) for s in row.get("scores", [])),
+                        ";".join(row.get("matching_types", [])),
+                        ";".join(row.get("errors", [])),
+                    ]
+                )
+            )
+        else:
+            self.write_line(json.dumps(row) + "\n")
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class Command(BaseCommand):
+    help = "Match a file of affiliations (CSV or JSONL) to ROR IDs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", type=str, help="CSV or JSONL file of affiliations")
+        parser.add_argument("output", type=str, help="CSV or JSONL file for the results")
+        parser.add_argument("--column", type=str, default="affiliation", help="CSV column or JSON field containing the affiliation")
+        parser.add_argument("--single-search", action="store_true", help="Use the single search matching strategy")
+        parser.add_argument("--engine", type=str, choices=ENGINES, help="Matching engine, defaults to MATCHING_ENGINE")
+        parser.add_argument("--all-status", action="store_true", help="Match inactive and withdrawn organizations too")
+        parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of worker processes, 0 to match in this process")
+        parser.add_argument("--chunk-size", type=int, default=50, help="Number of affiliations matched together by a worker")
+        parser.add_argument("--checkpoint", type=str, help="Checkpoint file, defaults to <output>.checkpoint")
+        parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+
+    def handle(self, *args, **options):
+        # the local index, if configured, is built before the workers are
+        # forked, so that they share it
+        load_local_index()
+        try:
+            get_engine(options["engine"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        checkpoint_path = options["checkpoint"] or options["output"] + ".checkpoint"
+        if options["restart"] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint["records"]:
+            self.stdout.write("Resuming after {} affiliations".format(checkpoint["records"]))
+
+        records = read_affiliations(
+            options["input"], checkpoint["input_offset"], options["column"]
+        )
+        chunks = read_chunks(records, options["chunk_size"])
+        matching_args = (
+            options["single_search"],
+            not options["all_status"],
+            options["engine"],
+        )
+        writer = OutputWriter(options["output"], checkpoint["output_offset"])
+        pool = Pool(options["processes"]) if options["processes"] > 0 else None
+
+        start = time.monotonic()
+        processed = 0
+        pending = deque()
+        try:
+            while True:
+                # keep a bounded number of chunks in flight, so that the
+                # input is not read ahead of the workers
+                while pool is not None and len(pending) < 2 * options["processes"]:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    affiliations = [a for a, _ in chunk]
+                    pending.append(
+                        (chunk, pool.apply_async(match_chunk, (affiliations,) + matching_args))
+                    )
+                if pool is None:
+                    chunk = next(chunks, None)
+                    if chunk is not None:
+                        rows = match_chunk([a for a, _ in chunk], *matching_args)
+                elif pending:
+                    chunk, result = pending.popleft()
+                    rows = result.get()
+                else:
+                    chunk = None
+                if chunk is None:
+                    break
+
+                for row in rows:
+                    checkpoint["records"] += 1
+                    writer.write(dict(record=checkpoint["records"], **row))
+                checkpoint["input_offset"] = chunk[-1][1]
+                checkpoint["output_offset"] = writer.flush()
+                write_checkpoint(checkpoint_path, checkpoint)
+
+                processed += len(rows)
+                elapsed = time.monotonic() - start
+                self.stdout.write(
+                    "Matched {} affiliations ({:.1f}/s)".format(
+                        checkpoint["records"], processed / elapsed if elapsed else 0
+                    )
+                )
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            writer.close()
+            if pool is not None:
+                pool.terminate()
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            "Done: {} affiliations matched in {:.1f}s ({:.1f}/s)".format(
+                processed, elapsed, processed / elapsed if elapsed else 0
+            )
+        )
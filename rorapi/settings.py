@@ -16,10 +16,11 @@ import json
 import sentry_sdk
 import boto3
 from dotenv import load_dotenv
-from elasticsearch import Elasticsearch, RequestsHttpConnection
+from elasticsearch import Elasticsearch
 from requests_aws4auth import AWS4Auth
 from corsheaders.defaults import default_headers
 from sentry_sdk.integrations.django import DjangoIntegration
+from rorapi.common.es_connection import PooledRequestsHttpConnection
 
 sentry_sdk.init(dsn=os.environ.get('SENTRY_DSN', None),
                 integrations=[DjangoIntegration()])
@@ -153,10 +154,121 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 
 ES_VARS = {
     'INDEX_V2': 'organizations-v2',
+    # precomputed search facets of INDEX_V2
+    'INDEX_V2_FACETS': 'organizations-v2-facets',
     'INDEX_TEMPLATE_ES7_V2': os.path.join(BASE_DIR, 'rorapi', 'v2', 'index_template_es7.json'),
     'BATCH_SIZE': 20,
     'MAX_PAGE': 500,  # = <ES LIMIT 10000> / BATCH_SIZE
-    'BULK_SIZE': 500
+    'BULK_SIZE': 500,
+    # walk the search results of a cursor in a point in time of the index,
+    # kept alive between pages for CURSOR_PIT_KEEP_ALIVE
+    'CURSOR_PIT': os.environ.get('ES_CURSOR_PIT', 'False') == 'True',
+    'CURSOR_PIT_KEEP_ALIVE': os.environ.get('ES_CURSOR_PIT_KEEP_ALIVE', '5m'),
+}
+
+# Affiliation matching
+# ENGINE: 'es' runs the matching queries in Elasticsearch, 'local' in an
+# in-process index built from the ROR dump at LOCAL_DUMP (JSON or zip file)
+# when each process starts; without it, the local engine is not available
+# QUERY_EXECUTION: 'sequential' sends the matching queries one at a time,
+# 'batch' sends all queries of a request in a single ES multi search,
+# 'concurrent' runs the nodes and matching types on a pool of WORKERS threads
+# RESULT_CACHE_*: per-process LRU cache of match_affiliation results
+# (SIZE entries, MAX_BYTES, TTL seconds), SIZE=0 disables the cache
+# CANDIDATE_CACHE_*: per-process LRU cache of the candidates returned by
+# the individual matching queries, same parameters
+# INDEX_GENERATION_CHECK_INTERVAL: how often (seconds) caches check whether
+# the index has been rebuilt
+# BATCH_MAX_SIZE: maximum number of affiliations in a batch matching request
+# STREAM_CHUNK_SIZE: number of lines of a streaming matching request that
+# are matched together (and so of results buffered)
+# PUSHDOWN: how the country and status constraints checked after scoring
+# are pushed down into the matching queries: 'off', 'filter' (ES only returns
+# candidates meeting them) or 'boost' (ES ranks them first)
+# FRAGMENT_CLASSIFIER: skip the multi search of affiliation parts that look
+# like addresses, or like departments of an organization named in another part
+# (off until its recall is checked with the benchmarkmatching fragments benchmark)
+# DEADLINE: time budget (seconds) of the multi search matching of an
+# affiliation, after which the remaining graph nodes and matching types are
+# skipped and the partial result is returned; 0 disables it. Requests with
+# our token can override it with the deadline parameter
+# CASCADE_MIN_MARGIN: in cascade mode, minimum score difference between the
+# candidate chosen by the single search and the next one for the single
+# search answer to be kept
+# CASCADE_QUERY_BUDGET: in cascade mode, maximum number of matching queries
+# per affiliation; the multi search is skipped when it would exceed it
+MATCHING = {
+    'ENGINE': os.environ.get('MATCHING_ENGINE', 'es'),
+    'LOCAL_DUMP': os.environ.get('MATCHING_LOCAL_DUMP'),
+    'QUERY_EXECUTION': os.environ.get('MATCHING_QUERY_EXECUTION', 'sequential'),
+    'WORKERS': int(os.environ.get('MATCHING_WORKERS', '8')),
+    'RESULT_CACHE_SIZE': int(os.environ.get('MATCHING_RESULT_CACHE_SIZE', '50000')),
+    'RESULT_CACHE_MAX_BYTES': int(os.environ.get('MATCHING_RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    'RESULT_CACHE_TTL': int(os.environ.get('MATCHING_RESULT_CACHE_TTL', '86400')),
+    'CANDIDATE_CACHE_SIZE': int(os.environ.get('MATCHING_CANDIDATE_CACHE_SIZE', '100000')),
+    'CANDIDATE_CACHE_MAX_BYTES': int(os.environ.get('MATCHING_CANDIDATE_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+    'CANDIDATE_CACHE_TTL': int(os.environ.get('MATCHING_CANDIDATE_CACHE_TTL', '86400')),
+    'INDEX_GENERATION_CHECK_INTERVAL': int(os.environ.get('INDEX_GENERATION_CHECK_INTERVAL', '60')),
+    'BATCH_MAX_SIZE': int(os.environ.get('MATCHING_BATCH_MAX_SIZE', '100')),
+    'STREAM_CHUNK_SIZE': int(os.environ.get('MATCHING_STREAM_CHUNK_SIZE', '20')),
+    'PUSHDOWN': os.environ.get('MATCHING_PUSHDOWN', 'off'),
+    'FRAGMENT_CLASSIFIER': os.environ.get('MATCHING_FRAGMENT_CLASSIFIER', 'False') == 'True',
+    'DEADLINE': float(os.environ.get('MATCHING_DEADLINE', '5')),
+    'CASCADE_MIN_MARGIN': float(os.environ.get('MATCHING_CASCADE_MIN_MARGIN', '0.04')),
+    'CASCADE_QUERY_BUDGET': int(os.environ.get('MATCHING_CASCADE_QUERY_BUDGET', '60')),
+}
+
+# Search response cache, shared by the worker processes through the 'search'
+# Django cache (SEARCH_CACHE_BACKEND at SEARCH_CACHE_LOCATION, a directory
+# for the default file based cache, memcached or the database cache to share
+# it between hosts)
+# TTL: seconds a response is fresh, 0 disables the cache
+# STALE_TTL: seconds a response is served stale after its TTL, while a
+# single process refreshes it
+# REFRESH_TIMEOUT: seconds after which a refresh that did not complete can
+# be started again
+# MAX_ENTRIES: number of cached responses
+# MAX_BYTES: size of the largest cached response
+SEARCH_CACHE = {
+    'TTL': int(os.environ.get('SEARCH_CACHE_TTL', '300')),
+    'STALE_TTL': int(os.environ.get('SEARCH_CACHE_STALE_TTL', '3600')),
+    'REFRESH_TIMEOUT': int(os.environ.get('SEARCH_CACHE_REFRESH_TIMEOUT', '30')),
+    'MAX_ENTRIES': int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '10000')),
+    'MAX_BYTES': int(os.environ.get('SEARCH_CACHE_MAX_BYTES', str(256 * 1024))),
+}
+
+# Streaming export of all the organizations matching a search
+EXPORT = {
+    # organizations fetched per ES query
+    'BATCH_SIZE': int(os.environ.get('EXPORT_BATCH_SIZE', '1000')),
+    # exports started per client, in the DRF throttle rate format
+    'RATE': os.environ.get('EXPORT_RATE', '10/hour'),
+    # exports streamed at the same time per client
+    'MAX_STREAMS': int(os.environ.get('EXPORT_MAX_STREAMS', '2')),
+    # seconds after which the stream of an interrupted export is forgotten
+    'STREAM_TIMEOUT': int(os.environ.get('EXPORT_STREAM_TIMEOUT', '3600')),
+    'COMPRESSION_LEVEL': int(os.environ.get('EXPORT_COMPRESSION_LEVEL', '6')),
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': os.environ.get(
+            'SEARCH_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('SEARCH_CACHE_LOCATION', '/tmp/rorapi_search_cache'),
+        'TIMEOUT': SEARCH_CACHE['TTL'] + SEARCH_CACHE['STALE_TTL'],
+        'OPTIONS': {'MAX_ENTRIES': SEARCH_CACHE['MAX_ENTRIES']},
+    },
+    # export rate limits, shared by the workers
+    'export': {
+        'BACKEND': os.environ.get(
+            'EXPORT_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('EXPORT_CACHE_LOCATION', '/tmp/rorapi_export_cache'),
+        # incr keeps the default timeout with some backends
+        'TIMEOUT': EXPORT['STREAM_TIMEOUT'],
+    },
 }
 
 # use AWS4Auth for AWS Elasticsearch unless running locally via docker or localhost
@@ -179,7 +291,9 @@ ES7 = Elasticsearch([{
     http_auth=http_auth,
     use_ssl=False,
     timeout=240,
-    connection_class=RequestsHttpConnection)
+    connection_class=PooledRequestsHttpConnection,
+    # the client is shared by the matching worker threads
+    pool_maxsize=max(10, MATCHING['WORKERS']))
 
 # ROR DUMP grid-2018-11-14
 # GRID = {
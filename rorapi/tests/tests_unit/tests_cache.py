@@ -0,0 +1,318 @@
+import mock
+
+from threading import Event, Thread
+
+from django.test import SimpleTestCase, override_settings
+
+from elasticsearch_dsl.response import Hit
+
+from rorapi.common.cache import LRUCache, SharedCache, get_index_generation, get_size
+from rorapi.common.matching import MatchedOrganization, QueryExecutor, \
+    BatchQueryExecutor, get_exact_match_query, get_queries_by_type, \
+    MATCHING_TYPE_PHRASE
+from rorapi.common.matching_cache import canonicalize_affiliation, \
+    cache_matching_results, CachedCandidate, hydrate_organizations
+from .utils import AttrDict
+
+
+@mock.patch('rorapi.common.cache.get_index_generation', return_value='g1')
+class LRUCacheTestCase(SimpleTestCase):
+    def test_get_set(self, generation_mock):
+        cache = LRUCache('test', 10, 10000, 60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', (1, 2))
+        self.assertEqual(cache.get('a'), (1, 2))
+        self.assertEqual(cache.bytes, get_size('a') + get_size((1, 2)))
+
+    def test_disabled(self, generation_mock):
+        cache = LRUCache('test', 0, 10000, 60)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_max_entries(self, generation_mock):
+        cache = LRUCache('test', 2, 10000, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_max_bytes(self, generation_mock):
+        size = get_size('a') + get_size('x' * 100)
+        cache = LRUCache('test', 10, 2 * size, 60)
+        cache.set('a', 'x' * 100)
+        cache.set('b', 'x' * 100)
+        cache.set('c', 'x' * 100)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.bytes, 2 * size)
+        cache.set('d', 'x' * 1000)
+        self.assertIsNone(cache.get('d'))
+
+    def test_ttl(self, generation_mock):
+        cache = LRUCache('test', 10, 10000, 60)
+        with mock.patch('time.monotonic', return_value=100):
+            cache.set('a', 1)
+        with mock.patch('time.monotonic', return_value=159):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('time.monotonic', return_value=160):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.bytes, 0)
+
+    def test_index_generation(self, generation_mock):
+        cache = LRUCache('test', 10, 10000, 60)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        generation_mock.return_value = 'g2'
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.bytes, 0)
+
+
+@mock.patch('rorapi.common.cache.get_index_generation', return_value='g1')
+class MatchingCacheTestCase(SimpleTestCase):
+    def test_canonicalize_affiliation(self, generation_mock):
+        self.assertEqual(
+            canonicalize_affiliation(' University  of\tExcellence\n'),
+            'University of Excellence')
+
+    def test_cache_matching_results(self, generation_mock):
+        org = {'_id': 'https://ror.org/0abc', '_source': {'id': 'https://ror.org/0abc'}}
+        match_mock = mock.Mock(return_value=[
+            MatchedOrganization(substring='University of Excellence',
+                                matching_type='PHRASE', score=1.0, chosen=True,
+                                organization=AttrDict({'id': org['_id']}))
+        ])
+        with mock.patch('rorapi.common.matching_cache.AFFILIATION_CACHE',
+                        LRUCache('test', 10, 10000, 60)):
+            match = cache_matching_results(
+                single_search=False, factory=MatchedOrganization)(match_mock)
+            match('University of Excellence', True)
+            match_mock.assert_called_once_with('University of Excellence', True, engine='es')
+
+            with mock.patch('rorapi.common.matching_cache.ES7.mget',
+                            return_value={'docs': [dict(org, found=True)]}) \
+                    as mget_mock:
+                cached = match(' University  of Excellence', True)
+            match_mock.assert_called_once()
+            mget_mock.assert_called_once()
+            self.assertEqual(len(cached), 1)
+            self.assertEqual(cached[0].organization.id, org['_id'])
+            self.assertEqual(cached[0].substring, 'University of Excellence')
+            self.assertEqual(cached[0].score, 1.0)
+            self.assertTrue(cached[0].chosen)
+
+            match('University of Excellence', False)
+            self.assertEqual(match_mock.call_count, 2)
+
+
+@mock.patch('rorapi.common.cache.get_index_generation', return_value='g1')
+class CandidateCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('rorapi.common.matching_cache.CANDIDATE_CACHE',
+                             LRUCache('test', 10, 100000, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hit(self, id):
+        return Hit({
+            '_id': id,
+            '_score': 12.5,
+            '_source': {
+                'id': id,
+                'status': 'active',
+                'names': [{'value': 'University of Excellence',
+                           'types': ['ror_display', 'label']}],
+                'locations': [{'geonames_details': {'country_code': 'US'}}],
+                'links': [{'value': 'https://excellence.edu'}]
+            }
+        })
+
+    def test_cached_candidates(self, generation_mock):
+        query = get_queries_by_type('University of Excellence',
+                                    MATCHING_TYPE_PHRASE)[0][1]
+        with mock.patch('elasticsearch_dsl.Search.execute',
+                        return_value=[self.hit('https://ror.org/0abc')]) \
+                as search_mock:
+            executor = QueryExecutor()
+            executor.execute(query)
+            candidates = QueryExecutor().execute(query)
+        search_mock.assert_called_once()
+        self.assertEqual(executor.executed, 1)
+        self.assertEqual(len(candidates), 1)
+        candidate = candidates[0]
+        self.assertIsInstance(candidate, CachedCandidate)
+        self.assertEqual(candidate.id, 'https://ror.org/0abc')
+        self.assertEqual(candidate.meta.score, 12.5)
+        self.assertEqual(candidate.status, 'active')
+        self.assertEqual(candidate.names[0].types, ['ror_display', 'label'])
+        self.assertEqual(
+            candidate.locations[0].geonames_details.country_code, 'US')
+
+    def test_negative_entries(self, generation_mock):
+        query = get_exact_match_query('Gallifrey')
+        with mock.patch('elasticsearch_dsl.Search.execute',
+                        return_value=[]) as search_mock:
+            QueryExecutor().execute(query)
+            executor = QueryExecutor()
+            self.assertEqual(executor.execute(query), [])
+        search_mock.assert_called_once()
+        self.assertEqual(executor.executed, 0)
+
+    def test_batch_prefetch(self, generation_mock):
+        cached = get_exact_match_query('University of Excellence')
+        query = get_exact_match_query('Gallifrey')
+        with mock.patch('elasticsearch_dsl.Search.execute',
+                        return_value=[]):
+            QueryExecutor().execute(cached)
+        with mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True,
+                        side_effect=lambda ms: [[] for _ in ms._searches]) \
+                as msearch_mock:
+            executor = BatchQueryExecutor()
+            executor.prefetch([cached, query])
+        self.assertEqual(len(msearch_mock.call_args[0][0]._searches), 1)
+        self.assertEqual(executor.executed, 1)
+        self.assertEqual(executor.execute(cached), [])
+
+    def test_hydrate_organizations(self, generation_mock):
+        doc = self.hit('https://ror.org/0abc').to_dict()
+        cached = CachedCandidate({'_id': doc['id'], '_source': {'id': doc['id']}})
+        matched = [
+            MatchedOrganization(substring='University of Excellence',
+                                matching_type='PHRASE', score=1.0, chosen=True,
+                                organization=cached),
+            MatchedOrganization(substring='Gallifrey', matching_type='PHRASE',
+                                score=0.9, chosen=False,
+                                organization=CachedCandidate(
+                                    {'_source': {'id': 'https://ror.org/0xyz'}}))
+        ]
+        with mock.patch('rorapi.common.matching_cache.ES7.mget',
+                        return_value={'docs': [
+                            {'_id': doc['id'], '_source': doc, 'found': True},
+                            {'_id': 'https://ror.org/0xyz', 'found': False}]}) \
+                as mget_mock:
+            hydrated = hydrate_organizations(matched)
+        mget_mock.assert_called_once()
+        self.assertEqual(len(hydrated), 1)
+        self.assertNotIsInstance(hydrated[0].organization, CachedCandidate)
+        self.assertEqual(hydrated[0].organization.links[0].value,
+                         'https://excellence.edu')
+        self.assertEqual(hydrated[0].score, 1.0)
+
+
+class IndexGenerationTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict('rorapi.common.cache.INDEX_GENERATION',
+                                  {'value': 'g1', 'checked': None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('rorapi.common.cache.read_index_generation')
+    def test_check_interval(self, read_mock):
+        read_mock.return_value = 'g2'
+        with mock.patch('rorapi.common.cache.time.monotonic', return_value=1000):
+            self.assertEqual(get_index_generation(), 'g2')
+            read_mock.return_value = 'g3'
+            self.assertEqual(get_index_generation(), 'g2')
+        with mock.patch('rorapi.common.cache.time.monotonic', return_value=2000):
+            self.assertEqual(get_index_generation(), 'g3')
+        read_mock.side_effect = Exception('ES down')
+        with mock.patch('rorapi.common.cache.time.monotonic', return_value=3000):
+            self.assertEqual(get_index_generation(), 'g3')
+        self.assertEqual(read_mock.call_count, 3)
+
+    @mock.patch('rorapi.common.cache.read_index_generation')
+    def test_concurrent_check(self, read_mock):
+        # threads do not wait for the ES read of the thread checking the
+        # generation
+        reading = Event()
+        done = Event()
+
+        def read():
+            reading.set()
+            done.wait(5)
+            return 'g2'
+
+        read_mock.side_effect = read
+        checking = Thread(target=get_index_generation)
+        checking.start()
+        self.assertTrue(reading.wait(5))
+        self.assertEqual(get_index_generation(), 'g1')
+        done.set()
+        checking.join(5)
+        self.assertEqual(get_index_generation(), 'g2')
+        read_mock.assert_called_once_with()
+
+
+class SyncThread:
+    def __init__(self, target, args, daemon):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@override_settings(CACHES={'search': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+@mock.patch('rorapi.common.cache.Thread', SyncThread)
+class SharedCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('rorapi.common.cache.get_index_generation',
+                             return_value='g1')
+        self.generation_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = SharedCache('test', 'search', 60, 600, 30, 1000)
+        self.cache.cache.clear()
+
+    def test_get_set(self):
+        refresh = mock.Mock()
+        self.assertIsNone(self.cache.get(('a', 1), refresh))
+        self.cache.set(('a', 1), {'hits': [1, 2]})
+        self.assertEqual(self.cache.get(('a', 1), refresh), {'hits': [1, 2]})
+        refresh.assert_not_called()
+
+    def test_disabled(self):
+        cache = SharedCache('test', 'search', 0, 600, 30, 1000)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a', mock.Mock()))
+
+    def test_max_bytes(self):
+        self.cache.set('a', 'x' * 2000)
+        self.assertIsNone(self.cache.get('a', mock.Mock()))
+
+    def test_index_generation(self):
+        self.cache.set('a', 1)
+        self.generation_mock.return_value = 'g2'
+        self.assertIsNone(self.cache.get('a', mock.Mock()))
+
+    def test_stale_while_revalidate(self):
+        with mock.patch('rorapi.common.cache.time.time', return_value=1000):
+            self.cache.set('a', 1)
+        refresh = mock.Mock(return_value=2)
+        with mock.patch('rorapi.common.cache.time.time', return_value=1100):
+            # the stale value is served while it is refreshed
+            self.assertEqual(self.cache.get('a', refresh), 1)
+            self.assertEqual(self.cache.get('a', refresh), 2)
+        refresh.assert_called_once_with()
+
+    def test_single_refresh(self):
+        with mock.patch('rorapi.common.cache.time.time', return_value=1000):
+            self.cache.set('a', 1)
+        key = self.cache.get_key('a')
+        # another process is refreshing the entry
+        self.cache.cache.add(key + ':refresh', True)
+        refresh = mock.Mock(return_value=2)
+        with mock.patch('rorapi.common.cache.time.time', return_value=1100):
+            self.assertEqual(self.cache.get('a', refresh), 1)
+        refresh.assert_not_called()
+
+    def test_failed_refresh(self):
+        with mock.patch('rorapi.common.cache.time.time', return_value=1000):
+            self.cache.set('a', 1)
+        refresh = mock.Mock(side_effect=[Exception('ES down'), 2])
+        with mock.patch('rorapi.common.cache.time.time', return_value=1100):
+            self.assertEqual(self.cache.get('a', refresh), 1)
+            self.assertEqual(self.cache.get('a', refresh), 1)
+            self.assertEqual(self.cache.get('a', refresh), 2)
@@ -18,6 +18,32 @@ class QueryBuilderTestCaseV2(SimpleTestCase):
             'track_total_hits': True
         })
 
+    def test_lean_affiliation_query(self):
+        qb = ESQueryBuilder()
+        qb.add_affiliation_query('query terms', 200, lean=True)
+
+        self.assertEqual(
+            qb.get_query().to_dict(), {
+                'query': {
+                    'nested': {
+                        'path': 'affiliation_match.names',
+                        'score_mode': 'max',
+                        'query': {
+                            'match': {
+                                'affiliation_match.names.name': 'query terms'
+                            }
+                        },
+                        'inner_hits': {
+                            'size': 100
+                        }
+                    }
+                },
+                '_source': ['status', 'locations.geonames_details.country_code',
+                            'affiliation_match.names_version'],
+                'size': 200,
+                'track_total_hits': True
+            })
+
     def test_match_all_query(self):
         qb = ESQueryBuilder()
         qb.add_match_all_query()
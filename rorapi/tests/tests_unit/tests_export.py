@@ -0,0 +1,126 @@
+import gzip
+import json
+import mock
+import os
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+from rest_framework.test import APIRequestFactory
+from rorapi.common.export import ExportRateThrottle, ExportStream, \
+    acquire_export_stream, get_export_plan, release_export_stream, stream_export, \
+    validate_export
+
+
+class ExportTestCase(SimpleTestCase):
+
+    def setUp(self):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_search_es7_v2.json'), 'r') as f:
+            self.test_data = json.load(f)
+        for hit in self.test_data['hits']['hits']:
+            hit['sort'] = [1.0, hit['_id']]
+        self.hits = self.test_data['hits']['hits']
+        for name, value in [('open_point_in_time', 'p1'), ('close_point_in_time', None)]:
+            patcher = mock.patch('rorapi.common.export.' + name, return_value=value)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict('rorapi.common.export.EXPORT', {'BATCH_SIZE': 8})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def batch(self, hits, pit):
+        data = dict(self.test_data, pit_id=pit)
+        data['hits'] = dict(data['hits'], hits=hits)
+        return Response(Search(), data)
+
+    def test_validate(self):
+        self.assertIsNone(validate_export({'query': 'query terms', 'fields': 'id'}))
+        self.assertEqual(validate_export({'page': '2', 'facets': 'false'}).errors,
+                         ["query parameter 'page' is illegal",
+                          "query parameter 'facets' is illegal"])
+        self.assertEqual(len(validate_export({'filter': 'types'}).errors), 1)
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_stream(self, search_mock):
+        search_mock.side_effect = [self.batch(self.hits[:8], 'p2'),
+                                   self.batch(self.hits[8:16], 'p3'),
+                                   self.batch(self.hits[16:], 'p3')]
+        data = b''.join(stream_export(get_export_plan({'filter': 'types:education'})))
+        lines = gzip.decompress(data).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(l)['id'] for l in lines],
+                         [h['_source']['id'] for h in self.hits])
+
+        queries = [c[0][0].to_dict() for c in search_mock.call_args_list]
+        self.assertEqual([q['size'] for q in queries], [8, 8, 8])
+        self.assertNotIn('search_after', queries[0])
+        self.assertEqual(queries[1]['search_after'], [1.0, self.hits[7]['_id']])
+        self.assertEqual([q['pit']['id'] for q in queries], ['p1', 'p2', 'p3'])
+        self.assertNotIn('aggs', queries[0])
+        self.assertIn({'terms': {'types': ['education']}},
+                      queries[0]['query']['bool']['filter'])
+        self.open_point_in_time.assert_called_once()
+        self.close_point_in_time.assert_called_once_with('p3')
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_stream_fields(self, search_mock):
+        search_mock.return_value = self.batch(self.hits[:2], 'p1')
+        data = b''.join(stream_export(get_export_plan({'fields': 'id,types'})))
+        for line in gzip.decompress(data).decode('utf-8').splitlines():
+            self.assertEqual(set(json.loads(line)), {'id', 'types'})
+        self.assertEqual(search_mock.call_args[0][0].to_dict()['_source'],
+                         ['id', 'types'])
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_interrupted_stream(self, search_mock):
+        search_mock.return_value = self.batch(self.hits[:8], 'p1')
+        cache = LocMemCache(self.id(), {})
+        with mock.patch.object(ExportRateThrottle, 'cache', cache):
+            self.assertTrue(acquire_export_stream('client'))
+            chunks = ExportStream(get_export_plan({}), 'client')
+            next(chunks)
+            chunks.close()
+            self.close_point_in_time.assert_called_once_with('p1')
+            self.assertEqual(cache.get('export_streams_client'), 0)
+            chunks.close()
+            self.assertEqual(cache.get('export_streams_client'), 0)
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_unstarted_stream(self, search_mock):
+        cache = LocMemCache(self.id(), {})
+        with mock.patch.object(ExportRateThrottle, 'cache', cache):
+            self.assertTrue(acquire_export_stream('client'))
+            ExportStream(get_export_plan({}), 'client').close()
+            search_mock.assert_not_called()
+            self.open_point_in_time.assert_not_called()
+            self.assertEqual(cache.get('export_streams_client'), 0)
+
+
+class ExportLimitsTestCase(SimpleTestCase):
+
+    def test_rate(self):
+        cache = LocMemCache(self.id(), {})
+        request = APIRequestFactory().get('/v2/organizations/export')
+        with mock.patch.object(ExportRateThrottle, 'cache', cache), \
+                mock.patch.dict('rorapi.common.export.EXPORT', {'RATE': '1/hour'}):
+            self.assertTrue(ExportRateThrottle().allow_request(request, None))
+            throttle = ExportRateThrottle()
+            self.assertFalse(throttle.allow_request(request, None))
+            self.assertGreater(throttle.wait(), 3500)
+
+    def test_max_streams(self):
+        cache = LocMemCache(self.id(), {})
+        with mock.patch.object(ExportRateThrottle, 'cache', cache), \
+                mock.patch.dict('rorapi.common.export.EXPORT', {'MAX_STREAMS': 2}):
+            self.assertTrue(acquire_export_stream('client'))
+            self.assertTrue(acquire_export_stream('client'))
+            self.assertFalse(acquire_export_stream('client'))
+            self.assertTrue(acquire_export_stream('other-client'))
+            self.assertEqual(cache.get('export_streams_client'), 2)
+            release_export_stream('client')
+            self.assertTrue(acquire_export_stream('client'))
+            cache.clear()
+            release_export_stream('client')
+            self.assertTrue(acquire_export_stream('client'))
@@ -0,0 +1,121 @@
+import mock
+
+from django.test import SimpleTestCase
+
+from rorapi.common import facets
+from rorapi.common.facets import FACET_TABLE, FacetTable, build_facet_table, \
+    get_facet_table, get_facets, get_precomputed_facets
+
+COUNTRY_CODE = 'locations.geonames_details.country_code'
+
+
+def organization(types, countries, status='active'):
+    continents = {'US': 'NA', 'CA': 'NA', 'FR': 'EU', 'PL': 'EU'}
+    return {
+        'types': types,
+        'status': status,
+        'locations': [{'geonames_details': {'country_code': c,
+                                            'continent_code': continents[c]}}
+                      for c in countries],
+    }
+
+
+class FacetTableTestCase(SimpleTestCase):
+    def setUp(self):
+        self.table = build_facet_table([
+            organization(['education'], ['US']),
+            organization(['education'], ['US']),
+            organization(['education', 'funder'], ['US', 'CA']),
+            organization(['facility'], ['FR']),
+            organization(['facility'], ['FR'], 'inactive'),
+            organization(['company'], ['PL'], 'withdrawn'),
+        ])
+
+    def buckets(self, aggregations, name):
+        return [(b.key, b.doc_count) for b in aggregations[name].buckets]
+
+    def test_build_facet_table(self):
+        self.assertEqual(len(self.table), 5)
+        self.assertIn([['education'], ['US'], ['NA'], ['active'], 2], self.table)
+        self.assertIn([['education', 'funder'], ['CA', 'US'], ['NA'], ['active'], 1],
+                      self.table)
+
+    def test_get_facets(self):
+        aggregations = get_facets(FacetTable(self.table), [])
+        self.assertEqual(self.buckets(aggregations, 'types'), [
+            ('education', 3), ('facility', 2), ('company', 1), ('funder', 1)])
+        self.assertEqual(self.buckets(aggregations, 'countries'), [
+            ('US', 3), ('FR', 2), ('CA', 1), ('PL', 1)])
+        self.assertEqual(self.buckets(aggregations, 'continents'), [('EU', 3), ('NA', 3)])
+        self.assertEqual(self.buckets(aggregations, 'statuses'), [
+            ('active', 4), ('inactive', 1), ('withdrawn', 1)])
+
+    def test_get_facets_filters(self):
+        aggregations = get_facets(FacetTable(self.table), [('status', ('active',)),
+                                               (COUNTRY_CODE, ('CA', 'FR'))])
+        self.assertEqual(self.buckets(aggregations, 'types'), [
+            ('education', 1), ('facility', 1), ('funder', 1)])
+        self.assertEqual(self.buckets(aggregations, 'countries'), [
+            ('CA', 1), ('FR', 1), ('US', 1)])
+        aggregations = get_facets(FacetTable(self.table), [('types', ('archive',))])
+        self.assertEqual(self.buckets(aggregations, 'statuses'), [])
+
+    def test_facet_size(self):
+        table = build_facet_table(organization(['type{:02}'.format(i)], ['US'])
+                                  for i in range(15))
+        types = self.buckets(get_facets(FacetTable(table), []), 'types')
+        self.assertEqual(len(types), 10)
+        self.assertEqual(types[0], ('type00', 1))
+
+    @mock.patch('rorapi.common.facets.get_facet_table')
+    def test_get_precomputed_facets(self, table_mock):
+        table = table_mock.return_value = FacetTable(self.table)
+        filters = (('types', ('education',)),)
+        facets = get_precomputed_facets(filters)
+        self.assertEqual(self.buckets(facets, 'types'), [('education', 3), ('funder', 1)])
+        self.assertIs(get_precomputed_facets(filters), facets)
+        self.assertEqual(list(table.facets), [filters])
+        self.assertIsNone(get_precomputed_facets(
+            (('locations.geonames_details.country_name', ('France',)),)))
+        table_mock.return_value = None
+        self.assertIsNone(get_precomputed_facets(()))
+
+
+class GetFacetTableTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(FACET_TABLE, {'generation': None, 'table': None,
+                                                'checked': None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('rorapi.common.facets.get_index_generation',
+                             return_value='g1')
+        self.generation_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load(self):
+        with mock.patch('rorapi.common.facets.ES7') as es_mock:
+            es_mock.get.return_value = {'_source': {'generation': 'g1', 'table': [[[], [], [], [], 1]]}}
+            self.assertEqual(list(get_facet_table().counts), [1])
+            self.assertIs(get_facet_table(), get_facet_table())
+            es_mock.get.assert_called_once()
+
+    def test_other_generation(self):
+        with mock.patch('rorapi.common.facets.ES7') as es_mock:
+            es_mock.get.return_value = {'_source': {'generation': 'g0', 'table': [[[], [], [], [], 1]]}}
+            self.assertIsNone(get_facet_table())
+            # a missing table is not looked up on every request
+            self.assertIsNone(get_facet_table())
+            es_mock.get.assert_called_once()
+
+    def test_precompute_facets(self):
+        hits = [{'_source': organization(['education'], ['US'])}]
+        with mock.patch('rorapi.common.facets.ES7') as es_mock, \
+                mock.patch('rorapi.common.facets.scan', return_value=hits), \
+                mock.patch('rorapi.common.facets.logger'):
+            es_mock.indices.exists.return_value = True
+            self.assertTrue(facets.precompute_facets('g2'))
+            body = es_mock.index.call_args[1]['body']
+            self.assertEqual(body, {'generation': 'g2',
+                                    'table': [[['education'], ['US'], ['NA'], ['active'], 1]]})
+            es_mock.index.side_effect = Exception('ES down')
+            self.assertFalse(facets.precompute_facets('g2'))
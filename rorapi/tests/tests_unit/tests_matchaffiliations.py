@@ -0,0 +1,103 @@
+import json
+import mock
+import os
+import tempfile
+
+from io import StringIO
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from rorapi.common.models import Errors
+from rorapi.management.commands.matchaffiliations import read_affiliations
+from .utils import AttrDict
+
+
+def match(affiliations, single_search, active_only, engine):
+    return [
+        Errors(['failed']) if a == 'Gallifrey' else mock.Mock(items=[
+            AttrDict({'chosen': True, 'score': 1.0, 'matching_type': 'PHRASE',
+                      'organization': {'id': 'https://ror.org/0' + a}}),
+            AttrDict({'chosen': False, 'score': 0.5, 'matching_type': 'FUZZY',
+                      'organization': {'id': 'https://ror.org/0xyz'}})
+        ])
+        for a in affiliations
+    ]
+
+
+@mock.patch('rorapi.management.commands.matchaffiliations.match_batch',
+            side_effect=match)
+class MatchAffiliationsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def write(self, name, lines):
+        with open(self.path(name), 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return self.path(name)
+
+    def run_command(self, *args):
+        call_command('matchaffiliations', *args, '--processes', '0',
+                     '--chunk-size', '2', stdout=StringIO())
+
+    def read_output(self, name):
+        with open(self.path(name)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_read_affiliations(self, match_mock):
+        path = self.write('input.csv', ['id,affiliation', '1,"abc, def"', '', '2,ghi'])
+        records = list(read_affiliations(path, 0, 'affiliation'))
+        self.assertEqual([r[0] for r in records], ['abc, def', 'ghi'])
+        resumed = list(read_affiliations(path, records[0][1], 'affiliation'))
+        self.assertEqual(resumed, records[1:])
+
+        path = self.write('input.jsonl', ['"abc"', '{"affiliation": "def"}'])
+        self.assertEqual([r[0] for r in read_affiliations(path, 0, 'affiliation')],
+                         ['abc', 'def'])
+
+    def test_match_jsonl(self, match_mock):
+        input_path = self.write('input.jsonl', ['"abc"', '"Gallifrey"', '"def"'])
+        self.run_command(input_path, self.path('output.jsonl'))
+        output = self.read_output('output.jsonl')
+        self.assertEqual([r['record'] for r in output], [1, 2, 3])
+        self.assertEqual(output[0]['ror_ids'], ['https://ror.org/0abc'])
+        self.assertEqual(output[0]['scores'], [1.0])
+        self.assertEqual(output[0]['matching_types'], ['PHRASE'])
+        self.assertEqual(output[1]['errors'], ['failed'])
+        self.assertEqual(match_mock.call_count, 2)
+
+    def test_match_csv(self, match_mock):
+        input_path = self.write('input.csv', ['name', 'abc', 'def'])
+        self.run_command(input_path, self.path('output.csv'), '--column', 'name')
+        with open(self.path('output.csv')) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'record,affiliation,ror_ids,scores,matching_types,errors')
+        self.assertEqual(lines[2], '2,def,https://ror.org/0def,1.0,PHRASE,')
+
+    def test_resume(self, match_mock):
+        input_path = self.write('input.jsonl', ['"abc"', '"def"', '"ghi"', '"jkl"', '"mno"'])
+        output_path = self.path('output.jsonl')
+        self.run_command(input_path, output_path)
+        complete = self.read_output('output.jsonl')
+
+        # interrupted after the first chunk, with a partially written second chunk
+        with open(output_path + '.checkpoint') as f:
+            checkpoint = json.load(f)
+        lines = open(input_path, 'rb').read().splitlines(True)
+        output = open(output_path, 'rb').read().splitlines(True)
+        checkpoint.update({'input_offset': len(b''.join(lines[:2])),
+                           'output_offset': len(b''.join(output[:2])),
+                           'records': 2})
+        with open(output_path + '.checkpoint', 'w') as f:
+            json.dump(checkpoint, f)
+        with open(output_path, 'wb') as f:
+            f.write(b''.join(output[:3]) + b'{"record": 4, "affi')
+
+        match_mock.reset_mock()
+        self.run_command(input_path, output_path)
+        self.assertEqual(match_mock.call_count, 2)
+        self.assertEqual(match_mock.call_args_list[0][0][0], ['ghi', 'jkl'])
+        self.assertEqual(self.read_output('output.jsonl'), complete)
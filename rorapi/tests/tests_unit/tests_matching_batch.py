@@ -0,0 +1,145 @@
+import json
+import mock
+import os
+
+from django.test import SimpleTestCase
+
+from rorapi.common.matching import MatchedOrganization
+from rorapi.common.matching_batch import match_batch, match_organizations_batch, \
+    match_stream, parse_lines
+from rorapi.common.matching_cache import AFFILIATION_CACHE, CANDIDATE_CACHE
+from rorapi.common.models import Errors
+from rorapi.v2.models import MatchingResult
+from .utils import AttrDict
+
+
+class MatchBatchTestCase(SimpleTestCase):
+    def setUp(self):
+        for cache in [AFFILIATION_CACHE, CANDIDATE_CACHE]:
+            patcher = mock.patch.object(cache, 'max_entries', 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_retrieve_es7_v2.json'), 'r') as f:
+            self.organization = json.load(f)['hits']['hits'][0]['_source']
+        self.organization['names'] = [{'value': 'University of Excellence',
+                                       'types': ['ror_display'], 'lang': None}]
+
+    def search(self, query):
+        body = str(query.to_dict())
+        if 'match_phrase' in body and 'excellence' in body:
+            return [AttrDict(self.organization)]
+        if 'error' in body:
+            raise Exception('query failed')
+        return []
+
+    def test_validation(self):
+        errors, _ = match_organizations_batch({})
+        self.assertIsInstance(errors, Errors)
+        errors, _ = match_organizations_batch({'affiliations': []})
+        self.assertIsInstance(errors, Errors)
+        with mock.patch.dict('rorapi.common.matching_batch.MATCHING',
+                             {'BATCH_MAX_SIZE': 2}):
+            errors, _ = match_organizations_batch(
+                {'affiliations': ['a', 'b', 'c']})
+        self.assertIsInstance(errors, Errors)
+        self.assertIn('maximum is 2', errors.errors[0])
+
+    def test_match_batch(self):
+        matched = [MatchedOrganization(substring='University of Excellence',
+                                       organization=AttrDict(self.organization))]
+        with mock.patch('rorapi.common.matching.match_affiliations',
+                        return_value={'University of Excellence': matched,
+                                      'Gallifrey': Exception('failed')}) \
+                as match_mock, \
+                self.assertLogs('rorapi.common.matching_batch', 'ERROR'):
+            results = match_batch(['University of Excellence', 'Gallifrey',
+                                   ' University  of Excellence', 42, ''],
+                                  active_only=False)
+        match_mock.assert_called_once_with(
+            ['University of Excellence', 'Gallifrey'], False, None)
+        self.assertIsInstance(results[0], MatchingResult)
+        self.assertEqual(results[0].number_of_results, 1)
+        self.assertIsInstance(results[1], Errors)
+        self.assertIsInstance(results[2], MatchingResult)
+        self.assertIsInstance(results[3], Errors)
+        self.assertIsInstance(results[4], Errors)
+
+    def test_match_batch_shared_msearch(self):
+        affiliations = ['University of Excellence', 'Gallifrey',
+                        'University of Excellence, Gallifrey']
+        with mock.patch.dict('rorapi.common.matching.MATCHING',
+                             {'QUERY_EXECUTION': 'batch'}), \
+                mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                           side_effect=self.search) as search_mock, \
+                mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True,
+                           side_effect=lambda ms: [self.search(q) for q in ms._searches]) \
+                as msearch_mock:
+            results = match_batch(affiliations)
+        self.assertEqual(search_mock.call_count, 0)
+        self.assertEqual(msearch_mock.call_count, 1)
+        self.assertEqual([r.number_of_results for r in results], [1, 0, 1])
+
+        with mock.patch.dict('rorapi.common.matching.MATCHING',
+                             {'QUERY_EXECUTION': 'sequential'}), \
+                mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                           side_effect=self.search):
+            sequential = match_batch(affiliations)
+        self.assertEqual(
+            [[(i.substring, i.score) for i in r.items] for r in results],
+            [[(i.substring, i.score) for i in r.items] for r in sequential])
+
+    def test_match_batch_item_errors(self):
+        with mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                        side_effect=self.search), \
+                self.assertLogs('rorapi.common.matching_batch', 'ERROR'):
+            results = match_batch(['University of Excellence', 'Error'])
+        self.assertIsInstance(results[0], MatchingResult)
+        self.assertIsInstance(results[1], Errors)
+
+    def test_match_batch_single_search(self):
+        with mock.patch('elasticsearch_dsl.MultiSearch.execute',
+                        side_effect=Exception('msearch failed')) as msearch_mock, \
+                self.assertLogs('rorapi.common.matching_batch', 'ERROR'):
+            results = match_batch(['University of Excellence', 'Gallifrey'],
+                                  single_search=True)
+        msearch_mock.assert_called_once()
+        self.assertEqual([type(r) for r in results], [Errors, Errors])
+
+
+class MatchStreamTestCase(SimpleTestCase):
+    def test_parse_lines(self):
+        parsed = list(parse_lines([b'"University of Excellence"\n', b'\n',
+                                   b'{"affiliation": "Gallifrey"}\n',
+                                   b'{"affiliation": \n', b'42\n']))
+        self.assertEqual(parsed[0], 'University of Excellence')
+        self.assertEqual(parsed[1], 'Gallifrey')
+        self.assertIsInstance(parsed[2], Errors)
+        self.assertEqual(parsed[3], 42)
+
+    def test_match_stream(self):
+        read = []
+
+        def lines():
+            for i in range(5):
+                read.append(i)
+                yield '"affiliation {}"'.format(i) if i != 2 else 'invalid'
+
+        def match(affiliations, single_search, active_only, engine):
+            return [MatchingResult([]) for _ in affiliations]
+
+        with mock.patch.dict('rorapi.common.matching_batch.MATCHING',
+                             {'STREAM_CHUNK_SIZE': 3}), \
+                mock.patch('rorapi.common.matching_batch.match_batch',
+                           side_effect=match) as match_mock:
+            results = match_stream(lines())
+            self.assertIsInstance(next(results), MatchingResult)
+            # only the first chunk has been read and matched
+            self.assertEqual(read, [0, 1, 2])
+            match_mock.assert_called_once_with(
+                ['affiliation 0', 'affiliation 1'], False, True, None)
+            results = [next(results), next(results), next(results), next(results)]
+        self.assertEqual([type(r) for r in results],
+                         [MatchingResult, Errors, MatchingResult, MatchingResult])
+        self.assertEqual(match_mock.call_count, 2)
@@ -0,0 +1,110 @@
+import json
+import mock
+import os
+
+from django.test import SimpleTestCase
+
+from rorapi.common import matching_single_search
+from rorapi.common.matching import MatchedOrganization, MatchingGraph, \
+    get_matching_graph
+from rorapi.common.matching_cache import AFFILIATION_CACHE, CANDIDATE_CACHE
+from rorapi.common.matching_cascade import STAGE_MULTI_SEARCH, \
+    STAGE_SINGLE_SEARCH, count_multi_search_queries, get_margin, \
+    match_affiliation, match_organizations
+from rorapi.v2.serializers import MatchingResultSerializer
+from .utils import AttrDict
+
+
+def single(score, chosen=False):
+    return matching_single_search.MatchedOrganization(score=score, chosen=chosen)
+
+
+class CascadeTestCase(SimpleTestCase):
+    def setUp(self):
+        for cache in [AFFILIATION_CACHE, CANDIDATE_CACHE]:
+            patcher = mock.patch.object(cache, 'max_entries', 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict('rorapi.common.matching_cascade.MATCHING', {
+            'CASCADE_MIN_MARGIN': 0.04, 'CASCADE_QUERY_BUDGET': 60})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.multi = [MatchedOrganization(score=0.95, chosen=True)]
+
+    def match(self, single_matched, multi_queries=10):
+        with mock.patch('rorapi.common.matching_single_search.match_affiliation',
+                        return_value=single_matched), \
+                mock.patch('rorapi.common.matching.match_affiliation',
+                           return_value=self.multi) as multi_mock, \
+                mock.patch('rorapi.common.matching_cascade.count_multi_search_queries',
+                           return_value=multi_queries) as count_mock, \
+                mock.patch('rorapi.common.matching.MatchingGraph',
+                           wraps=MatchingGraph) as graph_mock:
+            stage, matched = match_affiliation('University of Excellence', True,
+                                               engine='es')
+        if stage == STAGE_MULTI_SEARCH:
+            # the graph whose queries were counted is the graph matched
+            graph = count_mock.call_args[0][0]
+            multi_mock.assert_called_once_with('University of Excellence', True,
+                                               engine='es', deadline=None, graph=graph)
+            self.assertEqual(graph_mock.call_count, 0 if graph is None else 1)
+        else:
+            multi_mock.assert_not_called()
+        return stage, matched
+
+    def test_get_margin(self):
+        self.assertIsNone(get_margin([]))
+        self.assertIsNone(get_margin([single(0.97)]))
+        self.assertEqual(get_margin([single(1.0, True)]), 1.0)
+        self.assertAlmostEqual(
+            get_margin([single(0.98, True), single(0.97), single(0.5)]), 0.01)
+
+    def test_confident(self):
+        matched = [single(1.0, True), single(0.9)]
+        self.assertEqual(self.match(matched), (STAGE_SINGLE_SEARCH, matched))
+
+    def test_no_candidate(self):
+        self.assertEqual(self.match([single(0.9)]),
+                         (STAGE_MULTI_SEARCH, self.multi))
+
+    def test_low_margin(self):
+        matched = [single(0.98, True), single(0.97)]
+        self.assertEqual(self.match(matched), (STAGE_MULTI_SEARCH, self.multi))
+
+    def test_budget(self):
+        matched = [single(0.98, True), single(0.97)]
+        # the single search query is part of the budget
+        self.assertEqual(self.match(matched, 59), (STAGE_MULTI_SEARCH, self.multi))
+        self.assertEqual(self.match(matched, 60), (STAGE_SINGLE_SEARCH, matched))
+
+    def test_count_multi_search_queries(self):
+        count = count_multi_search_queries(
+            get_matching_graph('University of Excellence, Gallifrey', True))
+        # exact match query, whole string and part nodes, acronym query
+        self.assertGreater(count, 3)
+        # the multi search result is cached
+        self.assertEqual(count_multi_search_queries(None), 0)
+
+    def test_cached_multi_search(self):
+        with mock.patch('rorapi.common.matching_cascade.is_cached', return_value=True), \
+                mock.patch('rorapi.common.matching.get_matching_graph') as graph_mock:
+            stage, _ = self.match([single(0.9)])
+        self.assertEqual(stage, STAGE_MULTI_SEARCH)
+        graph_mock.assert_not_called()
+
+    def test_stage_serialized(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               'data/test_data_retrieve_es7_v2.json')) as f:
+            organization = json.load(f)['hits']['hits'][0]
+        matched = [matching_single_search.MatchedOrganization(
+            organization=AttrDict(organization), substring='University of Excellence',
+            score=1.0, matching_type='SINGLE SEARCH', chosen=True)]
+        with mock.patch('rorapi.common.matching_single_search.match_affiliation',
+                        return_value=matched):
+            errors, result = match_organizations(
+                {'affiliation': 'University of Excellence', 'cascade': ''})
+        self.assertIsNone(errors)
+        data = MatchingResultSerializer(result).data
+        self.assertEqual(data['stage'], STAGE_SINGLE_SEARCH)
+        self.assertEqual(data['number_of_results'], 1)
+        self.assertNotIn('stage', MatchingResultSerializer(result.__class__([])).data)
@@ -0,0 +1,43 @@
+import glob
+import json
+import os
+
+from django.test import SimpleTestCase
+from fuzzywuzzy import fuzz as fuzzywuzzy_fuzz
+from rapidfuzz import fuzz as rapidfuzz_fuzz
+
+from rorapi.common import matching, matching_single_search
+from rorapi.common.matching_countries import get_country_codes_exhaustive
+
+
+def load_affiliations():
+    affiliations = []
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..',
+                                              'tests_affiliations', 'data', '*.json'))):
+        with open(path) as f:
+            for d in json.load(f):
+                affiliations.append(d['affiliation'])
+                affiliations.extend(d['affiliation'].split(',')[-2:])
+    return list(dict.fromkeys(affiliations))
+
+
+class CountryDetectorParityTestCase(SimpleTestCase):
+    EXAMPLES = ['Untied Kingdom', 'Germny', 'Dept. of Physics, Usa', 'USA', 'UK, US',
+                'Republc of Korea', 'Cote d\'Ivoire', 'korea', 'Viet Nam', '12345',
+                'Univ. of Excellence, Gallifrey', 'Perú', 'Czech Repulic']
+
+    def assert_parity(self, affiliations, countries, fuzz, detector):
+        for affiliation in affiliations + self.EXAMPLES:
+            self.assertEqual(
+                set(detector.get_country_codes(affiliation)),
+                set(get_country_codes_exhaustive(
+                    countries, affiliation, fuzz.ratio, fuzz.partial_ratio)),
+                affiliation)
+
+    def test_parity_fuzzywuzzy(self):
+        self.assert_parity(load_affiliations()[::80], matching.COUNTRIES,
+                           fuzzywuzzy_fuzz, matching.COUNTRY_DETECTOR)
+
+    def test_parity_rapidfuzz(self):
+        self.assert_parity(load_affiliations()[::16], matching_single_search.GEONAMES_COUNTRIES,
+                           rapidfuzz_fuzz, matching_single_search.COUNTRY_DETECTOR)
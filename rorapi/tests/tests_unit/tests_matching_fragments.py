@@ -0,0 +1,80 @@
+import mock
+
+from django.test import SimpleTestCase
+
+from rorapi.common.matching import MatchingGraph
+from rorapi.common.matching_fragments import FRAGMENT_ADDRESS, \
+    FRAGMENT_DEPARTMENT, FRAGMENT_ORGANIZATION, FRAGMENT_OTHER, classify_part, \
+    get_searched_parts
+
+
+class ClassifyPartTestCase(SimpleTestCase):
+    def test_address(self):
+        for part in ['kjacobs@bu.edu', 'USA hzheng1@partners.org', '2809 Emerywood Parkway',
+                     'Kerpener Straße 62', 'Madingley Road', 'P.O. Box 118', 'Suite 500',
+                     '69120 Heidelberg', 'Sapporo 060-8556', 'CA 94303', 'Oxford OX1 3QT',
+                     'SW7 5BD', '100871', 'Kolkata 700 032']:
+            self.assertEqual(classify_part(part), FRAGMENT_ADDRESS, part)
+
+    def test_organization(self):
+        for part in ['University of Excellence', 'Université Paris 8', 'Inserm U1016',
+                     'Norwegian Defence Research Establishment therese@ffi.no',
+                     'Department of Anthropology University of Colorado Denver',
+                     'Department of Laboratory Medicine']:
+            self.assertEqual(classify_part(part), FRAGMENT_ORGANIZATION, part)
+
+    def test_department(self):
+        for part in ['Department of Physics', 'Dept of Physiology',
+                     'Dipartimento di Farmacologia', 'Departamento de Zootecnia']:
+            self.assertEqual(classify_part(part), FRAGMENT_DEPARTMENT, part)
+        for part in ['Department of Energy', 'Department of Veterans Affairs',
+                     'Department of the Interior', 'Department of Defence']:
+            self.assertEqual(classify_part(part), FRAGMENT_ORGANIZATION, part)
+
+    def test_other(self):
+        for part in ['NSTDA', 'I3S', 'Gallifrey', 'Weill Cornell Medicine',
+                     'Division of Cardiology', '3M', 'Stop 817-01 Gaithersburg',
+                     'CSIRO Agriculture and Food 203 Tor Street Toowoomba QLD 4350 Australia']:
+            self.assertEqual(classify_part(part), FRAGMENT_OTHER, part)
+
+    def test_get_searched_parts(self):
+        self.assertEqual(
+            get_searched_parts(['Department of Physics', 'University of Excellence',
+                                '69120 Heidelberg', 'Germany']),
+            ['University of Excellence', 'Germany'])
+        # a department is searched when no other part names an organization
+        self.assertEqual(
+            get_searched_parts(['Department of Energy', '1000 Independence Ave',
+                                'Washington DC']),
+            ['Department of Energy', 'Washington DC'])
+        # government departments are organizations
+        self.assertEqual(
+            get_searched_parts(['Office of Science', 'Department of Energy',
+                                'Washington DC']),
+            ['Office of Science', 'Department of Energy', 'Washington DC'])
+        self.assertEqual(
+            get_searched_parts(['Department of Veterans Affairs', 'Boston', 'MA',
+                                'USA', 'Harvard Medical School']),
+            ['Department of Veterans Affairs', 'Boston', 'MA', 'USA',
+             'Harvard Medical School'])
+        # departments are only dropped next to the organizations they
+        # belong to
+        self.assertEqual(
+            get_searched_parts(['Department of Physics', 'Acme Services Inc']),
+            ['Department of Physics', 'Acme Services Inc'])
+
+
+class MatchingGraphFragmentsTestCase(SimpleTestCase):
+    def test_graph_nodes(self):
+        affiliation = 'Department of Physics, University of Excellence, 69120 Heidelberg'
+        with mock.patch.dict('rorapi.common.matching.MATCHING',
+                             {'FRAGMENT_CLASSIFIER': True}):
+            nodes = [n.text for n in MatchingGraph(affiliation).nodes]
+        self.assertEqual(nodes, ['Department of Physics University of Excellence  Heidelberg',
+                                 'University of Excellence'])
+        with mock.patch.dict('rorapi.common.matching.MATCHING',
+                             {'FRAGMENT_CLASSIFIER': False}):
+            nodes = [n.text for n in MatchingGraph(affiliation).nodes]
+        self.assertEqual(nodes, ['Department of Physics University of Excellence  Heidelberg',
+                                 'Department of Physics', 'University of Excellence',
+                                 ' Heidelberg'])
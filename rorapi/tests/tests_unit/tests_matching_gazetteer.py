@@ -0,0 +1,38 @@
+import mock
+
+from django.test import SimpleTestCase
+
+from rorapi.common import matching_gazetteer
+from rorapi.common.matching import check_do_not_match, get_queries_by_type, \
+    MATCHING_TYPE_ACRONYM
+from rorapi.common.matching_gazetteer import Gazetteer, get_gazetteer
+
+
+class GazetteerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.gazetteer = Gazetteer(
+            [{'name': 'Gallifrey', 'iso': 'GF', 'iso3': 'GLF'}],
+            [{'name': 'Arcadia'}, {'name': 'Citadel'}])
+
+    def test_lookups(self):
+        self.assertTrue(self.gazetteer.is_country('gallifrey'))
+        self.assertTrue(self.gazetteer.is_country('Gf'))
+        self.assertTrue(self.gazetteer.is_country('GLF'))
+        self.assertFalse(self.gazetteer.is_country('Arcadia'))
+        self.assertTrue(self.gazetteer.is_city('ARCADIA'))
+        self.assertTrue(self.gazetteer.is_iso3('glf'))
+        self.assertFalse(self.gazetteer.is_iso3('GF'))
+        self.assertGreater(self.gazetteer.get_memory_size(), 0)
+
+    def test_shared_by_matching(self):
+        with mock.patch.dict(matching_gazetteer.GAZETTEER, {'gazetteer': self.gazetteer}):
+            self.assertTrue(check_do_not_match('Citadel'))
+            self.assertFalse(check_do_not_match('Mexico'))
+            queries = get_queries_by_type('GLF TARDIS Institute', MATCHING_TYPE_ACRONYM)
+            self.assertEqual([s for s, _ in queries], ['TARDIS'])
+
+    def test_lazy_loading(self):
+        with mock.patch.dict(matching_gazetteer.GAZETTEER, {'gazetteer': None}):
+            gazetteer = get_gazetteer()
+            self.assertIs(get_gazetteer(), gazetteer)
+            self.assertTrue(gazetteer.is_city('Bordeaux'))
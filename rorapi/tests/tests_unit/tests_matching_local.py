@@ -0,0 +1,161 @@
+import copy
+import json
+import mock
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from rorapi.common import matching, matching_single_search
+from rorapi.common.es_utils import COUNTRY_CODE_FIELD
+from rorapi.common.matching_cache import AFFILIATION_CACHE
+from rorapi.common.matching_local import LocalIndex, analyze, get_engine, \
+    get_local_index, load_local_index
+
+
+class LocalIndexTestCase(SimpleTestCase):
+    def organization(self, id, names, country_code='US', status='active'):
+        org = copy.deepcopy(self.template)
+        org['id'] = 'https://ror.org/' + id
+        org['status'] = status
+        org['names'] = [{'value': n, 'types': ['acronym'] if n.isupper() else ['label'],
+                         'lang': None} for n in names]
+        org['names'][0]['types'] = ['ror_display', 'label']
+        org['locations'][0]['geonames_details']['country_code'] = country_code
+        org['external_ids'] = []
+        org['relationships'] = []
+        return org
+
+    def setUp(self):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_retrieve_es7_v2.json'), 'r') as f:
+            self.template = json.load(f)['hits']['hits'][0]['_source']
+        self.index = LocalIndex([
+            self.organization('01', ['University of Excellence', 'UE']),
+            self.organization('02', ['Excellence Institute of Technology']),
+            self.organization('03', ['Université de Créativité'], 'FR'),
+            self.organization('04', ['Institute of Technology'], status='inactive'),
+            self.organization('05', ['Gallifrey Academy'], 'PL'),
+        ])
+        patcher = mock.patch('rorapi.common.matching_local.LOCAL_INDEX',
+                             {'index': self.index})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(AFFILIATION_CACHE, 'max_entries', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ids(self, hits):
+        return [h.meta.id[-2:] for h in hits]
+
+    def test_analyze(self):
+        self.assertEqual(analyze('Université de Créativité, Paris'),
+                         ('universite', 'de', 'creativite', 'paris'))
+        self.assertEqual(analyze('北京大学'), ('北', '京', '大', '学'))
+
+    def test_phrase(self):
+        self.assertEqual(self.ids(self.index.search_names(
+            'phrase', 'university of excellence')), ['01'])
+        self.assertEqual(self.ids(self.index.search_names(
+            'phrase', 'institute of technology')), ['04', '02'])
+        self.assertEqual(self.index.search_names('phrase', 'excellence university'), [])
+
+    def test_common(self):
+        hits = self.index.search_names('common', 'excellence institute')
+        self.assertEqual(set(self.ids(hits)), {'01', '02', '04'})
+        self.assertEqual(self.ids(hits)[0], '02')
+
+    def test_fuzzy(self):
+        self.assertEqual(self.ids(self.index.search_names(
+            'fuzzy', 'galifrey acadamy')), ['05'])
+        self.assertEqual(self.index.search_names('fuzzy', 'xyz'), [])
+
+    def test_exact(self):
+        self.assertEqual(self.ids(self.index.search_names_ids(
+            'Universite de Creativite')), ['03'])
+        self.assertEqual(self.ids(self.index.search_names_ids(
+            'https://ror.org/05')), ['05'])
+        self.assertEqual(self.index.search_names_ids('Creativite Universite'), [])
+
+    def test_affiliation(self):
+        hits = self.index.search_affiliation('University of Excellence, UE', 2)
+        self.assertEqual([h['_id'][-2:] for h in hits.hits.hits], ['01', '02'])
+        names = hits.hits.hits[0]['_source']['affiliation_match']['names']
+        self.assertEqual([n['name'] for n in names], ['University of Excellence'])
+        self.assertEqual(names[0]['normalized'], 'university of excellence')
+
+    def test_filters(self):
+        self.assertEqual(self.ids(self.index.search_names(
+            'phrase', 'institute of technology', filters=(('status', ('active',)),))),
+            ['02'])
+        self.assertEqual(self.ids(self.index.search_names(
+            'common', 'excellence universite',
+            filters=((COUNTRY_CODE_FIELD, ('FR', 'PL')),))), ['03'])
+        self.assertEqual(self.index.search_names_ids(
+            'https://ror.org/05', filters=((COUNTRY_CODE_FIELD, ('US',)),)), [])
+        hits = self.index.search_affiliation(
+            'Institute of Technology', 2, filters=(('status', ('inactive',)),))
+        self.assertEqual([h['_id'][-2:] for h in hits.hits.hits], ['04'])
+
+    @mock.patch.dict('rorapi.common.matching.MATCHING', {'PUSHDOWN': 'filter'})
+    def test_match_affiliation_pushdown(self):
+        matched = matching.match_affiliation(
+            'Department of Physics, University of Excellence, USA', True,
+            engine='local')
+        chosen = [m for m in matched if m.chosen]
+        self.assertEqual([m.organization.id for m in chosen], ['https://ror.org/01'])
+        self.assertNotIn('https://ror.org/03', [m.organization.id for m in matched])
+
+    def test_get_organizations(self):
+        organizations = self.index.get_organizations(
+            ['https://ror.org/01', 'https://ror.org/99'], False)
+        self.assertEqual(list(organizations), ['https://ror.org/01'])
+        self.assertEqual(organizations['https://ror.org/01'].names[0].value,
+                         'University of Excellence')
+
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_match_affiliation(self, search_mock):
+        matched = matching.match_affiliation(
+            'Department of Physics, University of Excellence, USA', True,
+            engine='local')
+        chosen = [m for m in matched if m.chosen]
+        self.assertEqual([m.organization.id for m in chosen], ['https://ror.org/01'])
+
+        matched = matching_single_search.match_affiliation(
+            'Université de Créativité', engine='local')
+        self.assertEqual(matched[0].organization['_id'], 'https://ror.org/03')
+        self.assertTrue(matched[0].chosen)
+        search_mock.assert_not_called()
+
+    def test_unknown_engine(self):
+        errors, _ = matching.match_organizations(
+            {'affiliation': 'University of Excellence', 'engine': 'solr'})
+        self.assertIn('solr', errors.errors[0])
+
+    def test_local_engine_not_available(self):
+        with mock.patch('rorapi.common.matching_local.LOCAL_INDEX', {'index': None}):
+            for match_organizations in [matching.match_organizations,
+                                        matching_single_search.match_organizations]:
+                errors, _ = match_organizations(
+                    {'affiliation': 'University of Excellence', 'engine': 'local'})
+                self.assertEqual(errors.errors,
+                                 ['Matching engine local is not available'])
+            self.assertEqual(get_engine('es'), 'es')
+            self.assertRaises(ValueError, get_local_index)
+
+    def test_load_local_index(self):
+        local_index = {'index': None}
+        with mock.patch('rorapi.common.matching_local.LOCAL_INDEX', local_index):
+            with mock.patch.dict('rorapi.common.matching_local.MATCHING',
+                                 {'LOCAL_DUMP': None}):
+                self.assertIsNone(load_local_index())
+            with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+                json.dump([self.organization('01', ['University of Excellence'])], f)
+                f.flush()
+                with mock.patch.dict('rorapi.common.matching_local.MATCHING',
+                                     {'LOCAL_DUMP': f.name}):
+                    index = load_local_index()
+            self.assertEqual(index.ids, ['https://ror.org/01'])
+            self.assertIs(get_local_index(), index)
+            self.assertEqual(get_engine('local'), 'local')
@@ -0,0 +1,46 @@
+import glob
+import json
+import os
+import random
+import re
+
+from django.test import SimpleTestCase
+
+from rorapi.common.matching_names import check_latin_chars, normalize, \
+    normalize_reference
+
+DATA_DIR = os.path.dirname(__file__)
+
+
+def load_corpus():
+    corpus = []
+    for path in glob.glob(os.path.join(DATA_DIR, '..', 'tests_affiliations', 'data', '*.json')):
+        with open(path) as f:
+            for d in json.load(f):
+                corpus.append(d['affiliation'])
+                corpus.extend(d['affiliation'].split(','))
+    for path in glob.glob(os.path.join(DATA_DIR, 'data', '*.json')):
+        with open(path) as f:
+            corpus.extend(re.findall(r'"value": "((?:[^"\\]|\\.)*)"', f.read()))
+    return corpus
+
+
+class NormalizeParityTestCase(SimpleTestCase):
+    def test_corpus(self):
+        corpus = load_corpus()
+        self.assertGreater(len(corpus), 10000)
+        for s in corpus:
+            self.assertEqual(normalize(s), normalize_reference(s), s)
+
+    def test_abbreviation_combinations(self):
+        tokens = ['u', '.', ' ', 's', 'univ', 'lab', 'inst', 'tech', '&', 'amp;',
+                  'the', 'x', 'é', '北', 'U', '-', 'Univ.', '&amp;']
+        rng = random.Random(0)
+        for _ in range(20000):
+            s = ''.join(rng.choice(tokens) for _ in range(rng.randint(1, 8)))
+            self.assertEqual(normalize(s), normalize_reference(s), s)
+
+    def test_check_latin_chars(self):
+        self.assertTrue(check_latin_chars('University of Excellence'))
+        self.assertTrue(check_latin_chars('Université 1'))
+        self.assertFalse(check_latin_chars('Université 北京'))
@@ -0,0 +1,167 @@
+import json
+import mock
+import os
+import random
+
+from django.test import SimpleTestCase
+from elasticsearch_dsl.utils import AttrDict
+from rapidfuzz import fuzz
+
+from rorapi.common.matching_cache import AFFILIATION_CACHE
+from rorapi.common.matching_single_search import MatchedOrganization, \
+    MATCHING_TYPE_SINGLE, MIN_SCORE, choose_candidate, match_affiliation, \
+    normalize, rescore, score_candidates
+
+
+def score_pairwise(aff, candidate):
+    # scoring before the names were scored with cdist
+    best = MatchedOrganization(organization=candidate, name='', score=0, rescore=0,
+                               start=-1, end=-1, matching_type=MATCHING_TYPE_SINGLE,
+                               substring=aff, chosen=False)
+    for candidate_name in candidate['_source']['affiliation_match']['names']:
+        name = candidate_name['name']
+        if (name.lower() in ['university school', 'university hospital']
+                or len(name) >= len(aff) + 4 or len(name) < 5
+                or (' ' not in name and aff.lower() != name.lower())
+                or (' ' not in aff and aff.lower() != name.lower())):
+            continue
+        alignment = fuzz.partial_ratio_alignment(normalize(aff), normalize(name))
+        if alignment.score > best.score:
+            best = best._replace(name=name, score=alignment.score,
+                                 rescore=alignment.score, start=alignment.src_start,
+                                 end=alignment.src_end)
+    return best
+
+
+def is_better_pairwise(aff, candidate, other):
+    score = 0
+    if 'univ' in candidate.name.lower() and 'univ' not in other.name.lower():
+        score += 1
+    if 'univ' not in candidate.name.lower() and 'univ' in other.name.lower():
+        score -= 1
+    c_diff = abs(len(candidate.name) - len(aff))
+    o_diff = abs(len(other.name) - len(aff))
+    if o_diff - c_diff > 4:
+        score += 1
+    if c_diff - o_diff > 4:
+        score -= 1
+    if candidate.start > other.end:
+        score += 1
+    if other.start > candidate.end:
+        score -= 1
+    if candidate.score > 99 and other.score < 99:
+        score += 1
+    if candidate.score < 99 and other.score > 99:
+        score -= 1
+    return score > 0
+
+
+def choose_pairwise(aff, candidates):
+    rescored = [c._replace(rescore=sum(is_better_pairwise(aff, c, o) for o in candidates))
+                for c in candidates]
+    top_score = max(c.rescore for c in rescored)
+    top_scored = [c for c in rescored if c.rescore == top_score]
+    if len(top_scored) == 1:
+        return rescored, top_scored[0]
+    matched = None
+    for c in top_scored:
+        if not any(c.organization['_id'] != o.organization['_id']
+                   and (c.start <= o.start <= c.end or c.start <= o.end <= c.end
+                        or o.start <= c.start <= o.end or o.start <= c.end <= o.end)
+                   for o in top_scored):
+            matched = c
+    return rescored, matched
+
+
+class SingleSearchScoringParityTestCase(SimpleTestCase):
+    def test_parity_with_pairwise_scoring(self):
+        with open(os.path.join(os.path.dirname(__file__), '..', 'tests_affiliations',
+                               'data', 'dataset_affiliations_crossref_2024_02_19.json')) as f:
+            affiliations = [d['affiliation'] for d in json.load(f)]
+        parts = [p.strip() for a in affiliations for p in a.split(',') if p.strip()]
+        rng = random.Random(0)
+        for aff in affiliations[:300]:
+            own = [p.strip() for p in aff.split(',') if p.strip()]
+            candidates = [
+                AttrDict({'_id': 'https://ror.org/0{}'.format(i % 40),
+                          '_source': {'affiliation_match': {'names': [
+                              {'name': n} for n in rng.sample(own + parts[:500], 3)]}}})
+                for i in range(60)]
+            scored = score_candidates(aff, candidates)
+            self.assertEqual(scored, [score_pairwise(aff, c) for c in candidates])
+            scored = [s for s in scored if s.score >= MIN_SCORE]
+            # the spans of the candidates scoring less are not computed
+            self.assertEqual(
+                [s for s in score_candidates(aff, candidates, min_alignment_score=MIN_SCORE)
+                 if s.score >= MIN_SCORE], scored)
+            if scored:
+                expected_rescored, expected = choose_pairwise(aff, scored)
+                rescored = rescore(aff, scored)
+                self.assertEqual(rescored, expected_rescored)
+                self.assertEqual(choose_candidate(rescored), expected)
+
+
+def lean_hit(id, names, status='active', offsets=None):
+    if offsets is None:
+        offsets = range(len(names))
+    return {
+        '_id': 'https://ror.org/' + id,
+        '_source': {
+            'status': status,
+            'locations': [{'geonames_details': {'country_code': 'US'}}]
+        },
+        'inner_hits': {
+            'affiliation_match.names': {
+                'hits': {'hits': [
+                    {'_nested': {'field': 'affiliation_match.names', 'offset': o},
+                     '_source': {'name': n}}
+                    for n, o in zip(names, offsets)]}
+            }
+        }
+    }
+
+
+class LeanCandidatesTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(AFFILIATION_CACHE, 'max_entries', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_score_inner_hits(self):
+        scored = score_candidates('University of Excellence', [
+            AttrDict(lean_hit('01', ['University of Excellence'])),
+            AttrDict(lean_hit('02', []))])
+        self.assertEqual([s.score for s in scored], [100, 0])
+
+    def test_score_inner_hits_order(self):
+        # equal scores are broken by the order of the names in the record,
+        # not by the order of the inner hits
+        aff = 'University of Excellence'
+        full = score_candidates(aff, [AttrDict({'_id': 'https://ror.org/01', '_source': {
+            'status': 'active',
+            'locations': [{'geonames_details': {'country_code': 'US'}}],
+            'affiliation_match': {'names': [{'name': 'Univ. of Excellence'},
+                                            {'name': 'University of Excellence'}]}}})])
+        lean = score_candidates(aff, [AttrDict(lean_hit(
+            '01', ['University of Excellence', 'Univ. of Excellence'], offsets=[1, 0]))])
+        self.assertEqual(full[0].score, lean[0].score)
+        self.assertEqual(lean[0].name, 'Univ. of Excellence')
+        self.assertEqual(lean[0].name, full[0].name)
+
+    @mock.patch('rorapi.common.matching_single_search.get_organizations')
+    def test_hydrate_output(self, get_organizations_mock):
+        full = AttrDict({'_id': 'https://ror.org/01',
+                         '_source': {'id': 'https://ror.org/01', 'name': 'full record'}})
+        get_organizations_mock.return_value = {'https://ror.org/01': full}
+        results = AttrDict({'hits': {'hits': [
+            lean_hit('01', ['University of Excellence']),
+            lean_hit('02', ['Excellence University Hospital'])]}})
+
+        matched = match_affiliation('University of Excellence', results=results)
+        get_organizations_mock.assert_called_once_with({'https://ror.org/01'}, True, 'es')
+        self.assertEqual([m.organization for m in matched], [full])
+        self.assertTrue(matched[0].chosen)
+
+        # organizations that no longer exist are dropped
+        get_organizations_mock.return_value = {}
+        self.assertEqual(match_affiliation('University of Excellence', results=results), [])
@@ -1,9 +1,23 @@
+import json
+import mock
+import os
+import re
+
 from django.test import SimpleTestCase
 
+from fuzzywuzzy import fuzz
 from rorapi.common.matching import load_geonames_countries, load_geonames_cities, load_countries, to_region, get_country_codes, \
-    get_countries, normalize, MatchedOrganization, get_similarity, get_score, \
+    get_countries, normalize, MatchedOrganization, get_similarity, get_similarities, get_score, \
     MatchingNode, clean_search_string, check_do_not_match, MatchingGraph, get_output, \
-    check_exact_match, MATCHING_TYPE_PHRASE, MATCHING_TYPE_COMMON, MATCHING_TYPE_FUZZY
+    check_exact_match, match_affiliation, match_organizations, QueryExecutor, \
+    BatchQueryExecutor, ConcurrentQueryExecutor, Deadline, get_deadline, \
+    build_query, get_graph_queries, get_matching_graph, get_query_constraints, \
+    match_affiliations, NO_CONSTRAINTS, \
+    MATCHING_TYPE_PHRASE, MATCHING_TYPE_COMMON, MATCHING_TYPE_FUZZY
+from rorapi.common.matching import NODE_MATCHING_TYPES
+from rorapi.common.matching_cache import AFFILIATION_CACHE, CANDIDATE_CACHE
+from rorapi.common.matching_names import NAMES_VERSION, get_matching_names
+from rorapi.v2.models import MatchingResult
 from .utils import AttrDict
 
 
@@ -374,6 +388,54 @@ class SimilarityTestCase(SimpleTestCase):
                          locations=[{'geonames_details': {'country_code': 'AV'}}])), 'UEXC', ['US-PR']),
             0)
 
+    def test_get_score_indexed_forms(self):
+        names = get_matching_names(['University of Excellence'])
+        names[0]['sorted'] = 'excellence of university brilliance'
+        candidate = {
+            'names': [{'value': 'University of Excellence', 'types': ['ror_display']}],
+            'locations': [{'geonames_details': {'country_code': 'XY'}}],
+            'affiliation_match': {'names': names, 'names_version': NAMES_VERSION}
+        }
+        # the forms stored in the index are used instead of being computed
+        self.assertEqual(
+            get_score(AttrDict(candidate), 'University of Excellence', None), 0.81)
+        # documents indexed with an older version of the forms fall back
+        candidate['affiliation_match']['names_version'] = NAMES_VERSION - 1
+        self.assertEqual(
+            get_score(AttrDict(candidate), 'University of Excellence', None), 1)
+
+
+class ScoringParityTestCase(SimpleTestCase):
+    DATASETS = ['dataset_affiliations_springer_2023_10_31.json',
+                'dataset_affiliations_crossref_2024_02_19.json']
+
+    def reference_similarity(self, aff_sub, cand_name):
+        # pairwise fuzzywuzzy scoring, as done before vectorization
+        aff_sub = normalize(aff_sub)
+        cand_name = normalize(cand_name)
+        if '(' in aff_sub or ')' in aff_sub or '-' in aff_sub or len(
+                [s for s in ['university', 'college', 'school', 'department',
+                             'institute', 'center', 'hospital'] if s in aff_sub]) > 1:
+            comparison_function = fuzz.partial_ratio
+        else:
+            comparison_function = fuzz.token_sort_ratio
+        cand_name = re.sub(r'\(.*\)', '', cand_name).strip()
+        return comparison_function(aff_sub, cand_name) / 100
+
+    def test_parity_with_pairwise_scoring(self):
+        for dataset in self.DATASETS:
+            with open(os.path.join(os.path.dirname(__file__), '..',
+                                   'tests_affiliations', 'data', dataset)) as f:
+                affiliations = [d['affiliation'] for d in json.load(f)]
+            substrings = [s.strip() for a in affiliations for s in a.split(',')
+                          if s.strip()]
+            for i in range(0, min(len(substrings), 4000), 40):
+                aff_sub = substrings[i]
+                cand_names = substrings[i + 1:i + 41]
+                self.assertEqual(
+                    get_similarities(aff_sub, cand_names),
+                    [self.reference_similarity(aff_sub, c) for c in cand_names])
+
 
 class TestMatchingNode(SimpleTestCase):
 
@@ -526,4 +588,235 @@ class TestGenerateOutput(SimpleTestCase):
             get_output(
                 [c1, c2],
                 [m1, m2, m3, m4, m5, m6, m7, m8, m9, m10, m11, m12, m13], False),
-            [c1_ch, m4, m10, m7])
\ No newline at end of file
+            [c1_ch, m4, m10, m7])
+
+class TestQueryExecution(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(CANDIDATE_CACHE, 'max_entries', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def candidate(self, id, name, country_code='US', status='active'):
+        return AttrDict({
+            'id': id,
+            'status': status,
+            'names': [{'value': name, 'types': ['ror_display']}],
+            'locations': [{'geonames_details': {'country_code': country_code}}]
+        })
+
+    def search(self, query):
+        # candidates depend on the query, so that different queries
+        # produce different matches
+        body = str(query.to_dict())
+        if 'match_phrase' in body:
+            return [self.candidate('org1', 'University of Excellence')]
+        if 'common' in body:
+            return [self.candidate('org1', 'University of Excellence'),
+                    self.candidate('org2', 'Creativity Institute')]
+        if 'fuzziness' in body:
+            return [self.candidate('org3', 'Creativity Institute', 'PL')]
+        return []
+
+    def match(self, affiliation, query_execution):
+        with mock.patch.dict('rorapi.common.matching.MATCHING',
+                             {'QUERY_EXECUTION': query_execution}), \
+                mock.patch.object(AFFILIATION_CACHE, 'max_entries', 0), \
+                mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                           side_effect=self.search) as search_mock, \
+                mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True,
+                           side_effect=lambda ms: [self.search(q) for q in ms._searches]) \
+                as msearch_mock:
+            matched = match_affiliation(affiliation, True)
+        return matched, search_mock.call_count, msearch_mock.call_count
+
+    def test_batch_same_as_sequential(self):
+        for affiliation in ['University of Excellence',
+                            'University of Excellence, Creativity Institute, USA',
+                            'Creativity Institute; Gallifrey: Outerspace']:
+            sequential, search_calls, msearch_calls = \
+                self.match(affiliation, 'sequential')
+            self.assertTrue(search_calls > 1)
+            self.assertEqual(msearch_calls, 0)
+
+            batch, search_calls, msearch_calls = \
+                self.match(affiliation, 'batch')
+            self.assertEqual(search_calls, 0)
+            self.assertEqual(msearch_calls, 1)
+            self.assertEqual(batch, sequential)
+
+    def test_concurrent_same_as_sequential(self):
+        for affiliation in ['University of Excellence',
+                            'University of Excellence, Creativity Institute, USA',
+                            'Creativity Institute; Gallifrey: Outerspace']:
+            sequential, _, _ = self.match(affiliation, 'sequential')
+            concurrent, search_calls, msearch_calls = \
+                self.match(affiliation, 'concurrent')
+            self.assertTrue(search_calls > 1)
+            self.assertEqual(msearch_calls, 0)
+            self.assertEqual(concurrent, sequential)
+
+    def test_concurrent_graph_ordering(self):
+        affiliation = 'University of Excellence, Creativity Institute, ' + \
+            'School of Brilliance, Gallifrey'
+        with mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                        side_effect=self.search):
+            sequential = MatchingGraph(affiliation).match(
+                ['US-PR'], 0.9, QueryExecutor())
+            for _ in range(5):
+                concurrent = MatchingGraph(affiliation).match(
+                    ['US-PR'], 0.9, ConcurrentQueryExecutor())
+                self.assertEqual(concurrent, sequential)
+
+    def test_query_memo(self):
+        # two identical nodes, the heuristics queries repeat the common
+        # terms query, so only the exact, phrase, common and fuzzy queries
+        # are sent to ES
+        for executor in [QueryExecutor(), BatchQueryExecutor(),
+                         ConcurrentQueryExecutor()]:
+            with mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                            side_effect=self.search) as search_mock:
+                check_exact_match('University of Excellence', [], executor)
+                MatchingGraph('University of Excellence').match(
+                    [], 0.9, executor)
+            self.assertEqual(search_mock.call_count, 4)
+            self.assertEqual(executor.executed, 4)
+            self.assertEqual(executor.saved, 7)
+
+    def test_query_memo_prefetch(self):
+        executor = BatchQueryExecutor()
+        graph = MatchingGraph('University of Excellence')
+        with mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True,
+                        side_effect=lambda ms: [self.search(q) for q in ms._searches]) \
+                as msearch_mock:
+            executor.prefetch(graph.get_queries())
+            graph.match([], 0.9, executor)
+        msearch_mock.assert_called_once()
+        self.assertEqual(executor.executed, 3)
+        self.assertEqual(executor.saved, 7)
+
+    def test_batch_graph_built_once(self):
+        affiliations = ['University of Excellence, Creativity Institute, USA',
+                        'Creativity Institute; Gallifrey: Outerspace']
+        expected = {a: self.match(a, 'sequential')[0] for a in affiliations}
+        with mock.patch.dict('rorapi.common.matching.MATCHING',
+                             {'QUERY_EXECUTION': 'batch'}), \
+                mock.patch.object(AFFILIATION_CACHE, 'max_entries', 0), \
+                mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True,
+                           side_effect=lambda ms: [self.search(q) for q in ms._searches]), \
+                mock.patch('rorapi.common.matching.MatchingGraph',
+                           wraps=MatchingGraph) as graph_mock, \
+                mock.patch('rorapi.common.matching.get_countries',
+                           wraps=get_countries) as countries_mock:
+            results = match_affiliations(affiliations, True)
+        self.assertEqual(results, expected)
+        # the graphs collecting the queries are the graphs matched
+        self.assertEqual(graph_mock.call_count, 2)
+        self.assertEqual(countries_mock.call_count, 2)
+
+
+class TestDeadline(TestQueryExecution):
+    def expiring_after(self, checks):
+        deadline = Deadline(10)
+        deadline.expired = mock.Mock(side_effect=lambda: deadline.expired.call_count > checks)
+        return deadline
+
+    def test_deadline(self):
+        self.assertFalse(Deadline().expired())
+        self.assertFalse(Deadline(0).expired())
+        self.assertFalse(Deadline(10).expired())
+        self.assertTrue(Deadline(1e-9).expired())
+
+    def test_get_deadline(self):
+        with mock.patch.dict('rorapi.common.matching.MATCHING', {'DEADLINE': 2}):
+            self.assertIsNotNone(get_deadline({}).end)
+            self.assertIsNone(get_deadline({'deadline': '0'}).end)
+            for invalid in ['', 'soon', '-1', 'nan', 'inf', '-inf', 'Infinity']:
+                with self.assertRaises(ValueError):
+                    get_deadline({'deadline': invalid})
+        errors, _ = match_organizations({'affiliation': 'University of Excellence',
+                                         'deadline': 'nan'})
+        self.assertEqual(errors.errors,
+                         ["'deadline' must be a non-negative number of seconds, got 'nan'"])
+
+    def test_graph_skips_after_deadline(self):
+        affiliation = 'University of Excellence, Creativity Institute, Gallifrey'
+        with mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                        side_effect=self.search):
+            complete = MatchingGraph(affiliation).match(['US-PR'], 0.9, QueryExecutor(), Deadline(10))
+            deadline = self.expiring_after(0)
+            self.assertEqual(MatchingGraph(affiliation).match(
+                ['US-PR'], 0.9, QueryExecutor(), deadline), ([], []))
+            self.assertTrue(deadline.hit)
+
+            # only the whole string node is matched
+            deadline = self.expiring_after(len(NODE_MATCHING_TYPES))
+            chosen, all_matched = MatchingGraph(affiliation).match(
+                ['US-PR'], 0.9, QueryExecutor(), deadline)
+        self.assertTrue(deadline.hit)
+        self.assertEqual([m.substring for m in chosen], ['University of Excellence Creativity Institute Gallifrey'])
+        self.assertLess(len(all_matched), len(complete[1]))
+
+    def test_partial_result_not_cached(self):
+        affiliation = 'University of Excellence, Creativity Institute'
+        for deadline, cached in [(self.expiring_after(2), False), (Deadline(10), True)]:
+            with mock.patch.object(AFFILIATION_CACHE, 'set') as set_mock, \
+                    mock.patch('elasticsearch_dsl.Search.execute', autospec=True,
+                               side_effect=self.search):
+                match_affiliation(affiliation, True, deadline=deadline)
+            self.assertEqual(deadline.hit, not cached)
+            self.assertEqual(set_mock.called, cached)
+
+    def test_partial_flag(self):
+        self.assertTrue(MatchingResult([], partial=True).partial)
+        self.assertFalse(hasattr(MatchingResult([]), 'partial'))
+        with mock.patch('rorapi.common.matching.match_affiliation', return_value=[]) as match_mock:
+            errors, result = match_organizations({'affiliation': 'University of Excellence',
+                                                  'deadline': '1.5'})
+        self.assertIsNone(errors)
+        self.assertIsNotNone(match_mock.call_args[1]['deadline'].end)
+        errors, _ = match_organizations({'affiliation': 'University of Excellence',
+                                         'deadline': 'soon'})
+        self.assertIsNotNone(errors)
+
+
+class TestPushdown(TestQueryExecution):
+    def pushdown(self, mode):
+        return mock.patch.dict('rorapi.common.matching.MATCHING', {'PUSHDOWN': mode})
+
+    def test_get_query_constraints(self):
+        constraints = [('locations.geonames_details.country_code', ('PR', 'US')),
+                       ('status', ('active',))]
+        with self.pushdown('off'):
+            self.assertEqual(get_query_constraints(['US-PR'], True), NO_CONSTRAINTS)
+        with self.pushdown('filter'):
+            self.assertEqual(list(get_query_constraints(['US-PR'], True).filters),
+                             constraints)
+            self.assertEqual(get_query_constraints([], False), NO_CONSTRAINTS)
+        with self.pushdown('boost'):
+            constraints = get_query_constraints(['US-PR'], True)
+        self.assertEqual(constraints.filters, ())
+        self.assertEqual(len(constraints.boosts), 2)
+
+    def test_build_query(self):
+        for mode in ['filter', 'boost']:
+            with self.pushdown(mode):
+                query = get_graph_queries(
+                    get_matching_graph('University of Excellence, USA', True))[1]
+            body = build_query(query).to_dict()['query']['bool']
+            clause = body['filter' if mode == 'filter' else 'should']
+            self.assertIn({'terms': {'status': ['active']}} if mode == 'filter' else
+                          {'terms': {'status': ['active'], 'boost': 5.0}}, clause)
+        with self.pushdown('off'):
+            query = get_graph_queries(
+                get_matching_graph('University of Excellence, USA', True))[1]
+        self.assertNotIn('terms', str(build_query(query).to_dict()))
+
+    def test_filter_same_as_off(self):
+        # the filtered out candidates were dropped from the output anyway
+        matched = {}
+        for mode in ['off', 'filter']:
+            with self.pushdown(mode):
+                matched[mode], _, _ = self.match(
+                    'University of Excellence, Creativity Institute, USA', 'sequential')
+        self.assertEqual([(m.organization.id, m.chosen) for m in matched['off']],
+                         [(m.organization.id, m.chosen) for m in matched['filter']])
@@ -1,6 +1,7 @@
 from django.test import SimpleTestCase
 
-from rorapi.v2.models import Aggregations, Organization, MatchedOrganization
+from rorapi.v2.models import Aggregations, Organization, MatchedOrganization, \
+    get_field_tree, get_source_fields
 from .utils import AttrDict
 
 
@@ -134,6 +135,42 @@ class OrganizationTestCase(SimpleTestCase):
             self.assertTrue(len(matched_ids) == 1)
 
 
+class SparseOrganizationTestCase(SimpleTestCase):
+    def test_field_tree(self):
+        self.assertIsNone(get_field_tree(None))
+        tree = get_field_tree(
+            ["names.value", "names", "id", "admin.created.date", "admin.created"]
+        )
+        self.assertEqual(tree, {"admin": {"created": {}}, "id": {}, "names": {}})
+        self.assertEqual(get_source_fields(tree), ["admin", "id", "names"])
+        tree = get_field_tree(["external_ids.all", "locations.geonames_id"])
+        self.assertEqual(
+            get_source_fields(tree),
+            ["external_ids.all", "external_ids.type", "locations"],
+        )
+
+    def test_sparse_attributes(self):
+        data = {
+            "id": "ror-id",
+            "names": [
+                {"types": ["alias"], "value": "Gallifrey University", "lang": None},
+                {"types": ["label"], "value": "Uniwersytet Gallifrenski", "lang": "pl"},
+            ],
+            "status": "active",
+        }
+        organization = Organization(
+            AttrDict(data), get_field_tree(["id", "names.value"])
+        )
+        self.assertEqual(organization.id, "ror-id")
+        self.assertEqual(
+            [n.value for n in organization.names],
+            ["Gallifrey University", "Uniwersytet Gallifrenski"],
+        )
+        self.assertFalse(hasattr(organization.names[0], "types"))
+        for a in ["admin", "established", "locations", "status", "types"]:
+            self.assertFalse(hasattr(organization, a))
+
+
 class MatchedOrganizationTestCase(SimpleTestCase):
     def test_attributes_exist(self):
         data = {
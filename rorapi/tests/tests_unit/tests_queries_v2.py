@@ -2,10 +2,18 @@ import json
 import mock
 import os
 
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, override_settings
+from elasticsearch import NotFoundError, RequestError
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+from elasticsearch_dsl.utils import AttrDict
 from rorapi.common.queries import get_ror_id, validate, build_search_query, \
-    build_retrieve_query, search_organizations, retrieve_organization
+    build_retrieve_query, search_organizations, retrieve_organization, \
+    get_search_plan, SearchPlan, SEARCH_CACHE, Cursor, encode_cursor, \
+    decode_cursor, get_plan_fingerprint, get_requested_fields
 from rorapi.settings import ES_VARS
+from rorapi.v2.models import get_field_tree
+from rorapi.v2.serializers import ListResultSerializer, OrganizationSerializer
 from .utils import IterableAttrDict
 
 
@@ -304,7 +312,7 @@ class BuildSearchQueryTestCase(SimpleTestCase):
     def test_query_advanced_status_filter(self):
         expected = {'query': {
             'bool': {
-                'filter': [{'terms': {'status': ('inactive',)}}],
+                'filter': [{'terms': {'status': ['inactive']}}],
                 'must': [{
                     'query_string': {
                         'query': 'query terms',
@@ -342,8 +350,8 @@ class BuildSearchQueryTestCase(SimpleTestCase):
         expected = {'query': {
             'bool': {
                 'filter': [
-                    {'terms': {'key1': ('val1',)}},
-                    {'terms': {'k2': ('value2',)}},
+                    {'terms': {'k2': ['value2']}},
+                    {'terms': {'key1': ['val1']}},
                     {'terms': {'status': ['active']}}
                 ],
             }
@@ -357,9 +365,9 @@ class BuildSearchQueryTestCase(SimpleTestCase):
         expected = {'query': {
             'bool': {
                 'filter': [
-                    {'terms': {'key1': ('val1',)}},
-                    {'terms': {'k2': ('value2',)}},
-                    {'terms': {'status': ('inactive',)}}
+                    {'terms': {'k2': ['value2']}},
+                    {'terms': {'key1': ['val1']}},
+                    {'terms': {'status': ['inactive']}}
                 ],
             }
         }}
@@ -372,7 +380,7 @@ class BuildSearchQueryTestCase(SimpleTestCase):
         expected = {'query': {
             'bool': {
                 'filter': [
-                    {'terms': {'locations.geonames_details.country_name': ('South Africa',)}},
+                    {'terms': {'locations.geonames_details.country_name': ['South Africa']}},
                     {'terms': {'status': ['active']}}
                 ],
             }
@@ -386,8 +394,8 @@ class BuildSearchQueryTestCase(SimpleTestCase):
         expected = {'query': {
             'bool': {
                 'filter': [
-                    {'terms': {'key1': ('val1',)}},
-                    {'terms': {'k2': ('value2',)}},
+                    {'terms': {'k2': ['value2']}},
+                    {'terms': {'key1': ['val1']}},
                 ],
             }
         }}
@@ -400,8 +408,8 @@ class BuildSearchQueryTestCase(SimpleTestCase):
         expected = {'query': {
             'bool': {
                 'filter': [
-                    {'terms': {'key1': ('val1',)}},
-                    {'terms': {'k2': ('value2',)}},
+                    {'terms': {'k2': ['value2']}},
+                    {'terms': {'key1': ['val1']}},
                     {'terms': {'status': ['active']}}
                 ],
                 'must': [{
@@ -427,8 +435,8 @@ class BuildSearchQueryTestCase(SimpleTestCase):
         expected = {'query': {
             'bool': {
                 'filter': [
-                    {'terms': {'key1': ('val1',)}},
-                    {'terms': {'k2': ('value2',)}},
+                    {'terms': {'k2': ['value2']}},
+                    {'terms': {'key1': ['val1']}},
                 ],
                 'must': [{
                     'nested': {
@@ -527,6 +535,9 @@ class SearchOrganizationsTestCase(SimpleTestCase):
                 os.path.join(os.path.dirname(__file__),
                              'data/test_data_search_es7_v2.json'), 'r') as f:
             self.test_data = json.load(f)
+        patcher = mock.patch.object(SEARCH_CACHE, 'ttl', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @mock.patch('elasticsearch_dsl.Search.execute')
     def test_search_organizations(self, search_mock):
@@ -602,6 +613,319 @@ class SearchOrganizationsTestCase(SimpleTestCase):
         self.assertEquals(len(error.errors), 6)
 
 
+class SearchPlanTestCase(SimpleTestCase):
+
+    def test_canonical_plan(self):
+        plan = get_search_plan({
+            'query': 'query terms',
+            'filter': 'types:Education,locations.geonames_details.country_code:us,'
+                      'types:facility,types:education',
+            'page': '2'})
+        self.assertEqual(plan, SearchPlan('string', 'query terms', (
+            ('locations.geonames_details.country_code', ('US',)),
+            ('status', ('active',)),
+            ('types', ('education', 'facility'))), 2))
+        self.assertEqual(plan, get_search_plan({
+            'page': '2',
+            'filter': 'types:FACILITY,country.country_code:US,types:education',
+            'query': 'query terms'}))
+
+    def test_status_default(self):
+        active = (('status', ('active',)),)
+        self.assertEqual(get_search_plan({}).filters, active)
+        self.assertEqual(get_search_plan({'all_status': 'false'}).filters, active)
+        self.assertEqual(get_search_plan({'all_status': ''}).filters, ())
+        self.assertEqual(get_search_plan({'filter': 'status:Inactive'}).filters,
+                         (('status', ('inactive',)),))
+        self.assertEqual(get_search_plan({'query.advanced': 'status:inactive'}).filters, ())
+        plan = get_search_plan({'query': 'https://ror.org/0w7hudk23'})
+        self.assertEqual(plan, SearchPlan('id', 'https://ror.org/0w7hudk23', (), 1))
+
+
+@override_settings(CACHES={'search': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SearchCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_search_es7_v2.json'), 'r') as f:
+            self.test_data = json.load(f)
+        patcher = mock.patch('rorapi.common.cache.get_index_generation',
+                             return_value='g1')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(SEARCH_CACHE, 'max_bytes', 1024 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        SEARCH_CACHE.cache.clear()
+
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_cached_search(self, search_mock):
+        search_mock.return_value = Response(Search(), self.test_data)
+        error, organizations = search_organizations(
+            {'filter': 'types:education,status:active'})
+        self.assertIsNone(error)
+        search_mock.assert_called_once()
+
+        # same plan, served from the cache
+        error, cached = search_organizations(
+            {'filter': 'status:ACTIVE,types:Education', 'page': '1'})
+        self.assertIsNone(error)
+        search_mock.assert_called_once()
+        self.assertEqual(cached.number_of_results, organizations.number_of_results)
+        self.assertEqual([o.id for o in cached.items], [o.id for o in organizations.items])
+        self.assertEqual([t.count for t in cached.meta.types],
+                         [t.count for t in organizations.meta.types])
+
+        # the active status is the default
+        search_organizations({'filter': 'types:education'})
+        self.assertEqual(search_mock.call_count, 1)
+        search_organizations({'filter': 'types:education', 'all_status': ''})
+        self.assertEqual(search_mock.call_count, 2)
+
+
+class FacetsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_search_es7_v2.json'), 'r') as f:
+            self.test_data = json.load(f)
+        patcher = mock.patch.object(SEARCH_CACHE, 'ttl', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_validate(self):
+        self.assertIsNone(validate({'facets': 'False'}))
+        self.assertEqual(len(validate({'facets': 'no'}).errors), 1)
+
+    def test_no_facets(self):
+        self.assertNotIn('aggs', build_search_query({'facets': 'false'}).to_dict())
+        self.assertIn('aggs', build_search_query({'facets': ''}).to_dict())
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_search_no_facets(self, search_mock):
+        del self.test_data['aggregations']
+        search_mock.return_value = Response(Search(), self.test_data)
+        error, organizations = search_organizations({'facets': 'false'})
+        self.assertIsNone(error)
+        self.assertNotIn('aggs', search_mock.call_args[0][0].to_dict())
+        data = ListResultSerializer(organizations).data
+        self.assertNotIn('meta', data)
+        self.assertEqual(len(data['items']), 20)
+
+    @mock.patch('rorapi.common.queries.get_precomputed_facets')
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_precomputed_facets(self, search_mock, facets_mock):
+        facets_mock.return_value = AttrDict({
+            'types': {'buckets': [{'key': 'education', 'doc_count': 7}]},
+            'countries': {'buckets': [{'key': 'FR', 'doc_count': 7}]},
+            'continents': {'buckets': [{'key': 'EU', 'doc_count': 7}]},
+            'statuses': {'buckets': [{'key': 'active', 'doc_count': 7}]}})
+        aggregations = self.test_data.pop('aggregations')
+        search_mock.return_value = Response(Search(), self.test_data)
+        error, organizations = search_organizations({'filter': 'types:education'})
+        self.assertIsNone(error)
+        facets_mock.assert_called_once_with(
+            (('status', ('active',)), ('types', ('education',))))
+        self.assertNotIn('aggs', search_mock.call_args[0][0].to_dict())
+        meta = ListResultSerializer(organizations).data['meta']
+        self.assertEqual(meta['countries'], [{'id': 'fr', 'title': 'France', 'count': 7}])
+
+        # the facets of other queries are aggregated by ES
+        facets_mock.reset_mock()
+        self.test_data['aggregations'] = aggregations
+        search_mock.return_value = Response(Search(), self.test_data)
+        search_organizations({'query': 'query terms'})
+        facets_mock.assert_not_called()
+        self.assertIn('aggs', search_mock.call_args[0][0].to_dict())
+
+
+class CursorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_search_es7_v2.json'), 'r') as f:
+            self.test_data = json.load(f)
+        for i, hit in enumerate(self.test_data['hits']['hits']):
+            hit['sort'] = [1.0, hit['_id']]
+        patcher = mock.patch.object(SEARCH_CACHE, 'ttl', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cursor(self, params, search_after=(1.0, 'https://ror.org/02bfwt286'), pit=None):
+        fingerprint = get_plan_fingerprint(get_search_plan(params))
+        return encode_cursor(Cursor(fingerprint, list(search_after), pit))
+
+    def test_encode_decode(self):
+        cursor = Cursor('abc', (2.5, 'https://ror.org/02bfwt286'), None)
+        self.assertEqual(decode_cursor(encode_cursor(cursor)), cursor)
+        cursor = Cursor('abc', (2.5, 'https://ror.org/02bfwt286', 7), 'p1')
+        self.assertEqual(decode_cursor(encode_cursor(cursor)), cursor)
+        for invalid in ['', 'abc', encode_cursor(['abc', 1, None]),
+                        encode_cursor(['abc', [], None]), 'é',
+                        encode_cursor(['abc', [2.5], None]),
+                        encode_cursor(['abc', ['2.5', 'id'], None]),
+                        encode_cursor(['abc', [True, 'id'], None]),
+                        encode_cursor(['abc', [2.5, 3], None]),
+                        encode_cursor(['abc', [2.5, 'id', 7], None]),
+                        encode_cursor(['abc', [2.5, 'id', 'x'], 'p1']),
+                        encode_cursor(['abc', [2.5, 'id'], 12]),
+                        encode_cursor([1, [2.5, 'id'], None])]:
+            with self.assertRaises(ValueError):
+                decode_cursor(invalid)
+
+    def test_validate(self):
+        self.assertIsNone(validate({'cursor': '*', 'filter': 'types:education'}))
+        cursor = self.cursor({'filter': 'types:education'})
+        self.assertIsNone(validate({'cursor': cursor, 'filter': 'types:Education'}))
+        errors = validate({'cursor': cursor, 'filter': 'types:facility'})
+        self.assertEqual(errors.errors, ["cursor '{}' was not issued for this query".format(cursor)])
+        self.assertEqual(validate({'cursor': '*', 'page': '2'}).errors,
+                         ['cursor and page parameters cannot be combined'])
+        self.assertEqual(validate({'cursor': 'abc'}).errors, ["cursor 'abc' is invalid"])
+
+    def test_build_query(self):
+        query = build_search_query({'cursor': '*'}).to_dict()
+        self.assertEqual(query['sort'], [{'_score': {'order': 'desc'}}, {'id': {'order': 'asc'}}])
+        self.assertNotIn('search_after', query)
+        self.assertEqual(query['from'], 0)
+
+        search = build_search_query({'cursor': self.cursor({}, pit='p1')})
+        query = search.to_dict()
+        self.assertEqual(query['search_after'], [1.0, 'https://ror.org/02bfwt286'])
+        self.assertEqual(query['pit']['id'], 'p1')
+        self.assertIsNone(search._index)
+        self.assertNotIn('sort', build_search_query({'page': '2'}).to_dict())
+
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_next_cursor(self, search_mock):
+        search_mock.return_value = Response(Search(), self.test_data)
+        error, organizations = search_organizations({'cursor': '*'})
+        self.assertIsNone(error)
+        cursor = decode_cursor(organizations.next_cursor)
+        self.assertEqual(cursor.search_after, (1.0, self.test_data['hits']['hits'][-1]['_id']))
+        self.assertIsNone(cursor.pit)
+        self.assertIsNone(validate({'cursor': organizations.next_cursor}))
+        self.assertFalse(hasattr(search_organizations({})[1], 'next_cursor'))
+
+        # last page
+        self.test_data['hits']['hits'] = self.test_data['hits']['hits'][:5]
+        search_mock.return_value = Response(Search(), self.test_data)
+        error, organizations = search_organizations({'cursor': organizations.next_cursor})
+        self.assertIsNone(error)
+        self.assertIsNone(organizations.next_cursor)
+        self.assertEqual(len(organizations.items), 5)
+        self.assertIsNone(ListResultSerializer(organizations).data['next_cursor'])
+        self.assertNotIn('next_cursor', ListResultSerializer(search_organizations({})[1]).data)
+
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_invalid_or_expired_cursor(self, search_mock):
+        cursor = self.cursor({}, pit='p1')
+        for error in [RequestError(400, 'search_phase_execution_exception'),
+                      NotFoundError(404, 'search_context_missing_exception')]:
+            search_mock.side_effect = error
+            errors, organizations = search_organizations({'cursor': cursor})
+            self.assertIsNone(organizations)
+            self.assertEqual(errors.errors,
+                             ["cursor '{}' is invalid or expired".format(cursor)])
+        # errors of other queries are not cursor errors
+        with self.assertRaises(NotFoundError):
+            search_organizations({'cursor': '*'})
+
+    @mock.patch.dict('rorapi.common.queries.ES_VARS', {'CURSOR_PIT': True})
+    @mock.patch('rorapi.common.queries.close_point_in_time')
+    @mock.patch('rorapi.common.queries.open_point_in_time', return_value='p1')
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_point_in_time(self, search_mock, open_mock, close_mock):
+        self.test_data['pit_id'] = 'p2'
+        search_mock.return_value = Response(Search(), self.test_data)
+        _, organizations = search_organizations({'cursor': '*'})
+        open_mock.assert_called_once()
+        self.assertEqual(decode_cursor(organizations.next_cursor).pit, 'p2')
+
+        self.test_data['hits']['hits'] = []
+        search_mock.return_value = Response(Search(), self.test_data)
+        _, organizations = search_organizations({'cursor': organizations.next_cursor})
+        open_mock.assert_called_once()
+        close_mock.assert_called_once_with('p2')
+        self.assertIsNone(organizations.next_cursor)
+
+
+class FieldsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_search_es7_v2.json'), 'r') as f:
+            self.test_data = json.load(f)
+        patcher = mock.patch.object(SEARCH_CACHE, 'ttl', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requested_fields(self):
+        self.assertIsNone(get_requested_fields(None))
+        self.assertIsNone(get_requested_fields(' , '))
+        self.assertEqual(get_requested_fields('names.value, id,names.value'),
+                         ('id', 'names.value'))
+
+    def test_validate(self):
+        self.assertIsNone(validate({'fields': 'id,names.value,locations'}))
+        self.assertIsNone(validate({'fields': 'locations.geonames_details'}))
+        error = validate({'fields': 'id,name,names.val,names.value.x'})
+        self.assertEqual(error.errors, ["field 'name' is illegal",
+                                        "field 'names.val' is illegal",
+                                        "field 'names.value.x' is illegal"])
+
+    def test_source(self):
+        query = build_search_query(
+            {'fields': 'id,names.value,locations.geonames_details.country_code'})
+        self.assertEqual(query.to_dict()['_source'],
+                         ['id', 'locations', 'names.value'])
+        query = build_search_query({'fields': 'names.types,links'})
+        self.assertEqual(query.to_dict()['_source'],
+                         ['links', 'names.types', 'names.value'])
+        self.assertNotIn('_source', build_search_query({}).to_dict())
+        query = build_retrieve_query('ror-id', ('id',))
+        self.assertEqual(query.to_dict()['_source'], ['id'])
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_search(self, search_mock):
+        search_mock.return_value = Response(Search(), self.test_data)
+        fields = 'id,names.value,locations.geonames_details.country_code'
+        error, organizations = search_organizations({'fields': fields})
+        self.assertIsNone(error)
+        data = ListResultSerializer(
+            organizations, fields=get_field_tree(get_requested_fields(fields))).data
+        self.assertEqual(len(data['items']), 20)
+        for item in data['items']:
+            self.assertEqual(set(item), {'id', 'locations', 'names'})
+            self.assertEqual(set(item['names'][0]), {'value'})
+            self.assertEqual(item['locations'][0],
+                             {'geonames_details': {'country_code': 'AU'}})
+        # the facets are not restricted
+        self.assertIn('meta', data)
+
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_retrieve(self, search_mock):
+        with open(
+                os.path.join(os.path.dirname(__file__),
+                             'data/test_data_retrieve_es7_v2.json'), 'r') as f:
+            test_data = json.load(f)
+        search_mock.return_value = \
+            IterableAttrDict(test_data, test_data['hits']['hits'])
+        error, organization = retrieve_organization('ror-id', ('id', 'types'))
+        self.assertIsNone(error)
+        self.assertFalse(hasattr(organization, 'names'))
+        data = OrganizationSerializer(
+            organization, fields=get_field_tree(('id', 'types'))).data
+        self.assertEqual(data, {
+            'id': test_data['hits']['hits'][0]['_source']['id'],
+            'types': sorted(test_data['hits']['hits'][0]['_source']['types'])})
+
+
 class RetrieveOrganizationsTestCase(SimpleTestCase):
 
     def setUp(self):
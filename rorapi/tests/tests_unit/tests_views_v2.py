@@ -2,10 +2,15 @@ import json
 import mock
 import os
 
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import SimpleTestCase, Client
+from elasticsearch import NotFoundError
 from rest_framework.test import APIRequestFactory
 
 from rorapi.common import views
+from rorapi.common.export import ExportRateThrottle
+from rorapi.common.queries import SEARCH_CACHE, Cursor, encode_cursor, \
+    get_plan_fingerprint, get_search_plan
 from rorapi.v2.models import Organization as OrganizationV2
 
 from .utils import IterableAttrDict
@@ -21,6 +26,9 @@ class ViewListTestCase(SimpleTestCase):
                 os.path.join(os.path.dirname(__file__),
                              'data/test_data_search_es7_v2.json'), 'r') as f:
             self.test_data = json.load(f)
+        patcher = mock.patch.object(SEARCH_CACHE, 'ttl', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @mock.patch('elasticsearch_dsl.Search.execute')
     def test_search_organizations(self, search_mock):
@@ -79,6 +87,23 @@ class ViewListTestCase(SimpleTestCase):
         self.assertEquals(list(organizations.keys()), ['errors'])
         self.assertEquals(len(organizations['errors']), 6)
 
+    @mock.patch('elasticsearch_dsl.Search.execute')
+    def test_invalid_or_expired_cursor(self, search_mock):
+        view = views.OrganizationViewSet.as_view({'get': 'list'})
+        forged = encode_cursor([get_plan_fingerprint(get_search_plan({})),
+                                ['1.0', 2, 3], None])
+        expired = encode_cursor(Cursor(get_plan_fingerprint(get_search_plan({})),
+                                       [1.0, 'https://ror.org/02bfwt286'], 'p1'))
+        search_mock.side_effect = NotFoundError(404, 'search_context_missing_exception')
+        for cursor, error in [(forged, "cursor '{}' is invalid"),
+                              (expired, "cursor '{}' is invalid or expired")]:
+            request = factory.get('/v2/organizations', {'cursor': cursor})
+            response = view(request, version=self.V2_VERSION)
+            response.render()
+            organizations = json.loads(response.content.decode('utf-8'))
+            self.assertEquals(organizations, {'errors': [error.format(cursor)]})
+        search_mock.assert_called_once()
+
     @mock.patch('elasticsearch_dsl.Search.execute')
     def test_query_redirect(self, search_mock):
         client = Client()
@@ -299,6 +324,17 @@ class HeartbeatViewTestCase(SimpleTestCase):
         response = self.client.get('/v2/heartbeat')
         self.assertEquals(response.status_code, 200)
 
+class ExportViewTestCase(SimpleTestCase):
+    def test_invalid_export_not_throttled(self):
+        cache = LocMemCache(self.id(), {})
+        with mock.patch.object(ExportRateThrottle, 'cache', cache), \
+                mock.patch.dict('rorapi.common.export.EXPORT', {'RATE': '1/hour'}):
+            for _ in range(2):
+                response = self.client.get('/v2/organizations/export', {'page': '2'})
+                self.assertEquals(response.status_code, 400)
+            request = APIRequestFactory().get('/v2/organizations/export')
+            self.assertTrue(ExportRateThrottle().allow_request(request, None))
+
 class BulkUpdateViewTestCase(SimpleTestCase):
     def setUp(self):
         self.csv_errors_empty = []
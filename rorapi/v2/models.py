@@ -1,8 +1,8 @@
-from geonamescache.mappers import country
 import random
 import string
 from django.db import models
-from rorapi.common.models import TypeBucket, CountryBucket, StatusBucket, Entity
+from rorapi.common.models import TypeBucket, CountryBucket, StatusBucket, Entity, \
+    COUNTRY_NAMES
 from rorapi.v2.record_constants import continent_code_to_name
 
 class ContinentBucket:
@@ -18,12 +18,7 @@ class CountryBucket:
 
     def __init__(self, data):
         self.id = data.key.lower()
-        mapper = country(from_key="iso", to_key="name")
-        try:
-            self.title = mapper(data.key)
-        except AttributeError:
-            # if we have a country code with no name mapping, skip it to prevent 500
-            pass
+        self.title = COUNTRY_NAMES.get(data.key)
         self.count = data.doc_count
 
 
@@ -79,41 +74,112 @@ class Admin:
                 pass
 
 
+# Key the items of the lists of an organization are sorted by, fetched
+# whenever one of their fields is
+SORT_KEYS = {
+    "external_ids": "type",
+    "links": "type",
+    "names": "value",
+    "relationships": "type",
+}
+
+
+def get_field_tree(fields):
+    """Tree of the fields selected by a list of dotted field names, as nested
+    dicts, an empty dict selecting a whole part. None selects all fields."""
+
+    if fields is None:
+        return None
+    tree = {}
+    for field in sorted(fields, key=lambda f: f.count(".")):
+        node = tree
+        for name in field.split("."):
+            if name in node and not node[name]:
+                # the whole part is already selected
+                break
+            node = node.setdefault(name, {})
+    return tree
+
+
+def get_source_fields(tree):
+    """Fields of the ES _source needed to build the organizations with the
+    fields of the tree. Admin details and locations are fetched whole."""
+
+    source = []
+    for name, subtree in tree.items():
+        if not subtree or name not in SORT_KEYS:
+            source.append(name)
+        else:
+            source.extend(name + "." + f for f in set(subtree) | {SORT_KEYS[name]})
+    return sorted(source)
+
+
+def is_selected(tree, name):
+    return tree is None or name in tree
+
+
+def select_attributes(tree, name, attributes):
+    if tree is None or not tree[name]:
+        return attributes
+    return [a for a in attributes if a in tree[name]]
+
+
 class Organization(Entity):
-    """Organization model class"""
+    """Organization model class. Only the parts of the organization selected
+    by the field tree are built."""
 
-    def __init__(self, data):
+    def __init__(self, data, fields=None):
         if "_source" in data:
             data = data["_source"]
         super(Organization, self).__init__(
-            data, ["established", "id", "status"]
+            data, [a for a in ["established", "id", "status"] if is_selected(fields, a)]
         )
-        self.admin = Admin(data.admin)
-        self.domains = sorted(data.domains)
-        sorted_ext_ids = sorted(data.external_ids, key=lambda x: x['type'])
-        self.external_ids = [
-            Entity(e, ["type", "preferred", "all"]) for e in sorted_ext_ids
-        ]
-        sorted_links = sorted(data.links, key=lambda x: x['type'])
-        self.links = [Entity(l, ["value", "type"]) for l in sorted_links]
-        self.locations = [Location(l) for l in data.locations]
-        sorted_names = sorted(data.names, key=lambda x: x['value'])
-        self.names = [Entity(n, ["value", "lang", "types"]) for n in sorted_names]
-        sorted_rels = sorted(data.relationships, key=lambda x: x['type'])
-        self.relationships = [
-            Entity(r, ["type", "label", "id"]) for r in sorted_rels
-        ]
-        self.types = sorted(data.types)
+        if is_selected(fields, "admin"):
+            self.admin = Admin(data.admin)
+        if is_selected(fields, "domains"):
+            self.domains = sorted(data.domains)
+        if is_selected(fields, "external_ids"):
+            sorted_ext_ids = sorted(data.external_ids, key=lambda x: x['type'])
+            attributes = select_attributes(
+                fields, "external_ids", ["type", "preferred", "all"]
+            )
+            self.external_ids = [Entity(e, attributes) for e in sorted_ext_ids]
+        if is_selected(fields, "links"):
+            sorted_links = sorted(data.links, key=lambda x: x['type'])
+            attributes = select_attributes(fields, "links", ["value", "type"])
+            self.links = [Entity(l, attributes) for l in sorted_links]
+        if is_selected(fields, "locations"):
+            self.locations = [Location(l) for l in data.locations]
+        if is_selected(fields, "names"):
+            sorted_names = sorted(data.names, key=lambda x: x['value'])
+            attributes = select_attributes(fields, "names", ["value", "lang", "types"])
+            self.names = [Entity(n, attributes) for n in sorted_names]
+        if is_selected(fields, "relationships"):
+            sorted_rels = sorted(data.relationships, key=lambda x: x['type'])
+            attributes = select_attributes(
+                fields, "relationships", ["type", "label", "id"]
+            )
+            self.relationships = [Entity(r, attributes) for r in sorted_rels]
+        if is_selected(fields, "types"):
+            self.types = sorted(data.types)
 
 
 class ListResult:
     """A model class for the list of organizations returned from the search"""
 
-    def __init__(self, data):
+    def __init__(self, data, next_cursor=None, cursor=False, facets=True,
+                 aggregations=None, fields=None):
         self.number_of_results = data.hits.total.value
         self.time_taken = data.took
-        self.items = [Organization(x) for x in data]
-        self.meta = Aggregations(data.aggregations)
+        self.items = [Organization(x, fields) for x in data]
+        # facets can be left out, or precomputed instead of aggregated by ES
+        if facets:
+            self.meta = Aggregations(
+                data.aggregations if aggregations is None else aggregations
+            )
+        # only reported when paginating with a cursor, None after the last page
+        if cursor:
+            self.next_cursor = next_cursor
 
 
 class MatchedOrganization:
@@ -131,9 +197,15 @@ class MatchedOrganization:
 class MatchingResult:
     """A model class for the result of affiliation matching"""
 
-    def __init__(self, data):
+    def __init__(self, data, stage=None, partial=False):
         self.number_of_results = len(data)
         self.items = [MatchedOrganization(x) for x in data]
+        # only reported by the cascade matching
+        if stage is not None:
+            self.stage = stage
+        # only reported when the matching was cut short by its deadline
+        if partial:
+            self.partial = True
 
 
 class Client(models.Model):
@@ -3,7 +3,8 @@ import bleach
 import pycountry
 import re
 from rorapi.v2.models import Client
-from rorapi.common.serializers import BucketSerializer, OrganizationRelationshipsSerializer
+from rorapi.common.serializers import BucketSerializer, OrganizationRelationshipsSerializer, \
+    restrict_fields
 
 class AggregationsSerializer(serializers.Serializer):
     types = BucketSerializer(many=True)
@@ -72,12 +73,23 @@ class OrganizationSerializer(serializers.Serializer):
     status = serializers.CharField()
     types = serializers.StringRelatedField(many=True)
 
+    def __init__(self, *args, fields=None, **kwargs):
+        super(OrganizationSerializer, self).__init__(*args, **kwargs)
+        if fields is not None:
+            restrict_fields(self, fields)
+
 
 class ListResultSerializer(serializers.Serializer):
     number_of_results = serializers.IntegerField()
     time_taken = serializers.IntegerField()
+    next_cursor = serializers.CharField(required=False)
     items = OrganizationSerializer(many=True)
-    meta = AggregationsSerializer()
+    meta = AggregationsSerializer(required=False)
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super(ListResultSerializer, self).__init__(*args, **kwargs)
+        if fields is not None:
+            restrict_fields(self.fields["items"].child, fields)
 
 
 class MatchedOrganizationSerializer(serializers.Serializer):
@@ -90,6 +102,8 @@ class MatchedOrganizationSerializer(serializers.Serializer):
 
 class MatchingResultSerializer(serializers.Serializer):
     number_of_results = serializers.IntegerField()
+    stage = serializers.CharField(required=False)
+    partial = serializers.BooleanField(required=False)
     items = MatchedOrganizationSerializer(many=True)
 
 
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rorapi.settings')
 
 application = get_wsgi_application()
+
+# the local matching engine index is built by each process before it
+# serves requests
+from rorapi.common.matching_local import load_local_index  # noqa: E402
+
+load_local_index()